@@ -2,15 +2,74 @@ package org.montage.ble;
 
 import android.bluetooth.BluetoothGatt;
 import android.bluetooth.BluetoothGattCallback;
+import android.bluetooth.BluetoothGattCharacteristic;
+import android.bluetooth.BluetoothGattDescriptor;
 import android.bluetooth.BluetoothProfile;
+import android.bluetooth.le.ScanCallback;
+import android.bluetooth.le.ScanResult;
 import android.util.Log;
 
+import java.util.Arrays;
+
 public class MyGattCallback extends BluetoothGattCallback {
+    // Implemented in Python (transport_android.py, GattEventListener) to receive GATT events
+    // as they happen instead of polling for them.
+    public interface Listener {
+        void onConnectionStateChange(int status, int newState);
+        void onServicesDiscovered(int status);
+        void onCharacteristicWrite(int status);
+        void onMtuChanged(int mtu, int status);
+        void onDescriptorWrite(int status);
+        void onCharacteristicChanged(String uuid, byte[] value);
+    }
+
+    // 247 bytes fills one LE data-length-extended packet (251 minus the L2CAP header)
+    public static final int PREFERRED_MTU = 247;
+
+    private Listener listener;
+
+    // Cleared by the app when it reconnects with BluetoothGatt.connect() and
+    // reuses the services it discovered before: onServicesDiscovered is then
+    // reported as soon as the link is set up, without a discovery round trip.
+    private boolean discoverServices = true;
+
+    public MyGattCallback() {
+    }
+
+    public MyGattCallback(Listener listener) {
+        this.listener = listener;
+    }
+
+    public void setListener(Listener listener) {
+        this.listener = listener;
+    }
+
+    public void setDiscoverServices(boolean discoverServices) {
+        this.discoverServices = discoverServices;
+    }
+
+    private void discoverServices(BluetoothGatt gatt) {
+        if (discoverServices) {
+            gatt.discoverServices();
+        } else if (listener != null) {
+            listener.onServicesDiscovered(BluetoothGatt.GATT_SUCCESS);
+        }
+    }
+
     @Override
     public void onConnectionStateChange(BluetoothGatt gatt, int status, int newState) {
+        // The app hears about the link before anything that follows from it
+        if (listener != null) {
+            listener.onConnectionStateChange(status, newState);
+        }
         if (newState == BluetoothProfile.STATE_CONNECTED) {
             Log.d("MyGattCallback", "Connected to GATT server.");
-            gatt.discoverServices();
+            // Shorter connection interval for lower command latency
+            gatt.requestConnectionPriority(BluetoothGatt.CONNECTION_PRIORITY_HIGH);
+            // Negotiate the MTU first; discovery starts from onMtuChanged
+            if (!gatt.requestMtu(PREFERRED_MTU)) {
+                discoverServices(gatt);
+            }
         } else if (newState == BluetoothProfile.STATE_DISCONNECTED) {
             Log.d("MyGattCallback", "Disconnected from GATT server.");
         }
@@ -19,5 +78,74 @@ public class MyGattCallback extends BluetoothGattCallback {
     @Override
     public void onServicesDiscovered(BluetoothGatt gatt, int status) {
         Log.d("MyGattCallback", "Services discovered with status: " + status);
+        if (listener != null) {
+            listener.onServicesDiscovered(status);
+        }
+    }
+
+    @Override
+    public void onMtuChanged(BluetoothGatt gatt, int mtu, int status) {
+        Log.d("MyGattCallback", "MTU changed to " + mtu + " with status: " + status);
+        if (listener != null) {
+            listener.onMtuChanged(mtu, status);
+        }
+        discoverServices(gatt);
+    }
+
+    @Override
+    public void onCharacteristicWrite(BluetoothGatt gatt, BluetoothGattCharacteristic characteristic, int status) {
+        if (listener != null) {
+            listener.onCharacteristicWrite(status);
+        }
+    }
+
+    @Override
+    public void onDescriptorWrite(BluetoothGatt gatt, BluetoothGattDescriptor descriptor, int status) {
+        Log.d("MyGattCallback", "Descriptor write with status: " + status);
+        if (listener != null) {
+            listener.onDescriptorWrite(status);
+        }
+    }
+
+    // Notifications, e.g. firmware telemetry. The value is copied because the
+    // characteristic's buffer is reused for the next notification.
+    @Override
+    public void onCharacteristicChanged(BluetoothGatt gatt, BluetoothGattCharacteristic characteristic) {
+        byte[] value = characteristic.getValue();
+        if (listener != null && value != null) {
+            listener.onCharacteristicChanged(characteristic.getUuid().toString(), Arrays.copyOf(value, value.length));
+        }
+    }
+
+    // Scan callback for the app's filtered scan. ScanCallback is an abstract
+    // class, so Python cannot implement it directly; results are forwarded to
+    // a ScanListener implemented in transport_android.py (ScanEventListener).
+    public static class Scanner extends ScanCallback {
+        public interface ScanListener {
+            void onScanResult(String address, String name, int rssi);
+            void onScanFailed(int errorCode);
+        }
+
+        private ScanListener listener;
+
+        public Scanner(ScanListener listener) {
+            this.listener = listener;
+        }
+
+        @Override
+        public void onScanResult(int callbackType, ScanResult result) {
+            String name = result.getScanRecord() != null ? result.getScanRecord().getDeviceName() : null;
+            if (listener != null) {
+                listener.onScanResult(result.getDevice().getAddress(), name, result.getRssi());
+            }
+        }
+
+        @Override
+        public void onScanFailed(int errorCode) {
+            Log.d("MyGattCallback", "Scan failed with error: " + errorCode);
+            if (listener != null) {
+                listener.onScanFailed(errorCode);
+            }
+        }
     }
-}
\ No newline at end of file
+}
@@ -1,33 +1,162 @@
 import bluetooth
-from bluetooth import BLE, UUID, FLAG_READ, FLAG_WRITE
+from bluetooth import BLE, UUID, FLAG_READ, FLAG_WRITE, FLAG_NOTIFY
 import struct
+import gc
 from machine import Pin
 import neopixel
 import time
-
-#D0:   GPIO21 pin0
-#D1:   GPIO22 pin1
-#D2:   GPIO14 pin2
-#D3:   GPIO32 pin3
-#D4:   GPIO15 pin4
-#D5:   GPIO33 pin5
+import micropython
+from micropython import const
+import uasyncio as asyncio
+import fwlog as log
+import montages
+import framestream
+import animator
+import eventqueue
+import stripout
+from eventqueue import EVENT_COMMAND, EVENT_CHUNK, EVENT_BUTTON
+
+# Set to 1 for development builds. With 0 every `if DEBUG_BUILD:` block is
+# compiled out and nothing is printed to the console; INFO and above still
+# go to the fwlog ring buffer (fwlog.dump() from the REPL). INFO is for state
+# changes and errors: messages about single commands go under DEBUG_BUILD,
+# so production builds spend nothing on them.
+DEBUG_BUILD = const(0)
+
+if DEBUG_BUILD:
+    log.configure(console=log.DEBUG, ring=log.DEBUG)
+else:
+    log.configure(console=log.OFF, ring=log.INFO)
+
+# Link settings. Writes without response skip the ATT round trip, and the
+# larger MTU and attribute buffer leave room for payloads beyond 20 bytes.
+FLAG_WRITE_NO_RESPONSE = const(0x0004)
+PREFERRED_MTU = const(247)
+CHAR_BUFFER_SIZE = const(244)  # PREFERRED_MTU minus the 3-byte ATT header
+# Preferred connection interval range, in 1.25 ms units (7.5 ms to 15 ms)
+CONN_INTERVAL_MIN = const(6)
+CONN_INTERVAL_MAX = const(12)
+
+# Binary command frame, version 1 (built by encode_command in commands.py)
+#
+#   byte 0     header: 0xB0 marker | protocol version
+#   byte 1     opcode
+#   byte 2     montage id, 1-based position in montages.json (0 = off)
+#   bytes 3-5  red, green, blue
+#   byte 6     brightness, 255 = full
+#   bytes 7-8  sequence number, uint16 little endian
+#
+# OP_LAYERS lights several montages at once. Byte 2 is then the number of
+# layers and bytes 3-5 the color for LEDs that two or more layers share
+# (0, 0, 0 leaves them to the top layer). After the sequence number come
+# LAYER_LEN bytes per layer: montage id, red, green, blue, priority. Layers
+# are drawn lowest priority first, so the highest priority wins where they
+# overlap, and the later layer on a tie.
+#
+# Text commands ("cz_ref blue") always start with an ASCII byte, so the old
+# format is still accepted as a fallback.
+PROTOCOL_HEADER = const(0xB1)
+FRAME_LEN = const(9)
+OP_SET_MONTAGE = const(0x01)
+OP_OFF = const(0x02)
+OP_ANIMATE = const(0x03)  # SET_MONTAGE fields, then effect and uint16 period in ms
+OP_LAYERS = const(0x04)  # layer count and overlap color, then the layers
+OP_FRAME_CHUNK = const(0x10)  # raw frame streaming, see framestream.py
+ANIMATE_FRAME_LEN = const(12)
+LAYER_LEN = const(5)
+MAX_LAYERS = const(9)
+STREAM_REPORT_INTERVAL = const(100)  # frames between stream statistics log lines
+
+# Telemetry characteristic (read/notify), decoded by telemetry.py in the app.
+# Sent after every command and every TELEMETRY_INTERVAL_MS while connected.
+#
+#   byte 0       TELEMETRY_VERSION
+#   byte 1       opcode of the last command (0 = text command)
+#   bytes 2-3    its sequence number (stream frames: frame id)
+#   bytes 4-7    decode time, us
+#   bytes 8-11   render time, us
+#   bytes 12-15  strip write time, us
+#   bytes 16-19  gc.mem_free()
+#   bytes 20-21  events dropped because the queue was full
+#   bytes 22-23  events replaced by a newer one in the queue
+#   bytes 24-25  stale commands ignored
+#   bytes 26-27  stream frames dropped
+#   bytes 28-31  uptime, ms
+#
+# All multi-byte fields are little endian; counters wrap.
+TELEMETRY_VERSION = const(1)
+TELEMETRY_FORMAT = "<BBHIIIIHHHHI"
+TELEMETRY_LEN = const(32)
+TELEMETRY_INTERVAL_MS = const(5000)
+
+# How the strips are driven, see stripout.py. OUTPUT_AUTO takes the RMT
+# backend, all strips written in parallel, when the heap has room for its
+# pulse lists (a SPIRAM build), and bit-bangs the strips otherwise.
+STRIP_OUTPUT = stripout.OUTPUT_AUTO
+
+# Room for every chunk of a full-size stream frame at the preferred MTU
+EVENT_QUEUE_SIZE = const(32)
+POWER_DOWN_DELAY_MS = const(2000)  # strips go dark before the relay cuts their supply
+
+# RGB values for the color names of the text format
+COLOR_MAP = {
+    "red": (75, 0, 0),
+    "blue": (0, 0, 75),
+    "green": (0, 75, 0),
+    "yellow": (75, 75, 0),
+    "white": (75, 75, 75),
+    "purple": (70, 0, 70),
+    "orange": (76, 85, 0),
+}
+
+# LEDs on each strip (np0-np3 in montages.json) and the GPIO driving it:
+#
+#   np0   D0   GPIO21   192 LEDs
+#   np1   D1   GPIO22    69 LEDs
+#   np2   D2   GPIO14    79 LEDs
+#   np3   D3   GPIO32   159 LEDs
+#
+# Every buffer that holds pixels is sized from these lengths, and montage
+# spans are checked against them at boot. const() tuples need MicroPython
+# 1.19 or later.
+STRIP_LENGTHS = const((192, 69, 79, 159))
+STRIP_PINS = const((21, 22, 14, 32))
+LEGACY_STRIP_PIXELS = const(525)  # what every strip used to be allocated, for report_memory()
 
 ButtonPin = Pin(27, Pin.IN, Pin.PULL_DOWN)
 PowerRelayControl = Pin(12, Pin.OUT)
 
 
 
+# Pin IRQ: only queues the button level; handle_button() acts on it
 def SwitchHandler(pin):
-    if pin.value() == 1:
+    ble_peripheral.events.put(EVENT_BUTTON, pin.value())
+
+
+power_down_task = None
+
+
+def handle_button(value):
+    global power_down_task
+    if value == 1:
+        # Pressed again before the relay went off: keep the power on
+        if power_down_task is not None:
+            power_down_task.cancel()
+            power_down_task = None
         PowerRelayControl.on()
-        print(f"Button Value = {pin.value()}")
-        print(f"Power Relay Value = {PowerRelayControl.value()}")
+        log.info("Button value = %d, power relay value = %d", value, PowerRelayControl.value())
     else:
         ble_peripheral.turn_off()
-        time.sleep(2)
-        PowerRelayControl.off()
-        print(f"Button Value On Depress = {pin.value()}")
-        print(f"Power Relay Value On Depress = {PowerRelayControl.value()}")
+        if power_down_task is None:
+            power_down_task = asyncio.create_task(power_down())
+
+
+async def power_down():
+    global power_down_task
+    await asyncio.sleep_ms(POWER_DOWN_DELAY_MS)
+    power_down_task = None
+    PowerRelayControl.off()
+    log.info("Button value on depress = %d, power relay value = %d", ButtonPin.value(), PowerRelayControl.value())
 
 
 
@@ -46,18 +175,112 @@ def advertising_payload(name=None, services=None):
                 raise ValueError("Unsupported UUID length")
     return payload
 
+
+# Keeps rendered montage frames so a repeated (montage, color) command only
+# has to copy bytes into the NeoPixel buffers instead of rendering it again.
+# Each entry is one bytes object per strip; the least recently used entry is
+# dropped once the total size would go over max_bytes.
+class FrameCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.frames = {}
+        self.order = []  # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.order[-1] != key:
+            self.order.remove(key)
+            self.order.append(key)
+        return frame
+
+    def put(self, key, frame):
+        size = 0
+        for strip in frame:
+            size += len(strip)
+        if size > self.max_bytes:
+            return
+        if key in self.frames:
+            self.discard(key)
+        while self.used_bytes + size > self.max_bytes:
+            self.discard(self.order[0])
+        self.frames[key] = frame
+        self.order.append(key)
+        self.used_bytes += size
+
+    def discard(self, key):
+        frame = self.frames.pop(key)
+        self.order.remove(key)
+        for strip in frame:
+            self.used_bytes -= len(strip)
+
+    def clear(self):
+        self.frames = {}
+        self.order = []
+        self.used_bytes = 0
+
+
 class BLEPeripheral:
-    def __init__(self, num_pixels, pin0, pin1, pin2, pin3, pin4, pin5):
+    FRAME_CACHE_BYTES = 32 * 1024  # about 21 full frames at STRIP_LENGTHS
+
+    def __init__(self, strip_lengths, pins):
         self.ble = BLE()
         self.ble.active(True)
+        self.ble.config(mtu=PREFERRED_MTU)
         self.connected = False
-        self.num_pixels = num_pixels
-        self.np0 = neopixel.NeoPixel(Pin(pin0), num_pixels)
-        self.np1 = neopixel.NeoPixel(Pin(pin1), num_pixels)
-        self.np2 = neopixel.NeoPixel(Pin(pin2), num_pixels)
-        self.np3 = neopixel.NeoPixel(Pin(pin3), num_pixels)
-        self.service_handle = None
+        self.mtu = 23
+        self.strips = tuple(neopixel.NeoPixel(Pin(pin), n) for pin, n in zip(pins, strip_lengths))
+        self.np0, self.np1, self.np2, self.np3 = self.strips
+        self.bufs = tuple(strip.buf for strip in self.strips)
+        self.blanks = tuple(bytes(len(buf)) for buf in self.bufs)
+        # Last committed contents of each strip. The LEDs may still hold
+        # anything after a reset, so start from a state no frame can match.
+        self.shown = [bytearray(b"\xff" * len(strip.buf)) for strip in self.strips]
+        self.output = stripout.make_output(STRIP_OUTPUT, self.strips)
+        self.frame_cache = FrameCache(self.FRAME_CACHE_BYTES)
+        # Montages come from montages.json; the lists are indexed by montage id
+        names, tables, masks = montages.load(strip_lengths)
+        self.montage_names = ["off"] + names
+        self.montage_spans = [None] + tables
+        self.montage_masks = [None] + masks
+        # Scratch for show_layers(): draw order, and the LEDs lit by one
+        # layer and by more than one
+        self.layer_order = bytearray(MAX_LAYERS)
+        self.layers_seen = montages.empty_mask(strip_lengths)
+        self.layers_shared = montages.empty_mask(strip_lengths)
+        self.montage_ids = {}
+        for montage_id, name in enumerate(self.montage_names):
+            self.montage_ids[name] = montage_id
+        self.last_seq = -1  # no binary frame seen on this connection yet
+        self.stale_commands = 0
+        self.stream = framestream.FrameAssembler(
+            framestream.max_payload_len([len(strip) for strip in self.strips]))
+        self.stream_frame_id = -1  # stream frame currently on the strips, -1 if none
+        self.stream_frames = 0
+        self.stream_bytes = 0
+        self.stream_window_start = 0
+        self.stream_window_frames = 0
+        self.stream_window_bytes = 0
+        self.animator = animator.Animator(self)
+        self.events = eventqueue.EventQueue(EVENT_QUEUE_SIZE)
+        self.conn_handle = None
+        # Timings of the last command, see publish_telemetry()
+        self.telemetry = bytearray(TELEMETRY_LEN)
+        self.last_opcode = 0
+        self.last_command_seq = 0
+        self.decode_us = 0
+        self.render_us = 0
+        self.write_us = 0
+        self.uptime_ms = 0
+        self.uptime_mark = time.ticks_ms()
         self.char_handle = None
+        self.telemetry_handle = None
         self.setup_services()
         self.start_advertising()
 
@@ -65,463 +288,473 @@ class BLEPeripheral:
         # Define UUIDs
         service_uuid = UUID("3322271e-756a-443d-8a9d-2f90c7a73bf5")
         char_uuid = UUID("9b7a6e35-cb8d-473b-9346-15507d362aa3")
+        telemetry_uuid = UUID("9b7a6e36-cb8d-473b-9346-15507d362aa3")
 
-        # Define characteristic
-        char = (char_uuid, FLAG_WRITE | FLAG_READ)
-        services = [(service_uuid, [char])]
+        # Define characteristics
+        char = (char_uuid, FLAG_WRITE | FLAG_WRITE_NO_RESPONSE | FLAG_READ)
+        telemetry_char = (telemetry_uuid, FLAG_READ | FLAG_NOTIFY)
+        services = [(service_uuid, [char, telemetry_char])]
 
         # Register services
         handles = self.ble.gatts_register_services(services)
-        print(f"Handles received: {handles}")  # Debug print
+        log.info("Handles received: %s", handles)
 
         # Extract integer handle values from the nested tuples
-        if handles and len(handles) > 0 and len(handles[0]) > 0:
-            self.service_handle = handles[0][0]  # Extract the integer
-            self.char_handle = 16  # We know this is the characteristic handle from debug output
-            print(f"Service Handle: {self.service_handle}")
-            print(f"Char Handle: {self.char_handle}")
+        # gatts_register_services returns the value handle of each characteristic
+        if handles and len(handles) > 0 and len(handles[0]) > 1:
+            self.char_handle = handles[0][0]
+            self.telemetry_handle = handles[0][1]
+            log.info("Char handle: %d, telemetry handle: %d", self.char_handle, self.telemetry_handle)
         else:
             raise ValueError("Failed to register services")
 
-    def turn_off(self):
-        for i in range(self.num_pixels):
-            self.np0[i] = (0,0,0)
-            self.np1[i] = (0,0,0)
-            self.np2[i] = (0,0,0)
-            self.np3[i] = (0,0,0)
-        self.np0.write()
-        self.np1.write()
-        self.np2.write()
-        self.np3.write()
+        # The default attribute buffer only holds 20 bytes
+        self.ble.gatts_set_buffer(self.char_handle, CHAR_BUFFER_SIZE)
 
-        print ("Color set to zero")
+    # Also the button-release path, so a running animation must not keep
+    # repainting the strips afterwards
+    def turn_off(self):
+        self.animator.stop()
+        self.stream_frame_id = -1
+        self.clear()
+        self.commit()
+
+        if DEBUG_BUILD:
+            log.debug("Color set to zero")
+
+    # The NeoPixel buffers are the off-screen frame: montages only draw into
+    # them, and nothing reaches the LEDs until commit() writes them out.
+    def clear(self):
+        for i in range(len(self.bufs)):
+            self.bufs[i][:] = self.blanks[i]
+
+    # Bytes held by buffers that grow with the strips: pixels, committed
+    # frames, blanks, animation frames, montage masks, the stream assembler
+    # and the output's own buffers
+    def strip_buffer_bytes(self):
+        total = len(self.stream.buf) + self.output.buffer_bytes()
+        for bufs in (self.bufs, self.shown, self.blanks, self.animator.start, self.animator.target,
+                     self.layers_seen, self.layers_shared):
+            for buf in bufs:
+                total += len(buf)
+        for mask in self.montage_masks[1:]:
+            for bits in mask:
+                total += len(bits)
+        return total
+
+    # Logs the free heap after setup, the bytes the strip buffers take, and
+    # an estimate of what sizing the per-pixel buffers to STRIP_LENGTHS
+    # saves over LEGACY_STRIP_PIXELS on every strip. Only the buffers that
+    # hold a fixed number of bytes per pixel are counted in the estimate; the
+    # masks and the stream buffer are left out.
+    def report_memory(self):
+        gc.collect()
+        pixels = 0
+        for strip in self.strips:
+            pixels += len(strip)
+        saved = 0
+        for bufs in (self.bufs, self.shown, self.blanks, self.animator.start, self.animator.target):
+            for buf in bufs:
+                saved += LEGACY_STRIP_PIXELS * montages.BYTES_PER_PIXEL - len(buf)
+        output = self.output.buffer_bytes()
+        saved += output * LEGACY_STRIP_PIXELS * len(self.strips) // pixels - output
+        log.info("Heap: %d bytes free, %d allocated", gc.mem_free(), gc.mem_alloc())
+        log.info("Strip buffers: %d bytes for %d LEDs", self.strip_buffer_bytes(), pixels)
+        log.info("Per-pixel buffers: about %d bytes less than at %d LEDs per strip (estimate)",
+                 saved, LEGACY_STRIP_PIXELS)
+        log.info("Frame cache: %d bytes, %d full frames", self.FRAME_CACHE_BYTES,
+                 self.FRAME_CACHE_BYTES // (pixels * montages.BYTES_PER_PIXEL))
+
+    # Writes only the strips whose pixels changed since the last commit, all
+    # in one call to the output backend. The write time is kept for the
+    # command's telemetry report; animation frames commit with record=False
+    # so they never replace it.
+    def commit(self, record=True):
+        changed = 0
+        for i in range(len(self.strips)):
+            if self.bufs[i] != self.shown[i]:
+                changed |= 1 << i
+        if not changed:
+            return
+        started = time.ticks_us()
+        self.output.write(changed)
+        if record:
+            self.write_us = time.ticks_diff(time.ticks_us(), started)
+        for i in range(len(self.strips)):
+            if changed & (1 << i):
+                self.shown[i][:] = self.bufs[i]
 
 
     def ble_callback(self, event, data):
         if event == 1:  # Connect
-            print("Device connected")
+            log.info("Device connected")
             self.connected = True
+            self.conn_handle = data[0]
 
         elif event == 2:  # Disconnect
-            print("Device disconnected")
+            log.info("Device disconnected")
             self.connected = False
+            self.conn_handle = None
+            self.mtu = 23
+            self.last_seq = -1
             self.start_advertising()
 
+        elif event == 21:  # MTU exchanged
+            conn_handle, mtu = data
+            self.mtu = mtu
+            log.info("MTU exchanged: %d", mtu)
+
         elif event == 3:  # Write
             handle, value = data
 
 
-            print(f"Write event - handle: {handle}, value: {value}")
-            # Read the value using the characteristic handle
+            # Read the value using the characteristic handle and leave the
+            # rest to the event task
             buffer = self.ble.gatts_read(self.char_handle)
-            command = buffer.decode()
-            print(f"Raw buffer received: {buffer}")
-            print(f"Decoded command: {command}")
-            self.process_command(command)
-
-
-    def bipolar(self, r, g, b):
-
-
-        #np0 = 192  total LEDs
-        #np1 = 69  total  LEDs
-        #np2 = 79  total  LEDs
-        #np3 = 159  total LEDs
-        self.set_color(r, g, b, 1, self.np3, 48)
-        self.set_color(r, g, b, 1, self.np3, 31)
-        self.set_color(r, g, b, 1, self.np3, 11)
-        self.set_color(r, g, b, 1, self.np3, 70)
-        self.set_color(r, g, b, 1, self.np3, 63)
-        self.set_color(r, g, b, 1, self.np3, 76)
-        self.set_color(r, g, b, 1, self.np3, 40)
-        self.set_color(r, g, b, 3, self.np3, 84, 112) # right side of bipolar
-        self.set_color(r, g, b, 3, self.np3, 116, 141)# left side of bipolar
-        self.set_color(r, g, b, 3, self.np3, 145, 159)
-        self.set_color(r, g, b, 2, self.np0, 62) # bottom of the brain
-
-
-        self.np0.write()
-        self.np2.write()
-        self.np3.write()
-        print("Bipolar montage set to color:", (r, g, b))
-
-
-    def transverse(self, r, g, b):
-
-        # bottom
-        self.set_color(r, g, b, 3, self.np0, 176, 186)
-        self.set_color(r, g, b, 3, self.np0, 111, 116)
-        self.set_color(r, g, b, 3, self.np0, 116, 120)
-        self.set_color(r, g, b, 3, self.np0, 120, 135)
-        self.set_color(r, g, b, 3, self.np0, 138, 143)
-        self.set_color(r, g, b, 1, self.np0, 80)
-        self.set_color(r, g, b, 3, self.np0, 82, 89)
-        self.set_color(r, g, b, 3, self.np0, 150, 156)
-        self.set_color(r, g, b, 1, self.np0, 159)
-        self.set_color(r, g, b, 1, self.np0, 106)
-        self.set_color(r, g, b, 1, self.np0, 12)
-        self.set_color(r, g, b, 1, self.np0, 6)
-        self.set_color(r, g, b, 1, self.np0, 19)
-        self.set_color(r, g, b, 1, self.np0, 0)
-        self.set_color(r, g, b, 1, self.np0, 67)
-        self.set_color(r, g, b, 1, self.np0, 43)
-        self.set_color(r, g, b, 1, self.np0, 35)
-        self.set_color(r, g, b, 1, self.np0, 48)
-        self.set_color(r, g, b, 3, self.np0, 160, 167)
-
-
-        # top
-        self.set_color(r, g, b, 2, self.np3, 83)
-        self.set_color(r, g, b, 1, self.np3, 112)
-        self.set_color(r, g, b, 1, self.np3, 116)
-        self.np0.write()
-        self.np3.write()
-        print("Transverse montage set to color:", (r, g, b))
-
-
-        self.np0.write()
-        self.np2.write()
-        self.np3.write()
-        self.np1.write()
-        print("Transverse montage set to color:", (r, g, b))
-
-    def hatband(self, r, g, b):
-        self.set_color(r, g, b, 1, self.np3, 48)
-        self.set_color(r, g, b, 1, self.np3, 31)
-        self.set_color(r, g, b, 1, self.np3, 63)
-        self.set_color(r, g, b, 1, self.np3, 76)
-        self.set_color(r, g, b, 3, self.np3, 84, 145) #
-        self.set_color(r, g, b, 2, self.np0, 55) # bottom of the brain
-
-
-        self.np2.write()
-        self.np3.write()
-        self.np0.write()
-        self.np1.write()
-        print("Hatband montage set to color:", (r, g, b))
-
-    def temporal(self, r, g, b):
-
-        # top of temporal pole
-        self.set_color(r, g, b, 1, self.np3, 48)
-        self.set_color(r, g, b, 1, self.np3, 31)
-        self.set_color(r, g, b, 1, self.np3, 63)
-        self.set_color(r, g, b, 1, self.np3, 76)
-        self.set_color(r, g, b, 3, self.np3, 92, 112)
-        self.set_color(r, g, b, 3, self.np3, 116, 134)
-
-        # bottom of temporal pole
-        self.set_color(r, g, b, 3, self.np0, 89, 107)
-        self.set_color(r, g, b, 3, self.np0, 70, 82)
-        self.set_color(r, g, b, 3, self.np0, 62, 70)
-        self.set_color(r, g, b, 3, self.np0, 107, 111)
-        self.set_color(r, g, b, 2, self.np0, 7)
-        self.set_color(r, g, b, 3, self.np0, 13, 26)
-        self.set_color(r, g, b, 3, self.np0, 143, 147)
-        self.set_color(r, g, b, 3, self.np0, 26, 43)
-        self.set_color(r, g, b, 3, self.np0, 156, 159)
-        self.set_color(r, g, b, 1, self.np0, 176)
-        self.set_color(r, g, b, 3, self.np0, 48, 55)
-
-        self.np2.write()
-        self.np3.write()
-        self.np0.write()
-        self.np1.write()
-        print("Temporal Pole montage set to color:", (r, g, b))
-
-    def cz_ref(self, r, g, b):
-        #top of brain
-        self.set_color(r, g, b, 2, self.np2, 81)
-        self.set_color(r, g, b, 3, self.np3, 23, 56)
-        self.set_color(r, g, b, 1, self.np1, 10)
-        self.set_color(r, g, b, 1, self.np1, 15)
-        self.set_color(r, g, b, 1, self.np1, 5)
-        self.set_color(r, g, b, 1, self.np3, 124)
-        self.set_color(r, g, b, 1, self.np3, 129)
-        self.set_color(r, g, b, 3, self.np3, 77, 83)
-        self.set_color(r, g, b, 3, self.np1, 41, 69)
-        self.set_color(r, g, b, 1, self.np3, 115)
-        self.set_color(r, g, b, 1, self.np3, 111)
-        self.set_color(r, g, b, 1, self.np1, 39)
-        self.set_color(r, g, b, 1, self.np3, 93)
-        self.set_color(r, g, b, 1, self.np1, 30)
-        self.set_color(r, g, b, 1, self.np3, 102)
-        self.set_color(r, g, b, 1, self.np1, 25)
-
-
-
-        #bottom of brain
-
-        self.set_color(r, g, b, 1, self.np0, 192)
-        self.set_color(r, g, b, 1, self.np0, 10)
-        self.set_color(r, g, b, 1, self.np0, 12)
-        self.set_color(r, g, b, 1, self.np0, 19)
-
-        self.set_color(r, g, b, 1, self.np0, 6)
-        self.set_color(r, g, b, 1, self.np0, 106)
-        self.set_color(r, g, b, 1, self.np0, 189)
-        self.set_color(r, g, b, 1, self.np0, 16)
-        self.set_color(r, g, b, 1, self.np0, 81)
-
-        self.set_color(r, g, b, 1, self.np0, 37)
-        self.set_color(r, g, b, 1, self.np0, 35)
-        self.set_color(r, g, b, 1, self.np0, 43)
-        self.set_color(r, g, b, 1, self.np0, 48)
-        self.set_color(r, g, b, 1, self.np0, 137)
-        self.set_color(r, g, b, 1, self.np0, 89)
-
-
-
-        self.np0.write()
-        self.np1.write()
-        self.np2.write()
-        self.np3.write()
-        print("Cz Referential montage set to color:", (r, g, b))
-
-    def ear_ref(self, r, g, b):
-        self.set_color(r, g, b, 2, 50)
-
-
-
-        #top
-        self.set_color(r, g, b, 3, self.np3, 0, 7)   # f3
-        self.set_color(r, g, b, 3, self.np3, 12, 40) # fz
-        self.set_color(r, g, b, 3, self.np3, 50, 55) # c3
-        self.set_color(r, g, b, 3, self.np3, 56, 70) # pz
-        self.set_color(r, g, b, 3, self.np3, 77, 82) # p3
-        self.set_color(r, g, b, 1, self.np1, 26)
-
-        #bottom
-        self.set_color(r, g, b, 3, self.np0, 62, 66)
-        self.set_color(r, g, b, 1, self.np0, 6)
-
-
-        self.set_color(r, g, b, 3, self.np0, 111, 116)
-        self.set_color(r, g, b, 1, self.np0, 13)
-
-
-        self.set_color(r, g, b, 1, self.np0, 190)
-        self.set_color(r, g, b, 1, self.np0, 19)
-
-
-        self.set_color(r, g, b, 3, self.np0, 150, 158)
-
-
-        self.set_color(r, g, b, 3, self.np0, 138, 143)
-        self.set_color(r, g, b, 3, self.np0, 157, 160)
-
-        self.set_color(r, g, b, 1, self.np0, 36)
-        self.set_color(r, g, b, 1, self.np0, 136)
-        self.set_color(r, g, b, 1, self.np0, 89)
-        self.set_color(r, g, b, 1, self.np0, 67)
-        self.set_color(r, g, b, 1, self.np0, 49)
-        self.set_color(r, g, b, 1, self.np0, 43)
-        self.set_color(r, g, b, 3, self.np0, 82, 89)
-        self.set_color(r, g, b, 1, self.np0, 80)
-
-        self.set_color(r, g, b, 3, self.np0, 116, 135)
-        self.set_color(r, g, b, 3, self.np0, 160, 186)
-
-
-        self.np0.write()
-        self.np1.write()
-        self.np2.write()
-        self.np3.write()
-        print("Ear Referential montage set to color:", (r, g, b))
-
-    def large(self, r, g, b):
-        self.set_color(r, g, b, 1, self.np3, 48)
-        self.set_color(r, g, b, 1, self.np3, 31)
-        self.set_color(r, g, b, 1, self.np3, 11)
-        self.set_color(r, g, b, 1, self.np3, 70)
-        self.set_color(r, g, b, 1, self.np3, 63)
-        self.set_color(r, g, b, 1, self.np3, 76)
-        self.set_color(r, g, b, 1, self.np3, 40)
-        self.set_color(r, g, b, 3, self.np3, 84, 112) # right side of bipolar
-        self.set_color(r, g, b, 3, self.np3, 116, 141)# left side of bipolar
-        self.set_color(r, g, b, 3, self.np3, 145, 159)
-        self.set_color(r, g, b, 2, self.np0, 55) # bottom of the brain
-
-
-        self.np0.write()
-        self.np2.write()
-        self.np3.write()
-        print("Large baby montage set to color:" (r, g, b))
-
-    def small(self, r, g, b):
-
-        # TOP
-
-        self.set_color(r, g, b, 3, self.np3, 23, 56)
-        self.set_color(r, g, b, 3, self.np3, 84, 112) # right side of top
-        self.set_color(r, g, b, 3, self.np3, 116, 141) # left side of top
-        self.set_color(r, g, b, 3, self.np1, 41, 69)
-
-
-        # BOTTOM
-
-        #right side connections from tp9 to top
-
-        self.set_color(r, g, b, 3, self.np0, 0, 27)
-        self.set_color(r, g, b, 1, self.np0, 106)
-        self.set_color(r, g, b, 1, self.np0, 12)
-        self.set_color(r, g, b, 3, self.np0, 111, 116)
-        self.set_color(r, g, b, 1, self.np3, 63)
-
-        #left side connections from tp10 to top
-
-        self.set_color(r, g, b, 1, self.np0, 89)
-        self.set_color(r, g, b, 3, self.np0, 138, 143)
-        self.set_color(r, g, b, 3, self.np0, 27, 55)
-        self.set_color(r, g, b, 1, self.np3, 76)
-
-
-        # ROC and LOC to top
-        self.set_color(r, g, b, 3, self.np0, 168, 176)
-
-
-
-
-
-
-        self.np0.write()
-        self.np1.write()
-        self.np2.write()
-        self.np3.write()
-        print("Small baby montage set to color:" (r, g, b))
-
-    def eci(self, r, g, b):
-
-        # Top
-        self.set_color(r, g, b, 2, self.np3, 112)
-        self.set_color(r, g, b, 3, self.np3, 116, 140)
-        self.set_color(r, g, b, 3, self.np1, 10, 20)
-        self.set_color(r, g, b, 3, self.np1, 30, 41)
-
-
-
-        # BOTTOM
-        self.set_color(r, g, b, 3, self.np0, 89, 107)
-        self.set_color(r, g, b, 3, self.np0, 0, 26)
-        self.set_color(r, g, b, 3, self.np0, 26, 55)
-
-
-
-
-
-        self.np3.write()
-        self.np1.write()
-        self.np2.write()
-        self.np0.write()
-        print("ECI montage set to color:" (r, g, b))
+            if len(buffer) >= 2 and buffer[0] == PROTOCOL_HEADER and buffer[1] == OP_FRAME_CHUNK:
+                self.events.put(EVENT_CHUNK, buffer)
+            else:
+                self.events.put(EVENT_COMMAND, buffer)
 
 
-    def process_command(self, command):
+    # Handles one characteristic write, either a binary frame or a text command
+    def process_command(self, buffer):
+        started = time.ticks_us()
+        self.write_us = 0
         try:
-            print("Received command:", command)
-
-            # Split the command into parts
-            parts = command.split()  # Expects "montage color"
-            if len(parts) < 2:
-                print("Invalid command format. Expected: 'montage color'")
+            if len(buffer) < 2 or buffer[0] != PROTOCOL_HEADER:
+                self.process_text_command(buffer.decode())
+                self.report_command(0, 0, started, started)
                 return
 
-            montage_name = parts[0].lower()  # First part is the montage name
-            color_name = parts[1].lower()    # Second part is the color
-
-            # Define RGB color mappings
-            color_map = {
-                "red": (75, 0, 0),
-                "blue": (0, 0, 75),
-                "green": (0, 75, 0),
-                "yellow": (75, 75, 0),
-                "white": (75, 75, 75),
-                "purple": (70, 0, 70),
-                "orange": (76, 85, 0),
-            }
-
-            # Check if the color exists
-            if color_name not in color_map:
-                print(f"Unknown color: {color_name}")
+            # Decode the frame in place; nothing here allocates
+            opcode = buffer[1]
+            if opcode == OP_FRAME_CHUNK:
+                self.animator.stop()
+                if len(buffer) >= framestream.CHUNK_HEADER_LEN and self.stream.add_chunk(buffer):
+                    decoded = time.ticks_us()
+                    self.show_stream_frame()
+                    self.report_command(opcode, self.stream.frame_id, started, decoded)
                 return
 
-            r, g, b = color_map[color_name]  # Get RGB values
-
-            # Call the appropriate function with the selected color
-
-            # check to see if this function causes delays or issues with accurate propagation
-            self.turn_off()
+            if len(buffer) < FRAME_LEN:
+                log.warn("Short command frame: %d bytes", len(buffer))
+                return
 
-            if montage_name == "bipolar":
-                self.bipolar(r, g, b)
-            elif montage_name == "transverse":
-                self.transverse(r, g, b)
-            elif montage_name == "hatband":
-                self.hatband(r, g, b)
-            elif montage_name == "temporal":
-                self.temporal(r, g, b)
-            elif montage_name == "cz_ref":
-                self.cz_ref(r, g, b)
-            elif montage_name == "ear_ref":
-                self.ear_ref(r, g, b)
-            elif montage_name == "large":
-                self.large(r, g, b)
-            elif montage_name == "small":
-                self.small(r, g, b)
-            elif montage_name == "eci":
-                self.eci(r, g, b)
-            elif montage_name == "off":
+            seq = buffer[7] | (buffer[8] << 8)
+            if self.last_seq >= 0:
+                delta = (seq - self.last_seq) & 0xFFFF
+                if delta == 0 or delta >= 0x8000:
+                    # Duplicate or older than a command already shown
+                    self.stale_commands += 1
+                    return
+            self.last_seq = seq
+            decoded = time.ticks_us()
+
+            if opcode == OP_SET_MONTAGE or opcode == OP_ANIMATE or opcode == OP_LAYERS:
+                brightness = buffer[6]
+                r = buffer[3] * brightness // 255
+                g = buffer[4] * brightness // 255
+                b = buffer[5] * brightness // 255
+                if DEBUG_BUILD:
+                    log.debug("Frame seq %d: op %d montage %d RGB(%d, %d, %d)", seq, opcode, buffer[2], r, g, b)
+                if opcode == OP_SET_MONTAGE:
+                    self.animator.stop()
+                    self.show_montage(buffer[2], r, g, b)
+                elif opcode == OP_LAYERS:
+                    if buffer[2] > MAX_LAYERS or len(buffer) < FRAME_LEN + buffer[2] * LAYER_LEN:
+                        log.warn("Bad layers frame: %d layers in %d bytes", buffer[2], len(buffer))
+                        return
+                    self.animator.stop()
+                    self.show_layers(buffer, r, g, b)
+                elif len(buffer) >= ANIMATE_FRAME_LEN:
+                    self.animate(buffer[9], buffer[2], r, g, b, buffer[10] | (buffer[11] << 8))
+                else:
+                    log.warn("Short animate frame: %d bytes", len(buffer))
+            elif opcode == OP_OFF:
                 self.turn_off()
             else:
-                print(f"Unknown montage: {montage_name}")
+                log.warn("Unknown opcode: %d", opcode)
+                return
+            self.report_command(opcode, seq, started, decoded)
 
         except Exception as commandError:
-            print(f"Error in command processing: {commandError}")
-
-
-    def set_color(self, r, g, b, controlVariable, dataline, LED_ID = 0, LED_ID2 = 0):
-        print(f"Setting LED {LED_ID} to RGB({r}, {g}, {b}) with controlVariable {controlVariable}")
-
-        #for individual LEDs
-        if controlVariable == 1:
-            dataline[LED_ID] = (r, g, b)
-
-
-        # for range from 0
-        elif controlVariable == 2:
-            print(f"made it to control var")
-
-            for i in range(LED_ID):
-                dataline[i] = (r, g, b)
-            print(f"Color set to RGB({r}, {g}, {b})")
-
-
-        # for ranges not from 0
-        elif controlVariable == 3:
-            print(f"made it to c-var 3")
-            for i in range(LED_ID, LED_ID2):
-                dataline[i] = (r, g, b)
-
-
+            log.error("Error in command processing: %s", commandError)
+
+    # Records how long the command that started at `started` took: decoding
+    # until `decoded`, then rendering, minus the strip write commit() timed
+    def report_command(self, opcode, seq, started, decoded):
+        self.last_opcode = opcode
+        self.last_command_seq = seq
+        self.decode_us = time.ticks_diff(decoded, started)
+        self.render_us = max(0, time.ticks_diff(time.ticks_us(), decoded) - self.write_us)
+        self.publish_telemetry()
+
+    # Updates the telemetry value and notifies the app. The value is only
+    # notified when it fits the negotiated MTU; it can always be read.
+    def publish_telemetry(self):
+        now = time.ticks_ms()
+        self.uptime_ms += time.ticks_diff(now, self.uptime_mark)
+        self.uptime_mark = now
+        events = self.events
+        struct.pack_into(TELEMETRY_FORMAT, self.telemetry, 0, TELEMETRY_VERSION,
+                         self.last_opcode, self.last_command_seq,
+                         self.decode_us, self.render_us, self.write_us, gc.mem_free(),
+                         events.dropped & 0xFFFF, events.coalesced & 0xFFFF,
+                         self.stale_commands & 0xFFFF, self.stream.dropped & 0xFFFF,
+                         self.uptime_ms & 0xFFFFFFFF)
+        self.ble.gatts_write(self.telemetry_handle, self.telemetry)
+        if self.conn_handle is not None and self.mtu - 3 >= TELEMETRY_LEN:
+            try:
+                self.ble.gatts_notify(self.conn_handle, self.telemetry_handle)
+            except OSError as e:
+                log.warn("Telemetry notify failed: %s", e)
+
+    # Keeps heap and uptime figures fresh between commands
+    async def telemetry_task(self):
+        while True:
+            await asyncio.sleep_ms(TELEMETRY_INTERVAL_MS)
+            if self.connected:
+                self.publish_telemetry()
+
+    # Fallback for the original "montage color" text format
+    def process_text_command(self, command):
+        if DEBUG_BUILD:
+            log.debug("Received command: %s", command)
+
+        # Split the command into parts
+        parts = command.split()  # Expects "montage color"
+        if len(parts) < 2:
+            log.warn("Invalid command format. Expected: 'montage color'")
+            return
+
+        montage_name = parts[0].lower()  # First part is the montage name
+        color_name = parts[1].lower()    # Second part is the color
+
+        # Check if the color exists
+        if color_name not in COLOR_MAP:
+            log.warn("Unknown color: %s", color_name)
+            return
+
+        montage_id = self.montage_ids.get(montage_name)
+        if montage_id is None:
+            log.warn("Unknown montage: %s", montage_name)
+            return
+
+        r, g, b = COLOR_MAP[color_name]  # Get RGB values
+        self.animator.stop()
+        self.show_montage(montage_id, r, g, b)
+
+    # Starts one of the animator effects on a montage
+    def animate(self, effect, montage_id, r, g, b, period_ms):
+        if effect == animator.EFFECT_CROSSFADE:
+            self.animator.crossfade(montage_id, r, g, b, period_ms)
+        elif effect == animator.EFFECT_PULSE:
+            self.animator.pulse(montage_id, r, g, b, period_ms)
+        elif effect == animator.EFFECT_PROPAGATE:
+            self.animator.propagate(montage_id, r, g, b, period_ms)
+        else:
+            log.warn("Unknown effect: %d", effect)
+
+    # Puts a fully received stream frame on the strips
+    def show_stream_frame(self):
+        data = self.stream.buf
+        length = self.stream.length
+        if length < 2:
+            return
+        if data[0] & framestream.FLAG_KEYFRAME:
+            self.clear()
+        elif data[1] != self.stream_frame_id:
+            # Delta against a frame that is not on the strips; wait for a keyframe
+            self.stream.dropped += 1
+            return
+
+        if not framestream.decode(data, length, self.bufs):
+            log.warn("Malformed stream frame %d", self.stream.frame_id)
+            self.stream_frame_id = -1
+            return
+        self.stream_frame_id = self.stream.frame_id
+        self.commit()
+
+        self.stream_frames += 1
+        self.stream_bytes += length
+        now = time.ticks_ms()
+        if self.stream_window_frames == 0:
+            self.stream_window_start = now
+        self.stream_window_frames += 1
+        self.stream_window_bytes += length
+        if self.stream_window_frames >= STREAM_REPORT_INTERVAL:
+            elapsed = max(1, time.ticks_diff(now, self.stream_window_start))
+            log.info("Stream: %d fps, %d bytes/frame, %d frames dropped",
+                     (self.stream_window_frames - 1) * 1000 // elapsed,
+                     self.stream_window_bytes // self.stream_window_frames,
+                     self.stream.dropped)
+            self.stream_window_frames = 0
+            self.stream_window_bytes = 0
+
+    # Puts a montage on the strips, rendering it only if it is not cached
+    def show_montage(self, montage_id, r, g, b):
+        if montage_id == 0:
+            self.turn_off()
+            return
+
+        # Compose the montage off-screen, then write the changed strips in one pass
+        if self.compose_montage(montage_id, r, g, b):
+            self.commit()
+            if DEBUG_BUILD:
+                log.debug("%s montage set to color: (%d, %d, %d)", self.montage_names[montage_id], r, g, b)
+
+    # Fills the off-screen frame with a montage, from the frame cache when it
+    # can. Returns False for an unknown montage id.
+    def compose_montage(self, montage_id, r, g, b):
+        if montage_id == 0 or montage_id >= len(self.montage_spans):
+            log.warn("Unknown montage id: %d", montage_id)
+            return False
+        self.stream_frame_id = -1
+
+        # Repeat commands are served from the frame cache
+        key = (montage_id << 24) | (r << 16) | (g << 8) | b
+        frame = self.frame_cache.get(key)
+        if frame is not None:
+            self.load_frame(frame)
+            if DEBUG_BUILD:
+                log.debug("%s served from frame cache", self.montage_names[montage_id])
+            return True
+
+        self.clear()
+        self.render(montage_id, r, g, b)
+        self.frame_cache.put(key, self.capture_frame())
+        return True
+
+    # Puts the layers of an OP_LAYERS frame on the strips, each in its own
+    # color, with the LEDs they share in (r, g, b) unless that is black.
+    # Repeats are served from the frame cache like single montages.
+    def show_layers(self, buffer, r, g, b):
+        self.stream_frame_id = -1
+        count = buffer[2]
+        end = FRAME_LEN + count * LAYER_LEN
+        key = buffer[2:7] + buffer[FRAME_LEN:end]
+        frame = self.frame_cache.get(key)
+        if frame is not None:
+            self.load_frame(frame)
+            self.commit()
+            return
+
+        # Insertion sort by priority keeps equal priorities in frame order
+        order = self.layer_order
+        for n in range(count):
+            priority = buffer[FRAME_LEN + n * LAYER_LEN + 4]
+            k = n
+            while k > 0 and buffer[FRAME_LEN + order[k - 1] * LAYER_LEN + 4] > priority:
+                order[k] = order[k - 1]
+                k -= 1
+            order[k] = n
+
+        self.clear()
+        highlight = r or g or b
+        if highlight:
+            montages.mask_clear(self.layers_seen)
+            montages.mask_clear(self.layers_shared)
+        brightness = buffer[6]
+        for n in range(count):
+            at = FRAME_LEN + order[n] * LAYER_LEN
+            montage_id = buffer[at]
+            if montage_id == 0 or montage_id >= len(self.montage_spans):
+                log.warn("Unknown montage id in layer: %d", montage_id)
+                continue
+            self.render(montage_id, buffer[at + 1] * brightness // 255,
+                        buffer[at + 2] * brightness // 255, buffer[at + 3] * brightness // 255)
+            if highlight:
+                montages.mask_add(self.montage_masks[montage_id], self.layers_seen, self.layers_shared)
+        if highlight:
+            self.render_mask(self.layers_shared, r, g, b)
+            if DEBUG_BUILD:
+                log.debug("%d layers, %d LEDs shared", count, montages.mask_count(self.layers_shared))
+        self.frame_cache.put(key, self.capture_frame())
+        self.commit()
+        if DEBUG_BUILD:
+            log.debug("%d montages layered", count)
+
+    # Draws a montage into the off-screen frame by walking its span table of
+    # (strip, start byte, end byte) triples. Pixels are stored GRB.
+    @micropython.native
+    def render(self, montage_id, r, g, b):
+        spans = self.montage_spans[montage_id]
+        strips = self.strips
+        for k in range(0, len(spans), 3):
+            buf = strips[spans[k]].buf
+            for i in range(spans[k + 1], spans[k + 2], 3):
+                buf[i] = g
+                buf[i + 1] = r
+                buf[i + 2] = b
+
+    # Draws every LED set in a mask, e.g. the LEDs layers share
+    @micropython.native
+    def render_mask(self, mask, r, g, b):
+        strips = self.strips
+        for s in range(len(mask)):
+            bits = mask[s]
+            buf = strips[s].buf
+            for k in range(len(bits)):
+                byte = bits[k]
+                i = k * 24
+                while byte:
+                    if byte & 1:
+                        buf[i] = g
+                        buf[i + 1] = r
+                        buf[i + 2] = b
+                    byte >>= 1
+                    i += 3
+
+    # Snapshots the pixel buffers of all strips as one frame
+    def capture_frame(self):
+        return tuple(bytes(strip.buf) for strip in self.strips)
+
+    # Copies a cached frame into the pixel buffers without writing them
+    def load_frame(self, frame):
+        for strip, data in zip(self.strips, frame):
+            strip.buf[:] = data
 
     def start_advertising(self):
         name = "ESP32_BLE"
         service_uuid = UUID("3322271e-756a-443d-8a9d-2f90c7a73bf5")
         payload = advertising_payload(name=name, services=[service_uuid])
-        self.ble.gap_advertise(100, adv_data=payload)
+        # The advertising packet is full, so the preferred connection
+        # interval range (AD type 0x12) goes in the scan response
+        response = bytearray((5, 0x12)) + struct.pack("<HH", CONN_INTERVAL_MIN, CONN_INTERVAL_MAX)
+        self.ble.gap_advertise(100, adv_data=payload, resp_data=response)
         self.ble.irq(self.ble_callback)
-        print("BLE is ready and advertising")
-
+        log.info("BLE is ready and advertising")
+
+
+
+# Runs the events queued by the IRQ handlers, oldest first, yielding to the
+# other tasks between events
+async def event_task(events):
+    while True:
+        await events.flag.wait()
+        while True:
+            kind, item = events.get()
+            if kind == EVENT_COMMAND or kind == EVENT_CHUNK:
+                if DEBUG_BUILD:
+                    log.debug("Command event, %d bytes: %s", len(item), item)
+                ble_peripheral.process_command(item)
+            elif kind == EVENT_BUTTON:
+                handle_button(item)
+            else:
+                break
+            await asyncio.sleep_ms(0)
 
 
 # Initialize the peripheral
-ble_peripheral = BLEPeripheral(525, 21, 22, 14, 32, 15, 33)
+ble_peripheral = BLEPeripheral(STRIP_LENGTHS, STRIP_PINS)
+ble_peripheral.report_memory()
 
 ButtonPin.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=SwitchHandler)
 
+async def main():
+    asyncio.create_task(ble_peripheral.telemetry_task())
+    await event_task(ble_peripheral.events)
 
 
-
-
-
-
+asyncio.run(main())
@@ -0,0 +1,207 @@
+# Timer-driven animations on the strips: crossfades, pulses and a signal
+# propagating along a montage
+#
+# A hardware timer fires every FRAME_MS and schedules step(), which draws
+# one frame straight into the NeoPixel buffers and commits it. Progress is
+# computed from the elapsed ticks, so an overrun frame makes the animation
+# skip ahead rather than slow down, and the BLE IRQ handler never waits for
+# more than one frame. All buffers are allocated up front and the per-frame
+# math is integer only, using the lookup tables below.
+
+import micropython
+from micropython import const
+from machine import Timer
+import time
+
+FRAME_MS = const(40)  # 25 fps; four bit-banged strips fit inside this budget
+TAIL_PIXELS = const(16)  # length of the bright front of a propagating signal
+TRAIL_LEVEL = const(40)  # brightness (of 255) left behind the front
+
+EFFECT_NONE = const(0)
+EFFECT_CROSSFADE = const(1)
+EFFECT_PULSE = const(2)
+EFFECT_PROPAGATE = const(3)
+
+
+def _build_tables():
+    # Perceptual brightness: gamma 2.2
+    gamma = bytearray(256)
+    for i in range(256):
+        gamma[i] = int(255 * (i / 255) ** 2.2 + 0.5)
+
+    # Smoothstep easing for crossfades, 0..255 over the fade
+    ease = bytearray(256)
+    for i in range(256):
+        t = i / 255
+        ease[i] = int(255 * t * t * (3 - 2 * t) + 0.5)
+
+    # One pulse period: brightness rises and falls like a sine, gamma corrected
+    pulse = bytearray(256)
+    for i in range(256):
+        t = i / 255
+        level = 4 * t * (1 - t)  # parabola close enough to a sine half-wave
+        pulse[i] = gamma[int(255 * level + 0.5)]
+
+    # Falloff behind the front of a propagating signal
+    tail = bytearray(TAIL_PIXELS)
+    for d in range(TAIL_PIXELS):
+        tail[d] = max(TRAIL_LEVEL, gamma[255 - d * 255 // TAIL_PIXELS])
+    return gamma, ease, pulse, tail
+
+
+GAMMA, EASE, PULSE, TAIL = _build_tables()
+
+
+class Animator:
+    def __init__(self, peripheral, timer_id=0):
+        self.peripheral = peripheral
+        self.bufs = peripheral.bufs
+        # Frame before a crossfade and the montage frame being animated
+        self.start = [bytearray(len(buf)) for buf in self.bufs]
+        self.target = [bytearray(len(buf)) for buf in self.bufs]
+        self.changed = bytearray(len(self.bufs))  # strips that differ between start and target
+        self.effect = EFFECT_NONE
+        self.spans = None
+        self.span_pixels = 0
+        self.r = 0
+        self.g = 0
+        self.b = 0
+        self.period = 1
+        self.started = 0
+        self.frames = 0
+        self.overruns = 0
+        self.timer = Timer(timer_id)
+        self.running = False
+        # Bound once: creating the bound method in the timer callback would allocate
+        self._step_ref = self.step
+
+    def running_effect(self):
+        return self.effect if self.running else EFFECT_NONE
+
+    # Fades from what is on the strips now to a montage
+    def crossfade(self, montage_id, r, g, b, duration_ms):
+        self.stop()
+        for buf, start in zip(self.bufs, self.start):
+            start[:] = buf
+        if not self._prepare(montage_id, r, g, b):
+            return
+        for i in range(len(self.bufs)):
+            self.changed[i] = self.start[i] != self.target[i]
+        self._run(EFFECT_CROSSFADE, duration_ms)
+
+    # Breathes the montage's brightness once per period
+    def pulse(self, montage_id, r, g, b, period_ms):
+        self.stop()
+        if self._prepare(montage_id, r, g, b):
+            self._run(EFFECT_PULSE, period_ms)
+
+    # Sends a bright front along the montage's spans, in file order, once per period
+    def propagate(self, montage_id, r, g, b, period_ms):
+        self.stop()
+        if not self._prepare(montage_id, r, g, b):
+            return
+        self.spans = self.peripheral.montage_spans[montage_id]
+        pixels = 0
+        for k in range(0, len(self.spans), 3):
+            pixels += (self.spans[k + 2] - self.spans[k + 1]) // 3
+        self.span_pixels = pixels
+        self._run(EFFECT_PROPAGATE, period_ms)
+
+    def stop(self):
+        if self.running:
+            self.timer.deinit()
+            self.running = False
+            self.effect = EFFECT_NONE
+
+    # Composes the montage once and keeps a copy as the animation target.
+    # The running effect must be stopped first: a step() already scheduled
+    # would otherwise draw over the composed frame.
+    def _prepare(self, montage_id, r, g, b):
+        if not self.peripheral.compose_montage(montage_id, r, g, b):
+            return False
+        for buf, target in zip(self.bufs, self.target):
+            target[:] = buf
+        self.spans = self.peripheral.montage_spans[montage_id]
+        self.r = r
+        self.g = g
+        self.b = b
+        return True
+
+    def _run(self, effect, period_ms):
+        self.stop()
+        self.effect = effect
+        self.period = max(FRAME_MS, period_ms)
+        self.started = time.ticks_ms()
+        self.frames = 0
+        self.running = True
+        self.timer.init(mode=Timer.PERIODIC, period=FRAME_MS, callback=self._on_timer)
+
+    def _on_timer(self, timer):
+        try:
+            micropython.schedule(self._step_ref, 0)
+        except RuntimeError:
+            self.overruns += 1  # schedule queue full: the previous frame is still pending
+
+    # Draws and commits one frame
+    def step(self, _):
+        if not self.running:
+            return
+        elapsed = time.ticks_diff(time.ticks_ms(), self.started)
+        effect = self.effect
+        if effect == EFFECT_CROSSFADE:
+            if elapsed >= self.period:
+                self._blend(256)
+                self.stop()
+            else:
+                self._blend(EASE[elapsed * 255 // self.period])
+        elif effect == EFFECT_PULSE:
+            self._scale(PULSE[(elapsed % self.period) * 255 // self.period])
+        elif effect == EFFECT_PROPAGATE:
+            self._propagate((elapsed % self.period) * (self.span_pixels + TAIL_PIXELS) // self.period)
+        self.frames += 1
+        self.peripheral.commit(False)
+
+    @micropython.native
+    def _blend(self, alpha):
+        for s in range(len(self.bufs)):
+            if not self.changed[s]:
+                continue
+            buf = self.bufs[s]
+            a = self.start[s]
+            b = self.target[s]
+            for i in range(len(buf)):
+                buf[i] = a[i] + (((b[i] - a[i]) * alpha) >> 8)
+
+    # Montage pixels at `level` of their color
+    @micropython.native
+    def _scale(self, level):
+        spans = self.spans
+        for k in range(0, len(spans), 3):
+            buf = self.bufs[spans[k]]
+            target = self.target[spans[k]]
+            for i in range(spans[k + 1], spans[k + 2]):
+                buf[i] = (target[i] * level) >> 8
+
+    # Pixels behind the front fade along TAIL down to TRAIL_LEVEL; pixels the
+    # signal has not reached yet stay dark
+    @micropython.native
+    def _propagate(self, head):
+        spans = self.spans
+        r = self.r
+        g = self.g
+        b = self.b
+        p = 0
+        for k in range(0, len(spans), 3):
+            buf = self.bufs[spans[k]]
+            for i in range(spans[k + 1], spans[k + 2], 3):
+                d = head - p
+                if d < 0:
+                    level = 0
+                elif d < TAIL_PIXELS:
+                    level = TAIL[d]
+                else:
+                    level = TRAIL_LEVEL
+                buf[i] = (g * level) >> 8
+                buf[i + 1] = (r * level) >> 8
+                buf[i + 2] = (b * level) >> 8
+                p += 1
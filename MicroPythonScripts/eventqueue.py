@@ -0,0 +1,128 @@
+# Bounded event queue between the IRQ handlers and the firmware's asyncio tasks
+#
+# IRQ handlers only put() the event and return; the event task in
+# ESP32_Script.py waits on `flag` and does the decoding, rendering, strip
+# writes and relay sequencing. put() does not allocate: the queue keeps
+# references in preallocated slots.
+#
+# Commands and button levels are latest-wins: a newer one replaces any older
+# one still waiting, so a burst of montage taps only renders the last. A
+# command also replaces waiting stream chunks, which it would paint over
+# anyway. Stream chunks are kept in order, and a chunk that finds the queue
+# full is dropped; the stream then waits for the next complete frame. A full
+# queue never loses a button level, see _make_room().
+#
+# Soft IRQ handlers run between bytecodes of the main thread, so put() can
+# never be interrupted by get() but get() can be interrupted by put(). Only
+# put() moves `tail` and only get() moves `head`; both run modulo twice the
+# capacity so a full queue can be told apart from an empty one.
+
+from micropython import const
+import uasyncio as asyncio
+
+EVENT_NONE = const(0)  # empty slot, or an event replaced by a newer one
+EVENT_COMMAND = const(1)  # montage, off, animate or text command
+EVENT_CHUNK = const(2)  # frame stream chunk
+EVENT_BUTTON = const(3)  # button level
+
+
+class EventQueue:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.kinds = bytearray(capacity)
+        self.items = [None] * capacity
+        self.head = 0  # next slot get() reads
+        self.tail = 0  # next slot put() writes
+        self.dropped = 0  # events lost to a full queue
+        self.coalesced = 0  # events replaced by a newer one
+        self.flag = asyncio.ThreadSafeFlag()
+
+    def count(self):
+        return (self.tail - self.head) % (2 * self.capacity)
+
+    # Called from IRQ handlers
+    def put(self, kind, item):
+        kinds = self.kinds
+        capacity = self.capacity
+        count = self.count()
+        if kind != EVENT_CHUNK:
+            for n in range(count):
+                i = (self.head + n) % capacity
+                old = kinds[i]
+                if old == kind or (kind == EVENT_COMMAND and old == EVENT_CHUNK):
+                    kinds[i] = EVENT_NONE
+                    self.items[i] = None
+                    self.coalesced += 1
+
+        if count == capacity:
+            if kind == EVENT_CHUNK:
+                self.dropped += 1
+                return
+            i = self._make_room(kind)
+            if i < 0:
+                self.dropped += 1
+                return
+        else:
+            i = self.tail % capacity
+            self.tail = (self.tail + 1) % (2 * capacity)
+        self.items[i] = item
+        kinds[i] = kind
+        self.flag.set()
+
+    # Frees the newest slot of a full queue for a latest-wins event and
+    # returns it, or -1 if the event has to be dropped. The events after the
+    # newest replaced slot move back by one, so the order is kept. With no
+    # replaced slot, a button level still gets in by dropping the oldest
+    # command or chunk; a button level is never dropped. The head slot is
+    # left alone, as get() may be reading it.
+    def _make_room(self, kind):
+        kinds = self.kinds
+        items = self.items
+        capacity = self.capacity
+        head = self.head
+        hole = -1
+        for n in range(capacity - 1, 0, -1):
+            if kinds[(head + n) % capacity] == EVENT_NONE:
+                hole = n
+                break
+        if hole < 0 and kind == EVENT_BUTTON:
+            for n in range(1, capacity):
+                i = (head + n) % capacity
+                if kinds[i] != EVENT_BUTTON:
+                    kinds[i] = EVENT_NONE
+                    items[i] = None
+                    self.dropped += 1
+                    hole = n
+                    break
+        if hole < 0:
+            return -1
+        for n in range(hole, capacity - 1):
+            i = (head + n) % capacity
+            j = (i + 1) % capacity
+            kinds[i] = kinds[j]
+            items[i] = items[j]
+        return (head + capacity - 1) % capacity
+
+    # Takes the oldest waiting event: returns (kind, item), or
+    # (EVENT_NONE, None) when the queue is empty
+    def get(self):
+        kinds = self.kinds
+        capacity = self.capacity
+        while self.head != self.tail:
+            i = self.head % capacity
+            kind = kinds[i]
+            item = self.items[i]
+            kinds[i] = EVENT_NONE
+            self.items[i] = None
+            self.head = (self.head + 1) % (2 * capacity)
+            if kind != EVENT_NONE and item is not None:
+                return kind, item
+        return EVENT_NONE, None
+
+    # Events waiting, not counting replaced ones
+    def pending(self):
+        n = 0
+        for k in range(self.count()):
+            if self.kinds[(self.head + k) % self.capacity] != EVENT_NONE:
+                n += 1
+        return n
@@ -0,0 +1,138 @@
+# Raw frame streaming: chunk reassembly and delta/RLE frame decoding
+#
+# The app (streaming.py) sends whole-model frames split over several writes
+# of the command characteristic. Each chunk is
+#
+#   byte 0     PROTOCOL_HEADER
+#   byte 1     OP_FRAME_CHUNK
+#   byte 2     frame id (uint8, wraps)
+#   byte 3     chunk index
+#   byte 4     chunk count
+#   bytes 5..  next piece of the frame payload
+#
+# and the reassembled payload is
+#
+#   byte 0     flags (FLAG_KEYFRAME: start from a black frame)
+#   byte 1     id of the frame this one is a delta against
+#   then, for every strip that changed, the strip index followed by ops:
+#     00nnnnnn              skip n+1 unchanged pixels
+#     01nnnnnn g r b        n+1 pixels of one color
+#     10nnnnnn (g r b)*     n+1 literal pixels
+#     11111111              end of this strip
+#
+# Pixels are sent in NeoPixel buffer (GRB) order so they can be copied as is.
+
+import micropython
+from micropython import const
+
+CHUNK_HEADER_LEN = const(5)
+FLAG_KEYFRAME = const(0x01)
+
+OP_SKIP = const(0x00)
+OP_RUN = const(0x40)
+OP_LITERAL = const(0x80)
+OP_END = const(0xFF)
+
+
+# Worst case payload for the given strip lengths: every pixel sent as a
+# literal, plus the op and strip bytes
+def max_payload_len(strip_lengths):
+    size = 2
+    for n in strip_lengths:
+        size += 2 + n * 3 + (n + 63) // 64
+    return size
+
+
+# Collects the chunks of one frame into a preallocated buffer. A chunk that
+# arrives out of order drops the frame; the next chunk 0 starts over.
+class FrameAssembler:
+    def __init__(self, capacity):
+        self.buf = bytearray(capacity)
+        self.length = 0
+        self.frame_id = -1
+        self.next_chunk = -1  # -1: waiting for the first chunk of a frame
+        self.dropped = 0
+
+    # Returns True once the last chunk of a frame has been added
+    def add_chunk(self, chunk):
+        frame_id = chunk[2]
+        index = chunk[3]
+        count = chunk[4]
+        if index == 0:
+            if self.next_chunk > 0:
+                self.dropped += 1  # the previous frame never completed
+            self.frame_id = frame_id
+            self.length = 0
+            self.next_chunk = 0
+        elif frame_id != self.frame_id or index != self.next_chunk:
+            if self.next_chunk > 0:
+                self.dropped += 1
+            self.next_chunk = -1
+            return False
+
+        n = len(chunk) - CHUNK_HEADER_LEN
+        if self.length + n > len(self.buf):
+            self.dropped += 1
+            self.next_chunk = -1
+            return False
+        buf = self.buf
+        start = self.length
+        for i in range(n):
+            buf[start + i] = chunk[CHUNK_HEADER_LEN + i]
+        self.length += n
+
+        self.next_chunk = index + 1
+        if self.next_chunk < count:
+            return False
+        self.next_chunk = -1
+        return True
+
+
+# Applies the strip records of a reassembled payload to the pixel buffers.
+# Returns False if the payload is malformed; the buffers may then be partly
+# updated and the caller should wait for a keyframe.
+@micropython.native
+def decode(data, length, bufs):
+    pos = 2
+    while pos < length:
+        strip = data[pos]
+        pos += 1
+        if strip >= len(bufs):
+            return False
+        buf = bufs[strip]
+        end = len(buf)
+        px = 0
+        while True:
+            if pos >= length:
+                return False
+            op = data[pos]
+            pos += 1
+            if op == OP_END:
+                break
+            n = ((op & 0x3F) + 1) * 3
+            if px + n > end:
+                return False
+            kind = op & 0xC0
+            if kind == OP_SKIP:
+                pass
+            elif kind == OP_RUN:
+                if pos + 3 > length:
+                    return False
+                c0 = data[pos]
+                c1 = data[pos + 1]
+                c2 = data[pos + 2]
+                pos += 3
+                for i in range(px, px + n, 3):
+                    buf[i] = c0
+                    buf[i + 1] = c1
+                    buf[i + 2] = c2
+            elif kind == OP_LITERAL:
+                if pos + n > length:
+                    return False
+                for i in range(n):
+                    buf[px + i] = data[pos + i]
+                pos += n
+            else:
+                return False
+            px += n
+    return True
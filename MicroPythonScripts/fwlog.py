@@ -0,0 +1,109 @@
+# Leveled logging for the ESP32 firmware
+#
+# Console output is off by default so production builds never block on the
+# UART. Records at or above the ring level are kept unformatted in a small
+# in-RAM ring buffer and only turned into text when someone asks for them:
+#
+#   >>> import fwlog
+#   >>> fwlog.dump()
+#
+# Hot-path debug calls in ESP32_Script.py are wrapped in `if DEBUG_BUILD:`,
+# which MicroPython removes at compile time when DEBUG_BUILD is const(0).
+
+from micropython import const
+import time
+
+DEBUG = const(10)
+INFO = const(20)
+WARN = const(30)
+ERROR = const(40)
+OFF = const(100)
+
+_LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARN: "WARN", ERROR: "ERROR"}
+
+_console_level = OFF
+_ring_level = INFO
+_min_level = INFO  # lowest level anything is listening for
+
+_ring = [None] * 32
+_ring_next = 0
+_ring_count = 0
+
+
+# Sets the console and ring levels and optionally resizes the ring
+def configure(console=None, ring=None, size=None):
+    global _console_level, _ring_level, _min_level, _ring, _ring_next, _ring_count
+    if console is not None:
+        _console_level = console
+    if ring is not None:
+        _ring_level = ring
+    if size is not None:
+        _ring = [None] * size
+        _ring_next = 0
+        _ring_count = 0
+    _min_level = min(_console_level, _ring_level)
+
+
+def _format(msg, args):
+    if args:
+        try:
+            return msg % args
+        except Exception:
+            return "%s %r" % (msg, args)
+    return msg
+
+
+def _log(level, msg, args):
+    global _ring_next, _ring_count
+    if level >= _ring_level:
+        # Store the raw pieces; formatting is deferred until the ring is read
+        _ring[_ring_next] = (time.ticks_ms(), level, msg, args)
+        _ring_next = (_ring_next + 1) % len(_ring)
+        if _ring_count < len(_ring):
+            _ring_count += 1
+    if level >= _console_level:
+        print(_LEVEL_NAMES[level], _format(msg, args))
+
+
+def debug(msg, *args):
+    if _min_level <= DEBUG:
+        _log(DEBUG, msg, args)
+
+
+def info(msg, *args):
+    if _min_level <= INFO:
+        _log(INFO, msg, args)
+
+
+def warn(msg, *args):
+    if _min_level <= WARN:
+        _log(WARN, msg, args)
+
+
+def error(msg, *args):
+    if _min_level <= ERROR:
+        _log(ERROR, msg, args)
+
+
+# Returns the buffered records as formatted lines, oldest first
+def records():
+    lines = []
+    start = (_ring_next - _ring_count) % len(_ring)
+    for i in range(_ring_count):
+        ticks, level, msg, args = _ring[(start + i) % len(_ring)]
+        lines.append("%d %s %s" % (ticks, _LEVEL_NAMES[level], _format(msg, args)))
+    return lines
+
+
+# Prints the buffered records to the console
+def dump():
+    for line in records():
+        print(line)
+
+
+def clear():
+    global _ring_next, _ring_count
+    for i in range(len(_ring)):
+        _ring[i] = None
+    _ring_next = 0
+    _ring_count = 0
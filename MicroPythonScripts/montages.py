@@ -0,0 +1,142 @@
+# Loads montages.json and compiles it into span tables for the renderer
+#
+# montages.json lists the montages in order, each as a name and its spans:
+#
+#   ["np3", 48]                       one LED
+#   ["np3", 84, 28]                   28 LEDs starting at 84
+#   ["np3", 84, 28, "right side"]     same, with a note for people reading the file
+#
+# A montage's id is its position in the list plus one (0 means "off"). The
+# app addresses montages by id, so new montages go at the end of the list.
+#
+# Each montage compiles to an array('H') of (strip index, start byte, end
+# byte) triples over the NeoPixel buffers. Spans that continue the previous
+# span on the same strip are merged into it.
+#
+# Each montage also compiles to a mask: one bytearray per strip with bit
+# (i & 7) of byte i >> 3 set for every LED i it lights. Set operations
+# between montages, such as the LEDs two montages share, then take one
+# bitwise op per 8 LEDs.
+
+import json
+from array import array
+import micropython
+
+FORMAT_VERSION = 1
+BYTES_PER_PIXEL = 3
+
+
+def _default_path():
+    if "/" in __file__:
+        return __file__.rsplit("/", 1)[0] + "/montages.json"
+    return "montages.json"
+
+
+# Returns (names, span_tables, masks) for the montages in the file, checked
+# against the number of LEDs on each strip
+def load(strip_lengths, path=None):
+    with open(path or _default_path()) as f:
+        data = json.load(f)
+    return compile_montages(data, strip_lengths)
+
+
+def compile_montages(data, strip_lengths):
+    if data.get("format") != FORMAT_VERSION:
+        raise ValueError("Unsupported montage file format: %r" % data.get("format"))
+
+    strip_names = data["strips"]
+    if len(strip_names) != len(strip_lengths):
+        raise ValueError("Montage file names %d strips, the board has %d"
+                         % (len(strip_names), len(strip_lengths)))
+    strip_index = {}
+    for i, strip_name in enumerate(strip_names):
+        strip_index[strip_name] = i
+
+    names = []
+    tables = []
+    masks = []
+    for montage in data["montages"]:
+        name = montage["name"]
+        if name == "off" or name in names:
+            raise ValueError("Duplicate montage name: %s" % name)
+        table = compile_spans(name, montage["spans"], strip_index, strip_lengths)
+        tables.append(table)
+        masks.append(compile_mask(table, strip_lengths))
+        names.append(name)
+    return names, tables, masks
+
+
+def compile_spans(name, spans, strip_index, strip_lengths):
+    table = array("H")
+    for span in spans:
+        if not 2 <= len(span) <= 4 or (len(span) == 4 and not isinstance(span[3], str)):
+            raise ValueError("%s: malformed span %r" % (name, span))
+
+        strip = strip_index.get(span[0])
+        if strip is None:
+            raise ValueError("%s: unknown strip %r" % (name, span[0]))
+
+        start = span[1]
+        count = span[2] if len(span) > 2 else 1
+        if not isinstance(start, int) or not isinstance(count, int) or start < 0 or count < 1:
+            raise ValueError("%s: bad LED range %r" % (name, span))
+        if start + count > strip_lengths[strip]:
+            raise ValueError("%s: span %r runs past the end of %s (%d LEDs)"
+                             % (name, span, span[0], strip_lengths[strip]))
+
+        start_byte = start * BYTES_PER_PIXEL
+        end_byte = (start + count) * BYTES_PER_PIXEL
+        n = len(table)
+        if n and table[n - 3] == strip and table[n - 1] == start_byte:
+            table[n - 1] = end_byte
+        else:
+            table.append(strip)
+            table.append(start_byte)
+            table.append(end_byte)
+    return table
+
+
+# One all-clear mask for strips of the given lengths
+def empty_mask(strip_lengths):
+    return tuple(bytearray((n + 7) >> 3) for n in strip_lengths)
+
+
+# Sets the bit of every LED a span table covers
+def compile_mask(table, strip_lengths):
+    mask = empty_mask(strip_lengths)
+    for k in range(0, len(table), 3):
+        bits = mask[table[k]]
+        for led in range(table[k + 1] // BYTES_PER_PIXEL, table[k + 2] // BYTES_PER_PIXEL):
+            bits[led >> 3] |= 1 << (led & 7)
+    return mask
+
+
+@micropython.native
+def mask_clear(mask):
+    for bits in mask:
+        for i in range(len(bits)):
+            bits[i] = 0
+
+
+# Adds a montage's mask to `seen`, the LEDs lit by the montages added so
+# far, and its overlap with them to `shared`
+@micropython.native
+def mask_add(mask, seen, shared):
+    for s in range(len(mask)):
+        bits = mask[s]
+        seen_bits = seen[s]
+        shared_bits = shared[s]
+        for i in range(len(bits)):
+            shared_bits[i] |= seen_bits[i] & bits[i]
+            seen_bits[i] |= bits[i]
+
+
+# Number of LEDs set in a mask
+def mask_count(mask):
+    count = 0
+    for bits in mask:
+        for byte in bits:
+            while byte:
+                byte &= byte - 1
+                count += 1
+    return count
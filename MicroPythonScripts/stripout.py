@@ -0,0 +1,212 @@
+# Strip output backends: how committed NeoPixel buffers reach the LEDs
+#
+# BLEPeripheral.commit() works out which strips changed and hands their
+# bitmask to the output's write(); the pixels are always read from the
+# NeoPixel buffers (GRB, three bytes per pixel).
+#
+#   OUTPUT_BITBANG  NeoPixel.write() on each strip in turn. Simple and small,
+#                   but an update takes the sum of the four transfers.
+#   OUTPUT_RMT      one ESP32 RMT channel per strip. All transfers are started
+#                   before any of them is waited for, so an update takes about
+#                   as long as the longest strip, but the pulse lists need a
+#                   SPIRAM build.
+#   OUTPUT_MOCK     records the frames and the modelled transfer time instead
+#                   of driving any pins, for host-side tests and benchmarks.
+#   OUTPUT_AUTO     RMT when the heap has room for its pulse lists and still
+#                   leaves RMT_HEAP_RESERVE for the rest of the firmware (a
+#                   SPIRAM build), bit-banging otherwise.
+
+import gc
+import micropython
+from micropython import const
+import fwlog as log
+
+try:
+    import esp32
+except ImportError:
+    esp32 = None  # unix port: bit-bang and mock outputs only
+
+OUTPUT_BITBANG = const(0)
+OUTPUT_RMT = const(1)
+OUTPUT_MOCK = const(2)
+OUTPUT_AUTO = const(3)
+
+# WS2812 timing: 1.2 us per bit, then at least 280 us low to latch
+BIT_NS = const(1200)
+RESET_US = const(300)
+
+# RMT ticks of 100 ns (80 MHz APB clock / 8)
+RMT_CLOCK_DIV = const(8)
+T0H = const(4)
+T0L = const(8)
+T1H = const(8)
+T1L = const(4)
+LATCH_TICKS = const(3000)  # RESET_US added to the last low pulse of a strip
+RMT_FIRST_CHANNEL = const(0)  # leaves the high channels to machine.bitstream
+RMT_HEAP_RESERVE = const(64 * 1024)  # frame cache, montages and BLE, set up after the output
+
+
+# Time the LEDs take to clock in `pixels` pixels, latch included
+def transfer_us(pixels):
+    return pixels * 24 * BIT_NS // 1000 + RESET_US
+
+
+def make_output(kind, strips):
+    if kind == OUTPUT_AUTO:
+        gc.collect()
+        if esp32 is None or gc.mem_free() < RmtOutput.heap_bytes(strips) + RMT_HEAP_RESERVE:
+            log.info("Not enough heap for the RMT output, writing the strips one by one")
+            return BitbangOutput(strips)
+        kind = OUTPUT_RMT
+    if kind == OUTPUT_RMT:
+        try:
+            return RmtOutput(strips)
+        except (ImportError, MemoryError, OSError) as e:
+            log.warn("RMT output unavailable (%s), writing the strips one by one", e)
+    elif kind == OUTPUT_MOCK:
+        return MockOutput(strips)
+    return BitbangOutput(strips)
+
+
+class BitbangOutput:
+    def __init__(self, strips):
+        self.strips = strips
+
+    def write(self, mask):
+        strips = self.strips
+        for i in range(len(strips)):
+            if mask & (1 << i):
+                strips[i].write()
+
+    # Returns once every transfer has finished
+    def wait(self):
+        pass
+
+    # Heap held by the output's own buffers
+    def buffer_bytes(self):
+        return 0
+
+
+# Each strip is sent as a list of pulse durations, two per bit, starting with
+# a high pulse. The list is kept between writes and only the bytes that
+# changed since the last write are re-encoded, from a table of the 16 pulses
+# of every byte value. write_pulses() copies the list and returns while the
+# channel transmits; it waits for the channel's previous transfer itself, and
+# the latch is part of every transfer, so write() never blocks on the LEDs.
+#
+# The pulse lists take about 200 bytes per pixel, and the RMT driver keeps a
+# copy of half that size: about 150 KB for the brain model's strips, so
+# they need a SPIRAM build.
+class RmtOutput:
+    def __init__(self, strips):
+        if esp32 is None:
+            raise ImportError("no esp32 module")
+        self.strips = strips
+        self.lut = tuple(self._byte_pulses(v) for v in range(256))
+        self.channels = []
+        self.pulses = []
+        self.encoded = []
+        try:
+            for i in range(len(strips)):
+                strip = strips[i]
+                n = len(strip.buf)
+                self.channels.append(esp32.RMT(RMT_FIRST_CHANNEL + i, pin=strip.pin,
+                                               clock_div=RMT_CLOCK_DIV, idle_level=False))
+                self.pulses.append(list(self.lut[0]) * n)
+                self.encoded.append(bytearray(n))
+                self.pulses[i][n * 16 - 1] += LATCH_TICKS
+        except Exception:
+            # Frees the channels set up so far, so the fallback output (or a
+            # later attempt) can have their pins
+            self.deinit()
+            raise
+
+    @staticmethod
+    def _byte_pulses(v):
+        pulses = []
+        for bit in range(7, -1, -1):
+            if v & (1 << bit):
+                pulses.append(T1H)
+                pulses.append(T1L)
+            else:
+                pulses.append(T0H)
+                pulses.append(T0L)
+        return tuple(pulses)
+
+    def write(self, mask):
+        strips = self.strips
+        for i in range(len(strips)):
+            if mask & (1 << i):
+                pulses = self.pulses[i]
+                buf = strips[i].buf
+                # Encoding the next strip overlaps the transfer of this one
+                self._encode(pulses, buf, self.encoded[i])
+                pulses[len(pulses) - 1] = self.lut[buf[len(buf) - 1]][15] + LATCH_TICKS
+                self.channels[i].write_pulses(pulses, 1)
+
+    def wait(self):
+        for i in range(len(self.channels)):
+            self.channels[i].wait_done(timeout=transfer_us(len(self.encoded[i]) // 3) // 1000 + 1)
+
+    def deinit(self):
+        for channel in self.channels:
+            channel.deinit()
+        self.channels = []
+        self.pulses = []
+        self.encoded = []
+
+    # Heap an RmtOutput for `strips` takes: 16 pulse words and one encoded
+    # byte per strip byte, and the driver's copy at two pulses per word
+    @staticmethod
+    def heap_bytes(strips):
+        total = 0
+        for strip in strips:
+            total += len(strip.buf) * (64 + 1 + 32)
+        return total
+
+    # Pulse lists at one word per pulse, and the encoded copies
+    def buffer_bytes(self):
+        total = 0
+        for i in range(len(self.pulses)):
+            total += len(self.pulses[i]) * 4 + len(self.encoded[i])
+        return total
+
+    # Re-encodes the bytes that differ from `encoded`
+    @micropython.native
+    def _encode(self, pulses, buf, encoded):
+        lut = self.lut
+        for i in range(len(buf)):
+            v = buf[i]
+            if v != encoded[i]:
+                encoded[i] = v
+                j = i * 16
+                pulses[j:j + 16] = lut[v]
+
+
+class MockOutput:
+    def __init__(self, strips, parallel=True):
+        self.strips = strips
+        self.parallel = parallel  # model RMT (True) or bit-bang (False) timing
+        self.frames = []  # (mask, one bytes object per strip)
+        self.transfer_us = 0  # modelled duration of the last write
+        self.total_us = 0
+
+    def write(self, mask):
+        frame = tuple(bytes(strip.buf) for strip in self.strips)
+        self.frames.append((mask, frame))
+        longest = 0
+        total = 0
+        for i in range(len(self.strips)):
+            if mask & (1 << i):
+                us = transfer_us(len(self.strips[i].buf) // 3)
+                longest = max(longest, us)
+                total += us
+        self.transfer_us = longest if self.parallel else total
+        self.total_us += self.transfer_us
+
+    def wait(self):
+        pass
+
+    # Recorded frames are test output, not firmware state
+    def buffer_bytes(self):
+        return 0
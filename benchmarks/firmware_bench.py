@@ -0,0 +1,469 @@
+# Rendering benchmarks for MicroPythonScripts/ESP32_Script.py
+#
+# Times rendering every montage from its span table, turn_off, one frame of
+# each animation effect, the BLE write IRQ handler, and the end-to-end
+# process_command path for every montage/color pair and for two layered
+# montages (cold: frame cache empty, warm: served from the cache). Reports
+# the median and minimum latency and the bytes allocated per operation, and
+# compares both with a stored baseline. Under CPython the allocation figures
+# include the simulator's copy of every strip write.
+#
+#   python benchmarks/firmware_bench.py                  # CPython + simulator
+#   micropython benchmarks/firmware_bench.py             # MicroPython unix port
+#   python benchmarks/firmware_bench.py --save           # record a new baseline
+#   python benchmarks/firmware_bench.py --check          # exit 1 if an operation allocates more
+#   python benchmarks/firmware_bench.py --threshold 0.5  # flag timings 50% slower (default 20%)
+#   python benchmarks/firmware_bench.py --filter montage
+#
+# Baselines are kept per Python implementation in benchmarks/baseline.json.
+# The bytes an operation allocates are the same on every full run, so
+# --check gates on those alone. Sub-millisecond timings swing by more than the
+# threshold between runs of the same tree, so slower timings are flagged
+# in the report but never fail the check; only compare them on the same,
+# quiet machine.
+
+import gc
+import json
+import sys
+
+MICROPYTHON = sys.implementation.name == "micropython"
+
+if MICROPYTHON:
+    import time
+else:
+    import os
+    import time
+    import tracemalloc
+
+if MICROPYTHON:
+    BENCH_DIR = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+    ROOT_DIR = BENCH_DIR + "/.."
+else:
+    BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+    ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+BASELINE_FILE = BENCH_DIR + "/baseline.json"
+DEFAULT_ITERATIONS = 20
+REGRESSION_THRESHOLD = 0.20  # 20% slower than the baseline minimum, report only
+
+
+# Under CPython the firmware runs on the simulator's mock modules
+def load_firmware_cpython():
+    sys.path.insert(0, ROOT_DIR)
+    from simulator import SimulatedBoard
+
+    board = SimulatedBoard()
+    return board.firmware, board.peripheral
+
+
+# The unix port has no bluetooth/neopixel, so minimal stand-ins are put in
+# sys.modules before the script is imported
+def load_firmware_micropython():
+    class Module:
+        pass
+
+    class Pin:
+        IN = 1
+        OUT = 3
+        PULL_DOWN = 2
+        IRQ_RISING = 1
+        IRQ_FALLING = 2
+
+        def __init__(self, id, *args, **kwargs):
+            self.id = id
+            self._value = 0
+
+        def value(self, v=None):
+            if v is None:
+                return self._value
+            self._value = v
+
+        def on(self):
+            self._value = 1
+
+        def off(self):
+            self._value = 0
+
+        def irq(self, *args, **kwargs):
+            pass
+
+    class Timer:
+        PERIODIC = 1
+
+        def __init__(self, id, **kwargs):
+            pass
+
+        def init(self, **kwargs):
+            pass
+
+        def deinit(self):
+            pass
+
+    class NeoPixel:
+        def __init__(self, pin, n, bpp=3, timing=1):
+            self.n = n
+            self.buf = bytearray(n * 3)
+
+        def __len__(self):
+            return self.n
+
+        def __setitem__(self, i, v):
+            self.buf[i * 3] = v[1]
+            self.buf[i * 3 + 1] = v[0]
+            self.buf[i * 3 + 2] = v[2]
+
+        def write(self):
+            pass
+
+    class BLE:
+        def __init__(self):
+            self.values = {}
+
+        def active(self, *args):
+            return True
+
+        def config(self, *args, **kwargs):
+            pass
+
+        def irq(self, handler):
+            pass
+
+        def gap_advertise(self, *args, **kwargs):
+            pass
+
+        def gatts_register_services(self, services):
+            handles = []
+            handle = 16
+            for uuid, characteristics in services:
+                value_handles = []
+                for c in characteristics:
+                    value_handles.append(handle)
+                    handle += 3
+                handles.append(tuple(value_handles))
+            return tuple(handles)
+
+        def gatts_read(self, handle):
+            return self.values.get(handle, b"")
+
+        def gatts_write(self, handle, data, send_update=False):
+            self.values[handle] = bytes(data)
+
+        def gatts_notify(self, *args):
+            pass
+
+        def gatts_set_buffer(self, *args):
+            pass
+
+    # Stands in for uasyncio so importing the script does not start its event loop
+    class ThreadSafeFlag:
+        def set(self):
+            pass
+
+        def clear(self):
+            pass
+
+    uasyncio = Module()
+    uasyncio.ThreadSafeFlag = ThreadSafeFlag
+    uasyncio.run = lambda coro: None
+    uasyncio.create_task = lambda coro: None
+
+    bluetooth = Module()
+    bluetooth.BLE = BLE
+    bluetooth.UUID = lambda value: bytes(16)
+    bluetooth.FLAG_READ = 0x0002
+    bluetooth.FLAG_WRITE_NO_RESPONSE = 0x0004
+    bluetooth.FLAG_WRITE = 0x0008
+    bluetooth.FLAG_NOTIFY = 0x0010
+    machine = Module()
+    machine.Pin = Pin
+    machine.Timer = Timer
+    neopixel = Module()
+    neopixel.NeoPixel = NeoPixel
+    sys.modules["bluetooth"] = bluetooth
+    sys.modules["machine"] = machine
+    sys.modules["neopixel"] = neopixel
+    sys.modules["uasyncio"] = uasyncio
+    sys.path.insert(0, ROOT_DIR + "/MicroPythonScripts")
+    import ESP32_Script
+
+    return ESP32_Script, ESP32_Script.ble_peripheral
+
+
+if MICROPYTHON:
+    def now_us():
+        return time.ticks_us()
+
+    def elapsed_us(start):
+        return time.ticks_diff(time.ticks_us(), start)
+
+    def alloc_start():
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+
+    def alloc_end(start):
+        used = gc.mem_alloc() - start
+        gc.enable()
+        return used
+else:
+    def now_us():
+        return time.perf_counter_ns() // 1000
+
+    def elapsed_us(start):
+        return time.perf_counter_ns() // 1000 - start
+
+    def alloc_start():
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def alloc_end(start):
+        return tracemalloc.get_traced_memory()[1] - start
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+# Runs op() `iterations` times after one warm-up call; setup() runs before
+# each call, outside the timing
+def measure(op, setup=None, iterations=DEFAULT_ITERATIONS):
+    if setup is not None:
+        setup()
+    op()
+    times = []
+    allocs = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        mark = alloc_start()
+        start = now_us()
+        op()
+        times.append(elapsed_us(start))
+        allocs.append(alloc_end(mark))
+    return {"median_us": median(times), "min_us": min(times), "alloc_bytes": max(allocs)}
+
+
+def build_benchmarks(fw, peripheral):
+    benchmarks = []
+
+    def add(name, op, setup=None):
+        benchmarks.append((name, op, setup))
+
+    # Everything but the output.* benchmarks writes through NeoPixel.write(),
+    # so the numbers stay comparable across output backends
+    stripout = fw.stripout
+    peripheral.output = stripout.BitbangOutput(peripheral.strips)
+
+    # Makes the next commit write every strip, as after a montage switch
+    def invalidate_strips():
+        for shown in peripheral.shown:
+            for i in range(len(shown)):
+                shown[i] = 0xFF
+
+    def light_strips():
+        for strip in peripheral.strips:
+            for i in range(0, len(strip.buf), 7):
+                strip.buf[i] = 75
+        invalidate_strips()
+
+    names = peripheral.montage_names
+    r, g, b = fw.COLOR_MAP["blue"]
+    for montage_id in range(1, len(names)):
+        add("montage." + names[montage_id],
+            lambda montage_id=montage_id: peripheral.render(montage_id, r, g, b), peripheral.clear)
+
+    add("turn_off", peripheral.turn_off, light_strips)
+
+    # Encoding and starting the transfers of a full update, and of a montage
+    # switch. Under CPython this includes the RMT mock decoding the pulses.
+    state = {"fill": 0, "montage": 0}
+
+    def change_all():
+        state["fill"] ^= 0x55
+        for buf in peripheral.bufs:
+            for i in range(len(buf)):
+                buf[i] = state["fill"]
+
+    add("output.bitbang.full", lambda: peripheral.output.write(0x0F), change_all)
+
+    # Only on the board or the simulator; the unix port has no esp32 module
+    rmt_output = stripout.make_output(stripout.OUTPUT_RMT, peripheral.strips)
+    if isinstance(rmt_output, stripout.RmtOutput):
+        def switch_montage():
+            for step in range(2):
+                state["montage"] += 1
+                peripheral.clear()
+                peripheral.render(1 + state["montage"] % (len(names) - 1), r, g, b)
+                if step == 0:
+                    rmt_output.write(0x0F)
+
+        add("output.rmt.full", lambda: rmt_output.write(0x0F), change_all)
+        add("output.rmt.montage_switch", lambda: rmt_output.write(0x0F), switch_montage)
+
+    # One animation frame of each effect, drawn without the timer
+    animator = peripheral.animator
+    for name, start in (("crossfade", animator.crossfade), ("pulse", animator.pulse),
+                        ("propagate", animator.propagate)):
+        def animate_setup(start=start):
+            peripheral.turn_off()
+            start(1, r, g, b, 1000)
+            animator.started = fw.time.ticks_add(fw.time.ticks_ms(), -500)
+
+        add("animate." + name, lambda: animator.step(0), animate_setup)
+
+    state["seq"] = 0
+
+    # What the BLE IRQ handler itself costs: read the value and queue it
+    def drain_events():
+        events = peripheral.events
+        while events.get()[1] is not None:
+            pass
+        peripheral.ble.values[peripheral.char_handle] = frame(1, fw.COLOR_MAP["blue"])
+
+    add("irq.write", lambda: peripheral.ble_callback(3, (0, peripheral.char_handle)), drain_events)
+
+    def frame(montage_id, rgb):
+        state["seq"] = (state["seq"] + 1) & 0xFFFF
+        return bytes((fw.PROTOCOL_HEADER, fw.OP_SET_MONTAGE, montage_id, rgb[0], rgb[1], rgb[2],
+                      255, state["seq"] & 0xFF, state["seq"] >> 8))
+
+    def cold_setup():
+        peripheral.frame_cache.clear()
+        peripheral.turn_off()
+
+    for montage_id in range(1, len(names)):
+        for color_name in sorted(fw.COLOR_MAP):
+            rgb = fw.COLOR_MAP[color_name]
+            name = names[montage_id] + "." + color_name
+
+            def run(montage_id=montage_id, rgb=rgb):
+                peripheral.process_command(frame(montage_id, rgb))
+
+            def warm_setup(montage_id=montage_id, rgb=rgb):
+                peripheral.turn_off()
+                run(montage_id, rgb)  # make sure the frame is cached
+                peripheral.turn_off()
+
+            add("process_command.cold." + name, run, cold_setup)
+            add("process_command.warm." + name, run, warm_setup)
+
+    # Bipolar under hatband with their shared LEDs in white: two span
+    # renders plus the mask overlap
+    def layers():
+        state["seq"] = (state["seq"] + 1) & 0xFFFF
+        white = fw.COLOR_MAP["white"]
+        red = fw.COLOR_MAP["red"]
+        blue = fw.COLOR_MAP["blue"]
+        peripheral.process_command(bytes((
+            fw.PROTOCOL_HEADER, fw.OP_LAYERS, 2, white[0], white[1], white[2], 255,
+            state["seq"] & 0xFF, state["seq"] >> 8,
+            peripheral.montage_ids["bipolar"], red[0], red[1], red[2], 0,
+            peripheral.montage_ids["hatband"], blue[0], blue[1], blue[2], 1)))
+
+    def layers_warm_setup():
+        peripheral.turn_off()
+        layers()
+        peripheral.turn_off()
+
+    add("process_command.cold.layers", layers, cold_setup)
+    add("process_command.warm.layers", layers, layers_warm_setup)
+
+    return benchmarks
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baseline(results):
+    baselines = load_baseline()
+    baselines[sys.implementation.name] = results
+    with open(BASELINE_FILE, "w") as f:
+        if MICROPYTHON:
+            json.dump(baselines, f)  # no indent/sort_keys on MicroPython
+        else:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+
+
+# Returns the operations that got slower than `threshold` and those that
+# allocate more than in the baseline
+def report(results, baseline, threshold):
+    slower = []
+    grew = []
+    print("%-44s %10s %10s %10s %9s %9s" % ("operation", "median us", "min us", "alloc B",
+                                             "vs base", "alloc vs"))
+    for name in sorted(results):
+        result = results[name]
+        change = ""
+        alloc_change = ""
+        base = baseline.get(name)
+        # The minimum is far less noisy than the median for sub-millisecond operations
+        if base and base["min_us"]:
+            ratio = result["min_us"] / base["min_us"] - 1
+            change = "%+.0f%%" % (ratio * 100)
+            if ratio > threshold:
+                change += " ?"
+                slower.append(name)
+        if base:
+            grown = result["alloc_bytes"] - base["alloc_bytes"]
+            if grown:
+                alloc_change = "%+d" % grown
+            if grown > 0:
+                alloc_change += " !"
+                grew.append(name)
+        print("%-44s %10.1f %10.1f %10d %9s %9s" % (name, result["median_us"], result["min_us"],
+                                                     result["alloc_bytes"], change, alloc_change))
+    return slower, grew
+
+
+def main(argv):
+    iterations = DEFAULT_ITERATIONS
+    name_filter = None
+    threshold = REGRESSION_THRESHOLD
+    if "--iterations" in argv:
+        iterations = int(argv[argv.index("--iterations") + 1])
+    if "--threshold" in argv:
+        threshold = float(argv[argv.index("--threshold") + 1])
+    if "--filter" in argv:
+        name_filter = argv[argv.index("--filter") + 1]
+
+    if MICROPYTHON:
+        fw, peripheral = load_firmware_micropython()
+    else:
+        fw, peripheral = load_firmware_cpython()
+        tracemalloc.start()
+
+    results = {}
+    for name, op, setup in build_benchmarks(fw, peripheral):
+        if name_filter is None or name_filter in name:
+            results[name] = measure(op, setup, iterations)
+
+    if "--save" in argv:
+        save_baseline(results)
+        print("Baseline saved for", sys.implementation.name)
+
+    slower, grew = report(results, load_baseline().get(sys.implementation.name, {}), threshold)
+    if slower:
+        print("%d operation(s) more than %d%% slower than the baseline (timing noise is not checked)"
+              % (len(slower), threshold * 100))
+    if grew:
+        print("%d operation(s) allocate more than the baseline" % len(grew))
+        # What an operation allocates depends on the ones that ran before it
+        # (list and dict capacity, the frame cache), so only a full run is
+        # comparable with the baseline
+        if name_filter is not None:
+            print("Allocations are only checked on a full run, without --filter")
+        elif "--check" in argv:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
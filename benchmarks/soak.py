@@ -0,0 +1,526 @@
+# Soak test for the command pipeline: BoardPool -> loopback transport ->
+# simulated boards running the real firmware
+#
+#   python benchmarks/soak.py                               # 60 s of mixed commands at 10/s
+#   python benchmarks/soak.py --scenario toggles --rate 40  # one card switched on and off
+#   python benchmarks/soak.py --scenario palette            # every palette color on a montage
+#   python benchmarks/soak.py --scenario montages           # every montage in turn
+#   python benchmarks/soak.py --scenario layers             # two or three montages layered
+#   python benchmarks/soak.py --mix toggles=3,palette=1     # weighted mix of the scenarios
+#   python benchmarks/soak.py --duration 4h --boards 3 --broadcast
+#   python benchmarks/soak.py --replay session.jsonl --speed 2 --loop --duration 1h
+#   python benchmarks/soak.py --drop-every 300              # drop a link every 5 min
+#   python benchmarks/soak.py --record session.jsonl        # keep the commands for --replay
+#   python benchmarks/soak.py --json soak.json              # results as JSON
+#   python benchmarks/soak.py --check                       # exit 1 on lost or reordered
+#                                                           # commands, slow p99 or heap growth
+#
+# The run is in virtual time (ManualClock), so an hour of commands takes as
+# long as the host needs to run them. Sessions come from the app with
+# RECORD_SESSIONS in main.py, or from --record; see session.py.
+#
+# Reported:
+#   throughput    commands sent, and shown by each board, per virtual second
+#   latency       BoardPool.send() to the board's telemetry report for that
+#                 command: link latency, write queueing, and the host time the
+#                 firmware took to decode, render and write the strips
+#   dropped       commands superseded in the app's write queue (expected above
+#                 the link's rate), failed writes, commands the board replaced
+#                 or lost from its event queue, and commands written but never
+#                 reported
+#   out of order  reports older than one already shown, and commands the
+#                 firmware discarded as stale
+#   heap          memory allocated by MicroPythonScripts/ and still live,
+#                 sampled with tracemalloc (the simulator's gc.mem_free() is
+#                 fixed), and its growth per hour over the second half of the
+#                 run, after the frame cache has filled; runs shorter than
+#                 MIN_DRIFT_S report no drift. tracemalloc slows the firmware
+#                 down about 3x, and its latencies with it: --no-heap for
+#                 latency figures only
+
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+FIRMWARE_DIR = os.path.join(ROOT_DIR, "MicroPythonScripts")
+sys.path.insert(0, ROOT_DIR)
+
+from boards import BoardPool
+from commands import (COLOR_RGB, COMMAND_FRAME, MONTAGE_IDS, OP_ANIMATE, OP_LAYERS, OP_OFF, OP_SET_MONTAGE,
+                      PROTOCOL_HEADER)
+from metrics import Histogram, Metrics
+from registry import DeviceRegistry
+from session import SessionRecorder, load_session
+from telemetry import decode_telemetry
+from transport_loopback import LoopbackTransport, ManualClock
+
+MONTAGES = [name for name in MONTAGE_IDS if name != "off"]  # the cards in DemoApp.command_map
+PALETTE = list(COLOR_RGB)  # the colors in DemoApp.show_color_menu
+SCENARIOS = ("toggles", "palette", "montages", "layers")
+COMMAND_OPCODES = (OP_SET_MONTAGE, OP_OFF, OP_ANIMATE, OP_LAYERS)
+LAYER_OVERLAP = "white"  # as in the app's multi-select mode
+
+DEFAULT_RATE = 10.0  # commands per second
+DEFAULT_DURATION_S = 60
+DEFAULT_MAX_P99_MS = 50.0
+DEFAULT_MAX_DRIFT_KB = 64.0  # firmware heap growth per hour
+CONNECT_S = 5  # scan, connect and subscribe before the first command
+SETTLE_S = 2  # after the last command, for the boards to report it
+HOUSEKEEPING_S = 1  # forget the boards' strip writes this often
+HEAP_SAMPLES = 60  # per run, unless --sample is given
+MIN_DRIFT_S = 600  # heap drift needs at least this long a run
+PROGRESS_STEPS = 10
+
+
+# Scenarios: endless generators of (command, color), or of (layers,
+# overlap color) for BoardPool.send_layers()
+
+# Rapid toggles: a card switched on and straight off again
+def toggles(rng):
+    while True:
+        color = rng.choice(PALETTE)
+        yield rng.choice(MONTAGES), color
+        yield "off", color
+
+
+# A montage swept through every palette color
+def palette(rng):
+    while True:
+        montage = rng.choice(MONTAGES)
+        for color in PALETTE:
+            yield montage, color
+
+
+# All nine montages in turn, in a new color each round
+def montages(rng):
+    while True:
+        color = rng.choice(PALETTE)
+        for montage in MONTAGES:
+            yield montage, color
+
+
+# Two or three montages at once, in their own colors
+def layers(rng):
+    while True:
+        picked = rng.sample(MONTAGES, rng.randint(2, 3))
+        yield [(montage, rng.choice(PALETTE)) for montage in picked], LAYER_OVERLAP
+
+
+# Each command from a scenario picked by weight
+def mixed(rng, weights):
+    names = sorted(weights)
+    generators = {name: globals()[name](rng) for name in names}
+    while True:
+        name = rng.choices(names, [weights[name] for name in names])[0]
+        yield next(generators[name])
+
+
+# "2h", "30m", "90s" or plain seconds
+def parse_duration(text):
+    units = {"h": 3600, "m": 60, "s": 1}
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+# "toggles=3,palette=1" -> {"toggles": 3.0, "palette": 1.0}
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name!r}; expected one of {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+# Sequence number of a binary montage command, or None for anything else
+def command_seq(payload):
+    if len(payload) < COMMAND_FRAME.size or payload[0] != PROTOCOL_HEADER or payload[1] not in COMMAND_OPCODES:
+        return None
+    return COMMAND_FRAME.unpack_from(payload)[7]
+
+
+# Bytes allocated by the firmware and still live
+def firmware_heap():
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, os.path.join(FIRMWARE_DIR, "*"))])
+    return sum(stat.size for stat in snapshot.statistics("filename"))
+
+
+# Least-squares slope of (time, value) samples, per hour
+def slope_per_hour(samples):
+    if len(samples) < 2:
+        return None
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_v = sum(v for _, v in samples) / len(samples)
+    spread = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not spread:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / spread * 3600
+
+
+class BoardStats:
+    def __init__(self):
+        self.pending = {}  # seq -> time written, until the board reports it
+        self.last_seq = None  # newest command the board reported
+        self.shown = 0
+        self.reordered = 0
+        self.first = None  # first and latest telemetry report
+        self.last = None
+
+    # Change in one of the board's 16-bit telemetry counters
+    def counted(self, field):
+        if self.first is None:
+            return 0
+        return (getattr(self.last, field) - getattr(self.first, field)) & 0xFFFF
+
+
+# Transport monitor: matches the commands written to each board with the
+# board's reports
+class SoakMonitor:
+    def __init__(self):
+        self.boards = {}  # address -> BoardStats
+        self.sent = {}  # seq -> clock time BoardPool.send() was called
+        self.latency = Histogram(max_samples=None)  # ms, one sample per board per command
+
+    def stats(self, address):
+        stats = self.boards.get(address)
+        if stats is None:
+            stats = self.boards[address] = BoardStats()
+        return stats
+
+    def delivered(self, address, time, payload):
+        seq = command_seq(payload)
+        if seq is not None:
+            self.stats(address).pending[seq] = time
+
+    def reported(self, address, time, value):
+        report = decode_telemetry(value)
+        if report is None:
+            return
+        stats = self.stats(address)
+        if stats.first is None:
+            stats.first = report
+        stats.last = report
+        # Periodic reports repeat the last command
+        if report.opcode not in COMMAND_OPCODES or stats.pending.pop(report.seq, None) is None:
+            return
+        if stats.last_seq is not None and (report.seq - stats.last_seq) & 0xFFFF >= 0x8000:
+            stats.reordered += 1
+        else:
+            stats.last_seq = report.seq
+        stats.shown += 1
+        sent = self.sent.get(report.seq)
+        if sent is not None:
+            self.latency.record((time - sent) * 1000)
+
+
+class Soak:
+    def __init__(self, commands, rate, duration, boards=1, broadcast=False, drop_every=None,
+                 sample_s=None, track_heap=True, seed=0, recorder=None, progress=None):
+        self.commands = commands  # iterator of (time offset, command, color)
+        self.rate = rate
+        self.duration = duration
+        self.broadcast = broadcast
+        self.drop_every = drop_every
+        self.sample_s = sample_s or max(1.0, duration / HEAP_SAMPLES)
+        self.track_heap = track_heap
+        self.rng = random.Random(seed)
+        self.progress = progress  # progress(line), or None
+
+        self.clock = ManualClock()
+        self.monitor = SoakMonitor()
+        if track_heap:
+            tracemalloc.start()
+        self.transport = LoopbackTransport(self.clock, boards=boards, count_host_time=True,
+                                           monitor=self.monitor)
+        self.pool = BoardPool(self.transport, DeviceRegistry(None), Metrics(now=self.clock.now_ms))
+        self.pool.recorder = recorder
+
+        self.start = None  # clock time of the first command
+        self.sent = 0
+        self.not_connected = 0
+        self.drops = 0
+        self.last_seq = 0  # sequence number of the last command sent from here
+        self.heap = []  # (seconds into the run, bytes)
+        self.wall_s = None
+
+    def run(self):
+        self.pool.broadcast = self.broadcast
+        self.pool.connect()
+        self.clock.advance(CONNECT_S)
+        if not any(board.ready for board in self.pool.boards.values()):
+            raise RuntimeError("no board became ready")
+
+        self.start = self.clock.get_time()
+        self.schedule_next()
+        self.clock.schedule_once(self.housekeeping, HOUSEKEEPING_S)
+        if self.drop_every:
+            self.clock.schedule_once(self.drop, self.drop_every)
+        if self.track_heap:
+            self.sample_heap(0)
+
+        wall_start = time.perf_counter()
+        step = self.duration / PROGRESS_STEPS
+        for n in range(1, PROGRESS_STEPS + 1):
+            self.clock.advance(step)
+            if self.progress is not None:
+                self.progress(self.progress_line(n * step, time.perf_counter() - wall_start))
+        self.clock.advance(SETTLE_S)
+        self.wall_s = time.perf_counter() - wall_start
+        self.pool.close()
+        if self.track_heap:
+            tracemalloc.stop()
+
+    def schedule_next(self):
+        entry = next(self.commands, None)
+        if entry is None or entry[0] >= self.duration:
+            return
+        self.clock.schedule_once(lambda dt: self.send(entry[1], entry[2]),
+                                 self.start + entry[0] - self.clock.get_time())
+
+    def send(self, command, color):
+        if isinstance(command, list):
+            sent = self.pool.send_layers(command, color)
+        else:
+            sent = self.pool.send(command, color)
+        if sent:
+            self.sent += 1
+            # The pool's own resends (e.g. after a reconnect) took the numbers
+            # in between; forget the commands sent under them a wrap ago
+            seq = self.pool.sequence
+            skipped = self.last_seq
+            while (seq - skipped) & 0xFFFF > 1:
+                skipped = (skipped + 1) & 0xFFFF
+                self.monitor.sent.pop(skipped, None)
+            self.monitor.sent[seq] = self.clock.get_time()
+            self.last_seq = seq
+        else:
+            self.not_connected += 1
+        self.schedule_next()
+
+    def housekeeping(self, dt):
+        for board in self.transport.boards.values():
+            board.clear_writes()
+        elapsed = self.clock.get_time() - self.start
+        if self.track_heap and elapsed >= len(self.heap) * self.sample_s:
+            self.sample_heap(elapsed)
+        self.clock.schedule_once(self.housekeeping, HOUSEKEEPING_S)
+
+    def sample_heap(self, elapsed):
+        self.heap.append((elapsed, firmware_heap()))
+
+    # Drops a connected board's link, as if it went out of range for a moment
+    def drop(self, dt):
+        connected = [address for address, link in self.transport.links.items() if link.connected]
+        if connected:
+            self.transport.drop(self.rng.choice(connected))
+            self.drops += 1
+        self.clock.schedule_once(self.drop, self.drop_every)
+
+    def progress_line(self, elapsed, wall_s):
+        line = (f"{elapsed:8.0f} s  {self.sent} sent, {self.shown()} shown, "
+                f"p99 {self.monitor.latency.percentile(99):.1f} ms")
+        if self.heap:
+            line += f", heap {self.heap[-1][1] / 1024:.1f} KB"
+        return line + f"  ({wall_s:.0f} s wall)"
+
+    def shown(self):
+        return sum(stats.shown for stats in self.monitor.boards.values())
+
+    # Cancelled traces by reason (coalesced, failed, ...), over every board
+    def cancelled(self):
+        reasons = {}
+        for name, n in self.pool.metrics.counters.items():
+            parts = name.split(".")
+            if parts[0] == "bcast" or (parts[0] == "cmd" and parts[1] != "undelivered"):
+                reasons[parts[-1]] = reasons.get(parts[-1], 0) + n
+        return reasons
+
+    def results(self):
+        boards = self.monitor.boards.values()
+        cancelled = self.cancelled()
+        unreported = sum(len(stats.pending) for stats in boards)
+        board_coalesced = sum(stats.counted("coalesced") for stats in boards)
+        stale = sum(stats.counted("stale") for stats in boards)
+        queue_full = sum(stats.counted("dropped") for stats in boards)
+        results = {
+            "duration_s": self.duration,
+            "wall_s": self.wall_s,
+            "boards": len(self.transport.boards),
+            "sent": self.sent,
+            "not_connected": self.not_connected,
+            "link_drops": self.drops,
+            "shown": self.shown(),
+            "sent_per_s": self.sent / self.duration,
+            "shown_per_s": self.shown() / self.duration,
+            "latency_ms": self.monitor.latency.summary(),
+            "coalesced": cancelled.get("coalesced", 0),
+            "failed": cancelled.get("failed", 0),
+            "board_coalesced": board_coalesced,
+            "board_queue_full": queue_full,
+            "lost": max(0, unreported - board_coalesced - stale - queue_full),
+            "reordered": sum(stats.reordered for stats in boards),
+            "stale": stale,
+            "heap": None,
+        }
+        if self.heap:
+            values = [size for _, size in self.heap]
+            results["heap"] = {
+                "start_kb": values[0] / 1024,
+                "end_kb": values[-1] / 1024,
+                "peak_kb": max(values) / 1024,
+                "drift_kb_per_h": self.heap_drift(),
+                "samples": [[round(t, 1), size] for t, size in self.heap],
+            }
+        return results
+
+    # Heap growth per hour over the second half of the run
+    def heap_drift(self):
+        if self.duration < MIN_DRIFT_S:
+            return None
+        second_half = [(t, size / 1024) for t, size in self.heap if t >= self.duration / 2]
+        return slope_per_hour(second_half)
+
+
+# Generated commands at `rate` per second
+def generated(scenario, rate):
+    for n, (command, color) in enumerate(scenario):
+        yield n / rate, command, color
+
+
+# A recorded session at `speed` times its own pace, over and over with `loop`
+def replayed(session, speed, loop, gap):
+    if not session:
+        return
+    offset = 0.0
+    while True:
+        for t, command, color in session:
+            yield offset + t / speed, command, color
+        if not loop:
+            return
+        offset += session[-1][0] / speed + gap
+
+
+def report(name, results, out):
+    latency = results["latency_ms"]
+    wall = results["wall_s"]
+    print(f"Soak: {name}, {results['duration_s']:.0f} s on {results['boards']} board(s)", file=out)
+    print(f"  wall time     {wall:.1f} s ({results['duration_s'] / wall:.1f}x real time)", file=out)
+    print(f"  commands      {results['sent']} sent, {results['not_connected']} while no board was ready, "
+          f"{results['link_drops']} link drops", file=out)
+    print(f"  throughput    {results['sent_per_s']:.1f} sent/s, {results['shown_per_s']:.1f} shown/s over all boards", file=out)
+    print(f"  latency       p50 {latency['p50']:.1f} ms, p99 {latency['p99']:.1f} ms, "
+          f"max {latency['max']:.1f} ms over {latency['count']} reports", file=out)
+    print(f"  dropped       {results['coalesced']} coalesced, {results['failed']} failed, "
+          f"{results['board_coalesced']} replaced on the board, {results['board_queue_full']} queue full, "
+          f"{results['lost']} lost", file=out)
+    print(f"  out of order  {results['reordered']} reported, {results['stale']} stale", file=out)
+    heap = results["heap"]
+    if heap is not None:
+        drift = heap["drift_kb_per_h"]
+        drift = "n/a" if drift is None else f"{drift:+.1f} KB/h"
+        print(f"  heap          {heap['start_kb']:.1f} KB -> {heap['end_kb']:.1f} KB, "
+              f"peak {heap['peak_kb']:.1f} KB, drift {drift}", file=out)
+
+
+# Reasons the run fails --check
+def check(results, max_p99_ms, max_drift_kb):
+    failures = []
+    for key in ("lost", "failed", "board_queue_full", "reordered", "stale"):
+        if results[key]:
+            failures.append(f"{results[key]} {key.replace('_', ' ')}")
+    if results["latency_ms"]["p99"] > max_p99_ms:
+        failures.append(f"p99 {results['latency_ms']['p99']:.1f} ms over {max_p99_ms:.1f} ms")
+    heap = results["heap"]
+    if heap is not None and heap["drift_kb_per_h"] is not None and heap["drift_kb_per_h"] > max_drift_kb:
+        failures.append(f"heap drift {heap['drift_kb_per_h']:.1f} KB/h over {max_drift_kb:.1f} KB/h")
+    return failures
+
+
+def option(argv, name, default=None, convert=str):
+    if name in argv:
+        return convert(argv[argv.index(name) + 1])
+    return default
+
+
+def main(argv):
+    rate = option(argv, "--rate", DEFAULT_RATE, float)
+    duration = option(argv, "--duration", None, parse_duration)
+    seed = option(argv, "--seed", 0, int)
+    rng = random.Random(seed)
+
+    replay = option(argv, "--replay")
+    if replay is not None:
+        session = load_session(replay)
+        speed = option(argv, "--speed", 1.0, float)
+        loop = "--loop" in argv
+        if duration is None:
+            duration = session[-1][0] / speed + SETTLE_S if session and not loop else DEFAULT_DURATION_S
+        commands = replayed(session, speed, loop, 1 / rate)
+        name = f"replay of {replay} ({len(session)} commands) at {speed:g}x" + (", looped" if loop else "")
+    else:
+        weights = parse_mix(option(argv, "--mix", ",".join(SCENARIOS)))
+        scenario = option(argv, "--scenario")
+        if scenario is not None:
+            weights = parse_mix(scenario)
+        if len(weights) == 1:
+            scenario = globals()[next(iter(weights))](rng)
+        else:
+            scenario = mixed(rng, weights)
+        commands = generated(scenario, rate)
+        name = (", ".join(f"{key}={value:g}" for key, value in sorted(weights.items()))
+                + f" at {rate:g}/s")
+        if duration is None:
+            duration = DEFAULT_DURATION_S
+
+    recorder = None
+    record = option(argv, "--record")
+    if record is not None:
+        recorder = SessionRecorder(record)
+
+    out = sys.stdout
+    verbose = "--verbose" in argv
+    soak = Soak(commands, rate, duration,
+                boards=option(argv, "--boards", 1, int),
+                broadcast="--broadcast" in argv,
+                drop_every=option(argv, "--drop-every", None, parse_duration),
+                sample_s=option(argv, "--sample", None, parse_duration),
+                track_heap="--no-heap" not in argv,
+                seed=seed,
+                recorder=recorder,
+                progress=lambda line: print(line, file=out, flush=True))
+    # The pool and the firmware log every command; keep them off the report
+    # unless asked for
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(out if verbose else devnull):
+        soak.run()
+
+    results = soak.results()
+    results["scenario"] = name
+    report(name, results, out)
+
+    path = option(argv, "--json")
+    if path is not None:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {path}")
+
+    if "--check" in argv:
+        failures = check(results,
+                         option(argv, "--max-p99-ms", DEFAULT_MAX_P99_MS, float),
+                         option(argv, "--max-heap-drift-kb", DEFAULT_MAX_DRIFT_KB, float))
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
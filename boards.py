@@ -0,0 +1,822 @@
+# Board connections: everything between a montage command and the transport
+#
+# BoardPool finds boards through a Transport (transport.py) and keeps one
+# BoardConnection per board, each with its own write queue, stream state and
+# telemetry. Nothing here imports Kivy or a Bluetooth stack: DemoApp in
+# main.py drives the pool from the UI and shows what it reports through the
+# PoolListener methods, and tools drive it headless over the loopback
+# transport.
+
+import random
+
+from commands import (OP_SET_MONTAGE, OP_OFF, EFFECT_CROSSFADE, MONTAGE_IDS, COLOR_RGB,
+                      encode_command, encode_animation, encode_layers)
+from streaming import FrameStreamer
+from telemetry import TELEMETRY_UUID, decode_telemetry, format_telemetry
+from transport import GATT_SUCCESS, DEFAULT_MTU
+
+# Finding the board. The last board connected to is reconnected by address;
+# if it does not answer, a scan filtered on SERVICE_UUID looks for any board.
+CACHED_CONNECT_TIMEOUT_S = 5  # falls back to a scan if the cached board has not linked by then
+SCAN_TIMEOUT_S = 10  # a scan that finds nothing gives up after this long
+SCAN_SETTLE_S = 1.0  # after the first board is found, wait this long for a stronger one
+SCAN_RETRY_S = 2  # first wait before looking for boards again; backs off from there
+RECONNECT_BASE_S = 0.2  # first reconnect after a drop comes within this long
+RECONNECT_MAX_S = 30  # longest wait between reconnect attempts
+RECONNECT_ATTEMPTS = 6  # failed reconnects before a board is given up
+BROADCAST_SCAN_S = 3  # in broadcast mode, scan this long to find every board in range
+
+
+# Android allows only one outstanding characteristic write, so writes are
+# issued one at a time and the next one waits for the link's on_write ack.
+# Every montage command carries the full display state, so a command that is
+# still waiting is replaced by a newer one (latest wins) instead of queueing.
+# Stream chunks are submitted with coalesce=False and always go out in order.
+# A write can carry a metrics.Trace, which is marked when the write is issued
+# ("write", then "written" once the transport accepted or refused it) and
+# acked ("ack").
+class GattWriteQueue:
+    def __init__(self, write, clock, timeout=1.0, max_retries=2):
+        self.write = write  # write(payload) -> True if the transport accepted the write
+        self.clock = clock
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.in_flight = None  # (payload, label, coalesce, trace) waiting for its ack
+        self.pending = []      # (payload, label, coalesce, trace) not yet written, oldest first
+        self.retries = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._timeout_event = None
+
+    def submit(self, payload, label="", coalesce=True, trace=None):
+        entry = (payload, label, coalesce, trace)
+        if self.in_flight is None:
+            self._start(entry)
+            return
+
+        if coalesce:
+            for waiting in [e for e in self.pending if e[2]]:
+                print(f"Coalesced: {waiting[1]} superseded by {label}")
+                self.pending.remove(waiting)
+                self.coalesced += 1
+                self._cancel_trace(waiting, "coalesced")
+        self.pending.append(entry)
+
+    # Writes queued behind the one in flight
+    def waiting_count(self):
+        return len(self.pending)
+
+    # Ack from the link's on_write for the write in flight
+    def on_write_complete(self, status):
+        if self.in_flight is None:
+            return
+        self._cancel_timeout()
+
+        if status == GATT_SUCCESS:
+            if self.in_flight[2]:
+                print(f"Write acked: {self.in_flight[1]}")
+            trace = self.in_flight[3]
+            if trace is not None:
+                trace.mark("ack")
+                trace.finish()
+            self.in_flight = None
+            self._start_next()
+        else:
+            print(f"Write failed with status {status}: {self.in_flight[1]}")
+            self._retry()
+
+    # Forgets everything, e.g. after the link dropped
+    def clear(self):
+        self._cancel_timeout()
+        if self.in_flight is not None:
+            self._cancel_trace(self.in_flight, "cleared")
+        for entry in self.pending:
+            self._cancel_trace(entry, "cleared")
+        self.in_flight = None
+        self.pending = []
+        self.retries = 0
+
+    def _start(self, entry):
+        self.in_flight = entry
+        self.retries = 0
+        self._send()
+
+    def _start_next(self):
+        if self.pending:
+            self._start(self.pending.pop(0))
+
+    def _send(self):
+        payload, label, coalesce, trace = self.in_flight
+        if trace is not None:
+            trace.mark("write")
+        try:
+            accepted = self.write(payload)
+        except Exception as e:
+            print(f"Failed to send command: {e}")
+            accepted = False
+        if trace is not None:
+            trace.mark("written")
+        if not accepted:
+            print(f"Write not accepted: {label}")
+        # A rejected write is retried when the timeout fires
+        self._timeout_event = self.clock.schedule_once(self._on_timeout, self.timeout)
+
+    def _on_timeout(self, dt):
+        self._timeout_event = None
+        print(f"Write timed out: {self.in_flight[1]}")
+        self._retry()
+
+    def _retry(self):
+        # A newer command makes a failed montage command irrelevant
+        if self.in_flight[2] and any(e[2] for e in self.pending):
+            self._cancel_trace(self.in_flight, "superseded")
+            self.in_flight = None
+            self._start_next()
+        elif self.retries < self.max_retries:
+            self.retries += 1
+            self._send()
+        else:
+            print(f"Giving up on: {self.in_flight[1]}")
+            self.failed += 1
+            self._cancel_trace(self.in_flight, "failed")
+            # The board cannot rebuild a frame with a chunk missing, so the
+            # rest of it is dropped too; FrameStreamer sends a keyframe next
+            if not self.in_flight[2]:
+                label = self.in_flight[1]
+                for entry in [e for e in self.pending if not e[2] and e[1] == label]:
+                    self.pending.remove(entry)
+                    self._cancel_trace(entry, "failed")
+            self.in_flight = None
+            self._start_next()
+
+    @staticmethod
+    def _cancel_trace(entry, reason):
+        if entry[3] is not None:
+            entry[3].cancel(reason)
+
+    def _cancel_timeout(self):
+        if self._timeout_event is not None:
+            self._timeout_event.cancel()
+            self._timeout_event = None
+
+
+# Jittered exponential backoff: a random delay between half the base and
+# base * 2^attempt, capped, so boards that dropped together do not all
+# retry at the same moment
+def backoff_delay(attempt, base=RECONNECT_BASE_S, cap=RECONNECT_MAX_S):
+    return random.uniform(base / 2, min(cap, base * 2 ** attempt))
+
+
+# One connection to a brain model, with its own write queue, stream state
+# and telemetry. BoardPool keeps one per board in `boards`, so a slow or lost
+# board never holds up the others. Events from the board's Link arrive here.
+#
+#   IDLE        no link
+#   CONNECTING  waiting for the link; gives up after the connect timeout
+#   LINKED      MTU, service discovery and the telemetry subscription
+#   READY       commands can be sent
+#   BACKOFF     the link dropped; waiting to reconnect
+#
+# A dropped link is brought back with Link.reconnect(), which reuses the
+# services found before where the transport can. After RECONNECT_ATTEMPTS
+# failed reconnects, or if a first connect never links, the board closes
+# and BoardPool.on_board_lost() decides what to do next. On every READY,
+# BoardPool.on_board_ready() resends the current selection.
+class BoardConnection:
+    IDLE = "idle"
+    CONNECTING = "connecting"
+    LINKED = "linked"
+    READY = "ready"
+    BACKOFF = "backoff"
+
+    def __init__(self, pool, address):
+        self.pool = pool
+        self.clock = pool.clock
+        self.address = address
+        self.link = pool.transport.link(address, self)
+        self.label = self.link.label  # short name for logs, metrics and the UI
+        self.state = BoardConnection.IDLE
+        self.write_queue = GattWriteQueue(self.write, pool.clock)
+        self.mtu = DEFAULT_MTU  # until the link negotiates a larger one
+        self.streamer = FrameStreamer(self.write_queue)
+        self.telemetry = None  # last report from the board, a telemetry.Telemetry
+        self.telemetry_log_interval = 10  # print every Nth report
+        self.telemetry_count = 0
+        self.connect_trace = None  # connection setup phases, until READY
+        self.connect_timeout = None  # gives up on a link that does not come up
+        self.reconnect_event = None
+        self.attempts = 0  # failed reconnects since the link dropped
+        self.ever_ready = False  # this link has been READY at least once
+        self.status = "Disconnected"
+
+    @property
+    def ready(self):
+        return self.state == BoardConnection.READY
+
+    # Starts a new connection; gives up after `timeout` seconds without a link
+    def connect(self, timeout=None):
+        self.close()
+        self.start_trace("connect")
+        self.attempts = 0
+        self.ever_ready = False
+        self.state = BoardConnection.CONNECTING
+        self.link.connect()
+        if timeout is not None:
+            self.connect_timeout = self.clock.schedule_once(lambda dt: self.on_connect_timeout(), timeout)
+
+        entry = self.pool.registry.get(self.address)
+        print(f"Connecting to {self.address} ({entry and entry['name']})")
+        self.set_status("Connecting...")
+        self.pool.listener.pool_connecting()
+
+    # Reconnects after a drop, reusing the services found before
+    def reconnect(self):
+        self.reconnect_event = None
+        self.state = BoardConnection.CONNECTING
+        print(f"{self.label}: reconnecting (attempt {self.attempts + 1})")
+        if not self.link.reconnect():
+            self.link_lost()
+            return
+        self.connect_timeout = self.clock.schedule_once(lambda dt: self.on_connect_timeout(), CACHED_CONNECT_TIMEOUT_S)
+
+    # Drops the connection without waiting for the transport to report it
+    def close(self):
+        self.cancel_connect_timeout()
+        if self.reconnect_event is not None:
+            self.reconnect_event.cancel()
+            self.reconnect_event = None
+        self.link.close()
+        if self.connect_trace is not None:
+            self.connect_trace.cancel("closed")
+            self.connect_trace = None
+        self.state = BoardConnection.IDLE
+        self.reset_link()
+
+    # Forgets what only lasts as long as one link
+    def reset_link(self):
+        self.telemetry = None
+        self.write_queue.clear()
+        self.mtu = DEFAULT_MTU
+        self.streamer.mtu = DEFAULT_MTU
+        self.streamer.reset()
+
+    def set_status(self, status):
+        self.status = status
+        self.pool.update_status()
+
+    def start_trace(self, prefix):
+        if self.connect_trace is not None:
+            self.connect_trace.cancel("retried")
+        self.connect_trace = self.pool.metrics.trace(prefix)
+
+    # The link did not come up in time, so the board is probably out of range
+    def on_connect_timeout(self):
+        self.connect_timeout = None
+        print(f"No answer from {self.address}")
+        self.link.disconnect()  # cancels the pending connect
+        self.link_lost()
+
+    def cancel_connect_timeout(self):
+        if self.connect_timeout is not None:
+            self.connect_timeout.cancel()
+            self.connect_timeout = None
+
+    # The link dropped or did not come up: back off and reconnect, or give up
+    def link_lost(self):
+        self.cancel_connect_timeout()
+        was_ready = self.state == BoardConnection.READY
+        self.reset_link()
+
+        # A first connect that never linked may be a board that moved or was
+        # swapped; a board that was ready before is worth a few retries
+        if not self.ever_ready:
+            self.give_up("Not Found")
+            return
+        if was_ready:
+            self.attempts = 0
+            self.start_trace("reconnect")  # from the drop to READY again
+        else:
+            self.attempts += 1
+        if self.attempts >= RECONNECT_ATTEMPTS:
+            self.give_up("Disconnected")
+            return
+
+        delay = backoff_delay(self.attempts)
+        print(f"{self.label}: reconnecting in {delay:.2f} s")
+        self.state = BoardConnection.BACKOFF
+        self.reconnect_event = self.clock.schedule_once(lambda dt: self.reconnect(), delay)
+        self.set_status("Reconnecting...")
+
+    def give_up(self, status):
+        if self.connect_trace is not None:
+            self.connect_trace.cancel("gave_up")
+            self.connect_trace = None
+        self.close()
+        self.set_status(status)
+        self.pool.on_board_lost(self)
+
+    # Called on the main thread whenever the link goes up or down
+    def on_link(self, connected, status):
+        if connected:
+            # The link reports the MTU and looks up the services itself
+            print(f"{self.label}: device connected.")
+            self.mark_connect_phase("link")
+            self.cancel_connect_timeout()
+            self.state = BoardConnection.LINKED
+            self.pool.registry.connected(self.address)
+            self.set_status("Connected")
+        else:
+            print(f"{self.label}: device disconnected! (status {status})")
+            if self.state in (BoardConnection.IDLE, BoardConnection.BACKOFF):
+                return  # already handled, e.g. after a connect timeout
+            self.link_lost()
+
+    # Called on the main thread with the MTU negotiated after connecting
+    def on_mtu(self, mtu, status):
+        if status == GATT_SUCCESS:
+            self.mtu = mtu
+            self.streamer.mtu = mtu
+            print(f"{self.label}: MTU negotiated: {mtu}")
+            self.mark_connect_phase("mtu")
+        else:
+            print(f"{self.label}: MTU request failed with status {status}, staying at {self.mtu}")
+
+    # Called on the main thread once the link has found the command
+    # characteristic, or failed to. A link that had to look the services up
+    # again while READY goes through the subscription again.
+    def on_services(self, status):
+        if self.state not in (BoardConnection.LINKED, BoardConnection.READY):
+            return
+        self.mark_connect_phase("discovery")
+        if status != GATT_SUCCESS:
+            self.set_status("Discovery Failed")
+            return
+        self.state = BoardConnection.LINKED
+        # Commands wait until the telemetry subscription has gone out, since
+        # Android runs one GATT operation at a time
+        if not self.link.subscribe():
+            self.set_ready()
+
+    # Called on the main thread once the telemetry subscription was written
+    def on_subscribed(self, status):
+        if self.state != BoardConnection.LINKED:
+            return
+        if status == GATT_SUCCESS:
+            print(f"{self.label}: subscribed to telemetry")
+        else:
+            print(f"{self.label}: telemetry subscription failed with status {status}")
+        self.mark_connect_phase("subscribe")
+        self.set_ready()
+
+    # Connection setup is complete; commands can be sent
+    def set_ready(self):
+        self.state = BoardConnection.READY
+        self.attempts = 0
+        self.ever_ready = True
+        if self.connect_trace is not None:
+            self.connect_trace.finish()
+            self.connect_trace = None
+        self.set_status("Ready")
+        self.pool.on_board_ready(self)
+
+    def mark_connect_phase(self, phase):
+        if self.connect_trace is not None:
+            self.connect_trace.mark(phase)
+
+    # Called on the main thread for every notification
+    def on_notify(self, uuid, value):
+        if uuid.lower() != TELEMETRY_UUID:
+            return
+        report = decode_telemetry(value)
+        if report is None:
+            print(f"{self.label}: unknown telemetry format: {value.hex()}")
+            return
+        previous = self.telemetry
+        self.telemetry = report
+        # Periodic reports repeat the last command; only new ones are sampled
+        if previous is None or (report.opcode, report.seq) != (previous.opcode, previous.seq):
+            metrics = self.pool.metrics
+            metrics.record("board.decode", report.decode_us / 1000)
+            metrics.record("board.render", report.render_us / 1000)
+            metrics.record("board.write", report.write_us / 1000)
+        text = format_telemetry(report)
+        self.pool.show_telemetry(self, text)
+        self.telemetry_count += 1
+        # Losses on the board are always worth a log line
+        lost = previous is not None and (report.dropped != previous.dropped
+                                         or report.stale != previous.stale
+                                         or report.stream_dropped != previous.stream_dropped)
+        if lost or self.telemetry_count % self.telemetry_log_interval == 1:
+            print(f"Telemetry {self.label}: {text}")
+
+    # Starts one write to the command characteristic; only GattWriteQueue
+    # calls this
+    def write(self, payload):
+        if self.state != BoardConnection.READY:
+            return False
+        return self.link.write(payload)
+
+    # Called on the main thread when a write has completed
+    def on_write(self, status):
+        self.write_queue.on_write_complete(status)
+
+
+# What a BoardPool reports to whoever drives it. DemoApp implements these to
+# update the UI; the defaults ignore everything, for headless runs that only
+# read the metrics.
+class PoolListener:
+    # Status bar text
+    def pool_status(self, text):
+        pass
+
+    # True while at least one board is ready
+    def pool_connected(self, connected):
+        pass
+
+    def pool_telemetry(self, text):
+        pass
+
+    # Per-board status of the last broadcast; "" when there is nothing to show
+    def pool_delivery(self, text):
+        pass
+
+    # A connection attempt has started
+    def pool_connecting(self):
+        pass
+
+
+# The boards the app talks to and the command pipeline in front of them:
+# finding boards, reconnecting, encoding montage commands and sending them to
+# one board or, in broadcast mode, to all of them
+class BoardPool:
+    def __init__(self, transport, registry, metrics, listener=None):
+        self.transport = transport
+        self.clock = transport.clock
+        self.registry = registry  # registry.DeviceRegistry
+        self.metrics = metrics
+        self.listener = listener or PoolListener()
+        self.boards = {}  # address -> BoardConnection
+        self.broadcast = False  # send commands to every connected board
+        self.delivery = None  # address -> delivery status of the last broadcast
+        self.scan_next = False  # skip the cached board on the next attempt
+        self.scanning = False
+        self.scan_results = {}  # address -> RSSI, for the current scan
+        self.scan_events = []  # timeout and settle callbacks of the current scan
+        self.scan_trace = None
+        self.connect_event = None  # pending retry of connect()
+        self.connect_attempts = 0  # retries since a board was last ready
+        # (command, color) lit on the boards, resent to every board that
+        # becomes ready; for layers, (list of (command, color), overlap color)
+        self.selection = None
+        self.brightness = 255
+        self.sequence = 0
+        self.recorder = None  # session.SessionRecorder for every command sent, if set
+
+        # Set to False to talk to firmware that only understands "montage color" text
+        self.use_binary_protocol = True
+
+        # Montage switches fade in over this many ms; 0 switches instantly
+        self.switch_fade_ms = 0
+
+    # Connects to the ESP32: directly to the board last connected to, or to
+    # the board a scan finds
+    def connect(self):
+        if self.connect_event is not None:
+            self.connect_event.cancel()
+            self.connect_event = None
+
+        status = self.transport.check()
+        if status is not None:
+            self.listener.pool_status(status)
+            return
+
+        try:
+            if self.broadcast:
+                # Every board this phone has used, plus any new ones in range
+                for address in self.registry.known():
+                    self.connect_board(address, CACHED_CONNECT_TIMEOUT_S)
+                self.start_scan()
+                return
+
+            address = self.registry.preferred()
+            if address is None or self.scan_next:
+                self.start_scan()
+                return
+            self.connect_board(address, CACHED_CONNECT_TIMEOUT_S)
+            self.drop_boards(keep=address)
+
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            self.listener.pool_status("Connection Failed")
+
+    # Starts connecting to `address` unless that board is already connected
+    # or connecting
+    def connect_board(self, address, timeout=None):
+        board = self.boards.get(address)
+        if board is None:
+            board = self.boards[address] = BoardConnection(self, address)
+        if board.state == BoardConnection.IDLE:
+            board.connect(timeout)
+
+    # Closes every board but `keep`, when leaving broadcast mode or after
+    # switching to another board
+    def drop_boards(self, keep=None):
+        for address in [a for a in self.boards if a != keep]:
+            self.boards.pop(address).close()
+        self.update_status()
+
+    # Called when a board gave up: it never linked, or stopped answering
+    # after a drop. It may have moved or been swapped, so look for boards
+    # instead of trying this one again.
+    def on_board_lost(self, board):
+        if self.boards.get(board.address) is not board:
+            return  # already dropped
+        del self.boards[board.address]
+        self.scan_next = True
+        self.update_status()
+        self.schedule_connect()
+
+    # Called whenever a board becomes ready, after a first connect or a
+    # reconnect: the board may have been reset or dark while the link was
+    # down, so it gets the current selection again
+    def on_board_ready(self, board):
+        self.connect_attempts = 0
+        if self.selection is None:
+            return
+        payload, label = self.command_payload(*self.selection)
+        print(f"{board.label}: resending {label}")
+        board.write_queue.submit(payload, label, trace=self.metrics.trace("resync"))
+
+    # Retries connect() with jittered exponential backoff, once per failed
+    # attempt; a board becoming ready resets it
+    def schedule_connect(self):
+        if self.connect_event is not None:
+            self.connect_event.cancel()
+        delay = backoff_delay(self.connect_attempts, base=SCAN_RETRY_S)
+        self.connect_attempts += 1
+        print(f"Looking for boards again in {delay:.1f} s")
+        self.connect_event = self.clock.schedule_once(lambda dt: self.connect(), delay)
+
+    # Status bar text and connected flag for all boards together
+    def update_status(self):
+        ready = [board for board in self.boards.values() if board.ready]
+        self.listener.pool_connected(bool(ready))
+        if len(self.boards) == 1:
+            self.listener.pool_status(next(iter(self.boards.values())).status)
+        elif self.boards:
+            self.listener.pool_status(f"Ready ({len(ready)} of {len(self.boards)} boards)")
+        if not self.boards or not self.broadcast:
+            self.listener.pool_delivery("")
+
+    def show_telemetry(self, board, text):
+        self.listener.pool_telemetry(f"{board.label}: {text}" if len(self.boards) > 1 else text)
+
+    # Switches broadcast mode: on connects to every board it can find, off
+    # keeps only the first ready board
+    def set_broadcast(self, active):
+        if active == self.broadcast:
+            return
+        self.broadcast = active
+        self.delivery = None
+        print(f"Broadcast {'on' if active else 'off'}")
+        if active:
+            self.scan_next = False
+            self.connect()
+            return
+        ready = [board.address for board in self.boards.values() if board.ready]
+        self.drop_boards(keep=ready[0] if ready else self.registry.preferred())
+
+    # Scans for boards advertising SERVICE_UUID, for at most SCAN_TIMEOUT_S
+    def start_scan(self):
+        if self.scanning:
+            return
+        if not self.transport.start_scan(self):
+            self.listener.pool_status("Bluetooth Off")
+            return
+        self.scanning = True
+        self.scan_results = {}
+        self.scan_trace = self.metrics.trace("scan")
+        timeout = BROADCAST_SCAN_S if self.broadcast else SCAN_TIMEOUT_S
+        self.scan_events = [self.clock.schedule_once(lambda dt: self.finish_scan(), timeout)]
+        print("Scanning for boards")
+        if not self.boards:
+            self.listener.pool_status("Scanning...")
+
+    # Called on the main thread for every board the scan sees
+    def on_scan_result(self, address, name, rssi):
+        if not self.scanning:
+            return
+        self.registry.seen(address, name, rssi)
+        first = not self.scan_results
+        self.scan_results[address.upper()] = rssi
+        if self.broadcast:
+            return  # collects every board until the scan times out
+        if address.upper() == self.registry.preferred():
+            self.finish_scan(address)  # the usual board is back; no need to compare
+        elif first:
+            self.scan_events.append(self.clock.schedule_once(lambda dt: self.finish_scan(), SCAN_SETTLE_S))
+
+    def on_scan_failed(self, error_code):
+        if not self.scanning:
+            return
+        print(f"Scan failed with error {error_code}")
+        self.stop_scan()
+        if self.scan_trace is not None:
+            self.scan_trace.cancel("failed")
+        self.listener.pool_status("Scan Failed")
+        self.schedule_connect()
+
+    def stop_scan(self):
+        for event in self.scan_events:
+            event.cancel()
+        self.scan_events = []
+        if self.scanning:
+            self.transport.stop_scan()
+            self.scanning = False
+
+    # Ends the scan and connects to `address`, or to the strongest board
+    # seen; in broadcast mode, to every board seen
+    def finish_scan(self, address=None):
+        if not self.scanning:
+            return
+        self.stop_scan()
+        self.registry.save()
+        if self.broadcast:
+            addresses = list(self.scan_results)
+        elif address is not None:
+            addresses = [address]
+        elif self.scan_results:
+            addresses = [max(self.scan_results, key=self.scan_results.get)]
+        else:
+            addresses = []
+        if not addresses:
+            print("No board found")
+            self.scan_trace.cancel("timeout")
+            if not self.boards:
+                self.listener.pool_status("No Board Found")
+                self.schedule_connect()
+            return
+
+        self.scan_trace.mark("found")
+        self.scan_trace.finish()
+        self.scan_next = False
+        try:
+            for address in addresses:
+                self.connect_board(address)
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            self.listener.pool_status("Connection Failed")
+        if not self.broadcast:
+            self.drop_boards(keep=addresses[0])
+
+    # Sends a montage command ("off" or a MONTAGE_IDS name) in `color`, a
+    # palette name or an (r, g, b) tuple. `trace` times the command from the
+    # tap that caused it; commands that do not come from a tap start their
+    # own. Returns False if no board was ready.
+    def send(self, command, color, trace=None):
+        self.selection = None if command == "off" else (command, color)
+        return self.submit(command, color, trace)
+
+    # Lights several montages at once: `layers` is a list of (command,
+    # color), lowest priority first, so later layers win where montages
+    # overlap. LEDs two or more layers share are shown in `overlap`, a
+    # palette name or (r, g, b), when it is set. Returns False if no board
+    # was ready.
+    def send_layers(self, layers, overlap=None, trace=None):
+        layers = [(command, color) for command, color in layers if command != "off"]
+        if len(layers) < 2:
+            command, color = layers[0] if layers else ("off", overlap or "blue")
+            return self.send(command, color, trace)
+        self.selection = (layers, overlap)
+        return self.submit(layers, overlap, trace)
+
+    # Sends a montage command, or layers, to the ready boards
+    def submit(self, command, color, trace):
+        if trace is None:
+            trace = self.metrics.trace("cmd")
+        trace.mark("send")
+        if self.recorder is not None:
+            self.recorder.record(self.clock.get_time(), command, color)
+        boards = [board for board in self.boards.values() if board.ready]
+        if not boards:
+            print("Not connected - command not sent")
+            trace.cancel("not_connected")
+            return False
+
+        payload, label = self.command_payload(command, color)
+        if not self.broadcast:
+            boards = boards[:1]
+        # The firmware forgets the stream frame it showed when a command
+        # replaces it, so the next frame to a board has to be a keyframe
+        for board in boards:
+            board.streamer.reset()
+        if self.broadcast:
+            self.broadcast_command(boards, payload, label, trace)
+        else:
+            boards[0].write_queue.submit(payload, label, trace=trace)
+        return True
+
+    # Payload and log label for `command` in `color`, or for a list of
+    # layers and their overlap color
+    def command_payload(self, command, color):
+        if isinstance(command, list):
+            return self.layers_payload(command, color)
+        if self.use_binary_protocol:
+            payload = self.encode_montage_command(command, color)
+        else:
+            payload = f"{command} {color}".encode('utf-8')
+        return payload, f"{command} {color}"
+
+    # Sends one command to every board at once. Each board's write queue
+    # paces its own writes, so a slow board only delays itself. Every board
+    # gets a "bcast.<board>" trace whose total is its delivery latency; the
+    # command's own trace finishes once the last board has acked or failed.
+    def broadcast_command(self, boards, payload, label, trace):
+        delivery = {board.address: "sending" for board in boards}
+        self.delivery = delivery
+        acked = []
+
+        def on_delivered(board, board_trace, reason):
+            acked.append(reason is None)
+            delivery[board.address] = f"{board_trace.total_ms:.0f} ms" if reason is None else reason
+            if len(acked) == len(boards):
+                if any(acked):
+                    trace.finish()
+                else:
+                    trace.cancel("undelivered")
+                print(f"Broadcast {label}: {acked.count(True)} of {len(boards)} boards")
+            if self.delivery is delivery:
+                self.show_delivery()
+
+        for board in boards:
+            board_trace = self.metrics.trace(
+                f"bcast.{board.label}",
+                lambda board_trace, reason, board=board: on_delivered(board, board_trace, reason))
+            board.write_queue.submit(payload, label, trace=board_trace)
+        self.show_delivery()
+
+    # Per-board status of the last broadcast
+    def show_delivery(self):
+        self.listener.pool_delivery("  ".join(
+            f"{self.boards[address].label if address in self.boards else address}: {status}"
+            for address, status in sorted(self.delivery.items())))
+
+    # Streams one raw frame: a bytes-like object per strip in GRB order, to
+    # the connected board or, in broadcast mode, to every ready board. Each
+    # board skips frames while its own link is busy. Returns False if no
+    # board took the frame.
+    def stream_frame(self, frame, keyframe=False):
+        any_sent = False
+        for board in self.boards.values():
+            if not board.ready:
+                continue
+            streamer = board.streamer
+            sent = streamer.send_frame(frame, keyframe)
+            if sent and streamer.frames_sent % 100 == 0:
+                stats = streamer.stats()
+                print(f"Streaming {board.label}: {stats['fps']:.1f} fps, "
+                      f"{stats['bytes_per_frame']:.0f} bytes/frame, {stats['skipped']} skipped")
+            any_sent = any_sent or sent
+        return any_sent
+
+    # Layers go out as one OP_LAYERS frame, priorities in list order. Firmware
+    # that only understands text gets the top layer.
+    def layers_payload(self, layers, overlap):
+        label = " + ".join(f"{command} {color}" for command, color in layers)
+        if not self.use_binary_protocol:
+            command, color = layers[-1]
+            return f"{command} {color}".encode('utf-8'), label
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        payload = encode_layers(
+            [(MONTAGE_IDS[command], self.rgb(color), priority) for priority, (command, color) in enumerate(layers)],
+            self.rgb(overlap) if overlap else (0, 0, 0), self.brightness, self.sequence)
+        if overlap:
+            label += f", shared in {overlap}"
+        return payload, label
+
+    # (r, g, b) for a palette name or an (r, g, b) tuple
+    def rgb(self, color):
+        return COLOR_RGB.get(color, COLOR_RGB["blue"]) if isinstance(color, str) else color
+
+    # Builds the binary frame for a montage command and a color name or (r, g, b) tuple
+    def encode_montage_command(self, command, color):
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        if command == "off":
+            return encode_command(OP_OFF, seq=self.sequence)
+        rgb = self.rgb(color)
+        if self.switch_fade_ms:
+            return encode_animation(EFFECT_CROSSFADE, MONTAGE_IDS[command], rgb, self.switch_fade_ms,
+                                    self.brightness, self.sequence)
+        return encode_command(OP_SET_MONTAGE, MONTAGE_IDS[command], rgb,
+                              self.brightness, self.sequence)
+
+    # Stops scanning and closes every board, e.g. when the app stops
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        self.stop_scan()
+        if self.connect_event is not None:
+            self.connect_event.cancel()
+            self.connect_event = None
+        for board in self.boards.values():
+            board.close()
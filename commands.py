@@ -0,0 +1,69 @@
+# Montage command protocol shared by the app, its transports and the tools
+#
+# Builds the binary frames MicroPythonScripts/ESP32_Script.py decodes. Kept
+# free of Kivy and of any Bluetooth stack, so the command pipeline can run
+# headless.
+
+import struct
+
+# Binary command frame, version 1. Must match the decoder in
+# MicroPythonScripts/ESP32_Script.py (process_command):
+# header, opcode, montage id, r, g, b, brightness, uint16 sequence number
+PROTOCOL_HEADER = 0xB1  # 0xB0 marker | protocol version 1
+OP_SET_MONTAGE = 0x01
+OP_OFF = 0x02
+OP_ANIMATE = 0x03  # command frame followed by ANIMATION_TAIL
+OP_LAYERS = 0x04  # command frame (layer count, overlap color) followed by a LAYER per layer
+COMMAND_FRAME = struct.Struct("<BBBBBBBH")
+ANIMATION_TAIL = struct.Struct("<BH")  # effect, period in ms
+LAYER = struct.Struct("<BBBBB")  # montage id, r, g, b, priority
+MAX_LAYERS = 9
+
+# Effects run by MicroPythonScripts/animator.py
+EFFECT_CROSSFADE = 1
+EFFECT_PULSE = 2
+EFFECT_PROPAGATE = 3
+
+# Montage ids: 1-based positions in MicroPythonScripts/montages.json
+MONTAGE_IDS = {
+    "off": 0,
+    "bipolar": 1,
+    "transverse": 2,
+    "hatband": 3,
+    "temporal": 4,
+    "cz_ref": 5,
+    "ear_ref": 6,
+    "large": 7,
+    "small": 8,
+    "eci": 9,
+}
+
+# RGB values sent for each palette color
+COLOR_RGB = {
+    "red": (75, 0, 0),
+    "blue": (0, 0, 75),
+    "green": (0, 75, 0),
+    "yellow": (75, 75, 0),
+    "white": (75, 75, 75),
+    "purple": (70, 0, 70),
+    "orange": (76, 85, 0),
+}
+
+# Packs one command into a binary frame
+def encode_command(opcode, montage_id=0, rgb=(0, 0, 0), brightness=255, seq=0):
+    r, g, b = rgb
+    return COMMAND_FRAME.pack(PROTOCOL_HEADER, opcode, montage_id, r, g, b, brightness, seq & 0xFFFF)
+
+# Packs an animation command: the montage is shown with `effect` over period_ms
+def encode_animation(effect, montage_id, rgb, period_ms, brightness=255, seq=0):
+    return (encode_command(OP_ANIMATE, montage_id, rgb, brightness, seq)
+            + ANIMATION_TAIL.pack(effect, min(period_ms, 0xFFFF)))
+
+# Packs layered montages: `layers` is a list of (montage_id, rgb, priority),
+# drawn lowest priority first. LEDs two or more layers share are shown in
+# `overlap_rgb` unless it is black.
+def encode_layers(layers, overlap_rgb=(0, 0, 0), brightness=255, seq=0):
+    if len(layers) > MAX_LAYERS:
+        raise ValueError(f"At most {MAX_LAYERS} layers, got {len(layers)}")
+    return (encode_command(OP_LAYERS, len(layers), overlap_rgb, brightness, seq)
+            + b"".join(LAYER.pack(montage_id, *rgb, priority) for montage_id, rgb, priority in layers))
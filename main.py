@@ -1,43 +1,72 @@
 # change on_toggle and send_command
 
+import os
+import threading
+import time
+
 from kivymd.app import MDApp
 from kivy.lang import Builder
 from kivy.clock import Clock
+from kivy.atlas import Atlas
+from kivy.utils import platform
 from kivymd.uix.screen import Screen
 from kivymd.uix.menu import MDDropdownMenu
 from kivy.properties import BooleanProperty, StringProperty
-from android.permissions import request_permissions, Permission, check_permission
-from jnius import autoclass, cast
 
-# BLE Constants
-BLE_ADDRESS = "70:B8:F6:67:64:A6" # MAC address of specific ESP32 being connected to. Change if switching microcontrollers
-CHAR_UUID = "9b7a6e35-cb8d-473b-9346-15507d362aa3"
-SERVICE_UUID = "3322271E-756A-443D-8A9D-2F90C7A73BF5"
+from boards import BoardPool
+from metrics import Metrics, now_ms
+from registry import DeviceRegistry
+from session import SessionRecorder
+from transport import TRANSPORT_ANDROID, TRANSPORT_DESKTOP, make_transport
+
+IMPORTED_MS = now_ms()  # fallback start time when the transport cannot report the process start
+
+# Bluetooth backend, see transport.py. Off Android it is bleak by default;
+# MONTAGE_TRANSPORT=loopback runs the app against simulated boards instead.
+APP_TRANSPORT = (TRANSPORT_ANDROID if platform == "android"
+                 else os.environ.get("MONTAGE_TRANSPORT", TRANSPORT_DESKTOP))
+
+DEVICE_REGISTRY = "devices.json"  # in the app's data directory, see registry.py
+
+# Set to True to record every command to session-<time>.jsonl in the app's
+# data directory, for replaying with benchmarks/soak.py --replay
+RECORD_SESSIONS = False
 
-# Java Classes  
-BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
-BluetoothDevice = autoclass('android.bluetooth.BluetoothDevice')
-BluetoothGatt = autoclass('android.bluetooth.BluetoothGatt')
-Context = autoclass('android.content.Context')
-UUID = autoclass('java.util.UUID')
-LocationManager = autoclass('android.location.LocationManager')
-PythonActivity = autoclass('org.kivy.android.PythonActivity')
-MyGattCallback = autoclass('org.montage.ble.MyGattCallback')
-BluetoothManager = autoclass('android.bluetooth.BluetoothManager')
-BluetoothProfile = autoclass('android.bluetooth.BluetoothProfile')
+# With multi-select on, LEDs shared by two or more of the selected montages
+# are shown in this color; None leaves them to the montage selected last
+LAYER_OVERLAP_COLOR = "white"
 
+# Montage card images, packed by tools/build_atlas.py
+CARD_ATLAS = "images/cards.atlas"
 
 
 class MainScreen(Screen):
     is_connected = BooleanProperty(False)
     status_text = StringProperty("Disconnected")
+    telemetry_text = StringProperty("")
+    delivery_text = StringProperty("")  # per-board result of the last broadcast
+
+
+# Latency histograms and CSV export; opened by tapping the status bar
+# DIAGNOSTICS_TAPS times in a row
+class DiagnosticsScreen(Screen):
+    summary_text = StringProperty("")
+    export_text = StringProperty("")
+
+DIAGNOSTICS_TAPS = 5
+DIAGNOSTICS_TAP_WINDOW = 3.0  # seconds for all of the taps
 
 class DemoApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.ble_client = None
-        self.characteristic = None
-        self.current_element = None
+        self.metrics = Metrics()
+        self.registry = None  # DeviceRegistry, loaded in build()
+        self.transport = None  # see transport.py, made in build()
+        self.pool = None  # BoardPool: the boards and the command pipeline
+        self.startup_marks = {"first_frame", "connecting"}  # not reached yet this launch
+        self.status_taps = []
+        self.active_elements = []  # selected cards, oldest first; more than one only in multi-select
+        self.multi_select = False
         self.menu = None
         self.color_map = {}
 
@@ -55,252 +84,187 @@ class DemoApp(MDApp):
             "ECI": "eci"
         }
 
+    # Startup work overlaps: the transport's worker thread prepares the
+    # Bluetooth stack, the permission request runs alongside the UI being
+    # built, and the connection starts as soon as permissions are granted
     def build(self):
+        self.registry = DeviceRegistry(os.path.join(self.user_data_dir, DEVICE_REGISTRY))
+        self.transport = make_transport(APP_TRANSPORT, Clock)
+        self.pool = BoardPool(self.transport, self.registry, self.metrics, self)
+        if RECORD_SESSIONS:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            self.pool.recorder = SessionRecorder(os.path.join(self.user_data_dir, f"session-{stamp}.jsonl"))
+        threading.Thread(target=self.transport.prepare, args=(self.registry.preferred(),),
+                         daemon=True).start()
+        self.transport.request_permissions(self.on_permissions)
+
+        # Load every card image (light and dark) as one GPU texture before the
+        # cards are built, so toggling a card only swaps texture regions
+        self.card_atlas = Atlas(CARD_ATLAS)
+        return Builder.load_file("ui.kv")
 
-        # Requests permissions and checks their status
-        def on_permissions_callback(permissions, grants):
-
-            print("Permissions callback executed")
-            for i, grant in enumerate(grants):
-                if not grant:
-                    print(f"Permission denied: {permissions[i]}")
-
-            if all(grants):
-                print("All permissions granted")
-                if self.is_location_enabled():
-                    Clock.schedule_once(lambda dt: self.connect_to_device(), 1)
-                else:
-                    print("Please enable location services manually.")
-                    self.get_main_screen().status_text = "Enable Location Services"
-            else:
-                print("Some permissions were denied")
-                self.get_main_screen().status_text = "Permission Denied"
+    def on_start(self):
+        # Runs on the next clock tick, after the first frame has been drawn
+        Clock.schedule_once(lambda dt: self.mark_startup("first_frame"))
 
-        request_permissions([
-            Permission.ACCESS_BACKGROUND_LOCATION,
-            Permission.ACCESS_FINE_LOCATION,
-            Permission.BLUETOOTH,
-            Permission.BLUETOOTH_ADMIN,
-        ], on_permissions_callback)
+    # Records the time from process start to a startup milestone, once
+    def mark_startup(self, name):
+        if name not in self.startup_marks:
+            return
+        self.startup_marks.discard(name)
+        ms = self.transport.process_age_ms()
+        if ms is None:
+            ms = now_ms() - IMPORTED_MS  # from import only: misses interpreter startup
+        self.metrics.record(f"startup.{name}", ms)
+        print(f"Startup: {name} after {ms:.0f} ms")
+
+    # Called on the main thread once the permission request was answered
+    def on_permissions(self, granted):
+        if granted:
+            self.pool.connect()
+        else:
+            self.get_main_screen().status_text = "Permission Denied"
 
-        return Builder.load_file("ui.kv")
+    # Texture region for a montage card: the dark variant while it is active
+    def card_texture(self, image_id, active):
+        if not image_id:
+            return None
+        return self.card_atlas.textures.get(f"{image_id}_dark" if active else image_id)
 
     # Displays the app interface
     def get_main_screen(self):
         return self.root.get_screen("main")
 
-    # Ensures location is enabled
-    def is_location_enabled(self):
-        try:
-            context = self.get_context()
-            location_manager = cast('android.location.LocationManager',
-                                    context.getSystemService(Context.LOCATION_SERVICE))
-            return (location_manager.isProviderEnabled(LocationManager.GPS_PROVIDER) or
-                    location_manager.isProviderEnabled(LocationManager.NETWORK_PROVIDER))
-        except Exception as e:
-            print(f"Location check failed: {e}")
-            return False
-
-    # Checks that all required permissions were granted
-    def check_permissions(self):
-        required = [
-            Permission.ACCESS_FINE_LOCATION,
-            Permission.BLUETOOTH,
-            Permission.BLUETOOTH_ADMIN,
-            Permission.ACCESS_BACKGROUND_LOCATION
-        ]
-        return all(check_permission(p) for p in required)
-
-    # Checks connectivity status 
-    def check_connection(self, dt):
-        try:
-            context = self.get_context()
-            manager = cast('android.bluetooth.BluetoothManager',
-                        context.getSystemService(Context.BLUETOOTH_SERVICE))
-            device = self.ble_client.getDevice()
-            state = manager.getConnectionState(device, BluetoothProfile.GATT)
-
-            if state == BluetoothProfile.STATE_CONNECTED:
-                print("Device connected.")
-                screen = self.get_main_screen()
-                screen.status_text = "Connected"
-                screen.is_connected = True
-
-                if not hasattr(self, '_services_discovered'):
-                    self.ble_client.discoverServices()
-                    self._services_discovered = True
-                    Clock.schedule_interval(self.poll_for_service, 1)
-
-                # Stop polling for initial connection
-                Clock.unschedule(self.check_connection)
-
-                # Start monitoring for reconnection
-                Clock.schedule_interval(self.monitor_connection, 5)
-
-        except Exception as e:
-            print(f"Connection check failed: {e}")
-
-    # Allows for reconnection after a disconnection
-    def monitor_connection(self, dt):
-        try:
-            context = self.get_context()
-            manager = cast('android.bluetooth.BluetoothManager',
-                        context.getSystemService(Context.BLUETOOTH_SERVICE))
-            device = self.ble_client.getDevice()
-            state = manager.getConnectionState(device, BluetoothProfile.GATT)
+    # What BoardPool reports, shown in and under the status bar
 
-            if state != BluetoothProfile.STATE_CONNECTED:
-                print("Device disconnected!")
+    def pool_status(self, text):
+        self.get_main_screen().status_text = text
 
-                screen = self.get_main_screen()
-                screen.status_text = "Disconnected"
-                screen.is_connected = False
+    def pool_connected(self, connected):
+        self.get_main_screen().is_connected = connected
 
-                # Stop monitoring connection
-                Clock.unschedule(self.monitor_connection)
+    def pool_telemetry(self, text):
+        self.get_main_screen().telemetry_text = text
 
-                # Clear service discovery flag
-                if hasattr(self, '_services_discovered'):
-                    del self._services_discovered
+    def pool_delivery(self, text):
+        self.get_main_screen().delivery_text = text
 
-                # Try reconnecting after delay
-                Clock.schedule_once(lambda dt: self.connect_to_device(), 2)
+    def pool_connecting(self):
+        self.mark_startup("connecting")
 
-        except Exception as e:
-            print(f"Monitor connection check failed: {e}")
-
-    # Searches for service to connect to 
-    def poll_for_service(self, dt):
+    # Counts taps on the status bar; enough of them in a row open the
+    # diagnostics screen
+    def on_status_touch(self, widget, touch):
+        if not widget.collide_point(*touch.pos):
+            return False
+        now = Clock.get_time()
+        self.status_taps = [t for t in self.status_taps if now - t < DIAGNOSTICS_TAP_WINDOW] + [now]
+        if len(self.status_taps) >= DIAGNOSTICS_TAPS:
+            self.status_taps = []
+            self.open_diagnostics()
+        return True
+
+    def open_diagnostics(self):
+        self.refresh_diagnostics()
+        self.root.current = "diagnostics"
+
+    def close_diagnostics(self):
+        self.root.current = "main"
+
+    def refresh_diagnostics(self):
+        screen = self.root.get_screen("diagnostics")
+        screen.summary_text = self.metrics.format_summary()
+
+    # Writes the summary and the raw samples to the app's data directory
+    def export_metrics(self):
+        screen = self.root.get_screen("diagnostics")
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        summary_path = os.path.join(self.user_data_dir, f"latency-{stamp}.csv")
+        samples_path = os.path.join(self.user_data_dir, f"latency-samples-{stamp}.csv")
         try:
-            service = self.ble_client.getService(UUID.fromString(SERVICE_UUID))
-            if service:
-                print("Service found!")
-                self.characteristic = service.getCharacteristic(UUID.fromString(CHAR_UUID))
-                
-                if self.characteristic:
-                    print("Characteristic set!")
-                    screen = self.get_main_screen()
-                    screen.status_text = "Ready"
-                    screen.is_connected = True
-                    Clock.unschedule(self.poll_for_service)
-                else:
-                    print("Characteristic not found - still polling...")
-            else:
-                print("Service not found - still polling...")
-        except Exception as e:
-            print(f"Service polling error: {e}")
-
-            # Continue polling unless too many failed attempts
-            if hasattr(self, '_poll_count'):
-                self._poll_count += 1
-                if self._poll_count > 10:  # Stops after 10 attempts
-                    Clock.unschedule(self.poll_for_service)
-                    self.get_main_screen().status_text = "Discovery Failed"
-            else:
-                self._poll_count = 1
-
-    # Connects the app to the ESP32
-    def connect_to_device(self):
-        screen = self.get_main_screen()
-
-        if not self.check_permissions():
-            screen.status_text = "Missing Permissions"
-            return
-
-        if not self.is_location_enabled():
-            screen.status_text = "Location Off"
+            self.metrics.export_csv(summary_path, samples_path)
+        except OSError as e:
+            print(f"Metrics export failed: {e}")
+            screen.export_text = f"Export failed: {e}"
             return
+        print(f"Metrics exported to {summary_path}")
+        screen.export_text = f"Saved {summary_path}"
 
-        try:
-            adapter = BluetoothAdapter.getDefaultAdapter()
-            if not adapter.isEnabled():
-                screen.status_text = "Bluetooth Off"
-                return
-
-            device = adapter.getRemoteDevice(BLE_ADDRESS)
-
-            # Disconnect previous GATT client if it exists
-            if self.ble_client is not None:
-                print("Closing old GATT connection before reconnecting...")
-                try:
-                    self.ble_client.disconnect()
-                    self.ble_client.close()
-                except Exception as e:
-                    print(f"Error closing GATT: {e}")
-                self.ble_client = None  # Clear the reference
-
-            self.gatt_callback = MyGattCallback()
-            self.ble_client = device.connectGatt(
-                self.get_context(),
-                False,
-                self.gatt_callback
-            )
-
-            screen.status_text = "Connecting..."
-            Clock.schedule_interval(self.check_connection, 1)
-
-        except Exception as e:
-            print(f"Connection failed: {e}")
-            screen.status_text = "Connection Failed"
+    def reset_metrics(self):
+        self.metrics.reset()
+        self.refresh_diagnostics()
 
     # Toggle card and send command when ElementCard is pressed 
     def on_toggle_press(self, element_card):
+        trace = self.metrics.trace("cmd")
         card_text = element_card.text.strip()
         command = self.command_map.get(card_text)
         if command is None:
             print(f"No command mapped for {card_text}")
+            trace.cancel("unmapped")
             return
 
-        # Ensure original image is stored the first time (so we can toggle back to it)
-        if not hasattr(element_card, "original_image_source"):
-            element_card.original_image_source = element_card.image_source
-
         if element_card.active:
             # Toggled Off
             print(f"OFF: {card_text}")
             element_card.active = False
 
-            # Switch back to light image
-            element_card.image_source = element_card.original_image_source
-
-            if self.current_element == element_card:
-                self.current_element = None
-            self.send_command("off", element_card)
+            if element_card in self.active_elements:
+                self.active_elements.remove(element_card)
+            if self.multi_select and self.active_elements:
+                self.send_layers(trace)
+            else:
+                self.send_command("off", element_card, trace)
         else:
             # Toggled on
             print(f"ON: {card_text}\nCommand: {command}")
-            if self.current_element and self.current_element != element_card:
-                self.current_element.active = False
-
-                # Reset the image of the previous card
-                if hasattr(self.current_element, "original_image_source"):
-                    self.current_element.image_source = self.current_element.original_image_source
+            if not self.multi_select:
+                for card in self.active_elements:
+                    card.active = False
+                self.active_elements = []
 
             element_card.active = True
-            self.current_element = element_card
-
-            # Switch to dark image
-            if hasattr(element_card, "dark_image_source"):
-                element_card.image_source = element_card.dark_image_source
-
-            self.send_command(command, element_card)
+            self.active_elements.append(element_card)
 
-    # Function to send command
-    def send_command(self, command, element_card):
-        screen = self.get_main_screen()
-        if not screen.is_connected:
-            print("Not connected - command not sent")
-            return
+            if self.multi_select:
+                self.send_layers(trace)
+            else:
+                self.send_command(command, element_card, trace)
 
+    # Function to send command. `trace` times the command from the tap that
+    # caused it; commands that do not come from a tap start their own.
+    def send_command(self, command, element_card, trace=None):
         selected_color = self.color_map.get(element_card.text, "blue")
-        full_command = f"{command} {selected_color}"
-
-        try:
-            self.characteristic.setValue(full_command.encode('utf-8'))
-            self.ble_client.writeCharacteristic(self.characteristic)
-            print(f"Sent: {full_command}")
-        except Exception as e:
-            print(f"Failed to send command: {e}")
+        self.pool.send(command, selected_color, trace)
+
+    # Sends every selected card as one layered command, the card selected
+    # last on top
+    def send_layers(self, trace=None):
+        layers = [(self.command_map[card.text.strip()], self.color_map.get(card.text, "blue"))
+                  for card in self.active_elements]
+        self.pool.send_layers(layers, LAYER_OVERLAP_COLOR, trace)
+
+    # Multi-select switch under the title: while it is on, a card adds its
+    # montage to the ones lit instead of replacing them
+    def set_multi_select(self, active):
+        self.multi_select = active
+        if active or len(self.active_elements) < 2:
+            return
+        # Back to one montage: keep the card selected last
+        for card in self.active_elements[:-1]:
+            card.active = False
+        card = self.active_elements[-1]
+        self.active_elements = [card]
+        self.send_command(self.command_map[card.text.strip()], card)
+
+    # Broadcast switch under the title
+    def set_broadcast(self, active):
+        self.pool.set_broadcast(active)
+
+    # Streams one raw frame: a bytes-like object per strip in GRB order.
+    # Returns False if no board took the frame; see BoardPool.stream_frame().
+    def stream_frame(self, frame, keyframe=False):
+        return self.pool.stream_frame(frame, keyframe)
 
     # Shows color selection from drop down
     def show_color_menu(self, instance, card):
@@ -324,16 +288,14 @@ class DemoApp(MDApp):
         print(f"Assigned color {color} to {card.text}")
         if card.active:
             command = self.command_map.get(card.text.strip())
-            if command:
+            if self.multi_select:
+                self.send_layers()
+            elif command:
                 self.send_command(command, card)
         self.menu.dismiss()
 
-    def get_context(self):
-        return PythonActivity.mActivity.getApplicationContext()
-
     def on_stop(self):
-        if hasattr(self, 'ble_client') and self.ble_client:
-            self.ble_client.disconnect()
+        self.pool.close()
 
 if __name__ == '__main__':
     DemoApp().run()
\ No newline at end of file
@@ -0,0 +1,152 @@
+# Latency metrics for the app
+#
+# Traces time the stages of a command (tap, send_command, the
+# writeCharacteristic call, the write ack) and of connection setup, and feed
+# the intervals into in-memory histograms. The hidden diagnostics screen shows
+# p50/p95/p99 per metric and exports everything as CSV.
+
+import csv
+import time
+from collections import deque
+
+MAX_SAMPLES = 1000  # per metric; percentiles cover the most recent samples
+
+
+def now_ms():
+    return time.perf_counter() * 1000
+
+
+class Histogram:
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, ms):
+        self.samples.append(ms)
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    # Nearest-rank percentile over the recent samples
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = max(1, -(-len(ordered) * p // 100))
+        return ordered[int(rank) - 1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min or 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max or 0.0,
+        }
+
+
+# `now` returns the current time in ms; traces in a headless run can follow
+# a virtual clock instead of the host's
+class Metrics:
+    def __init__(self, max_samples=MAX_SAMPLES, now=now_ms):
+        self.max_samples = max_samples
+        self.now = now
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, name, ms):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.max_samples)
+        histogram.record(ms)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def trace(self, prefix, on_close=None):
+        return Trace(self, prefix, on_close)
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+
+    # Fixed-width table for the diagnostics screen
+    def format_summary(self):
+        lines = [f"{'metric':<24}{'n':>6}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}"]
+        for name in sorted(self.histograms):
+            s = self.histograms[name].summary()
+            lines.append(f"{name:<24}{s['count']:>6}{s['p50']:>8.1f}{s['p95']:>8.1f}"
+                         f"{s['p99']:>8.1f}{s['max']:>8.1f}")
+        for name in sorted(self.counters):
+            lines.append(f"{name:<24}{self.counters[name]:>6}")
+        return "\n".join(lines)
+
+    # Writes one summary row per metric (times in ms) to `path`, and every
+    # recent sample to `samples_path` if given
+    def export_csv(self, path, samples_path=None):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["metric", "count", "mean_ms", "min_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            for name in sorted(self.histograms):
+                s = self.histograms[name].summary()
+                writer.writerow([name, s["count"]] + [f"{s[k]:.3f}" for k in
+                                                      ("mean", "min", "p50", "p95", "p99", "max")])
+            for name in sorted(self.counters):
+                writer.writerow([name, self.counters[name], "", "", "", "", "", ""])
+
+        if samples_path is not None:
+            with open(samples_path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["metric", "index", "ms"])
+                for name in sorted(self.histograms):
+                    for i, ms in enumerate(self.histograms[name].samples):
+                        writer.writerow([name, i, f"{ms:.3f}"])
+
+
+# Times one operation as a sequence of stages. mark(stage) records the time
+# since the previous stage as "<prefix>.<stage>"; a stage that is marked again
+# (a retried write) keeps its first time. finish() records the whole
+# operation as "<prefix>.total"; cancel() counts it as "<prefix>.<reason>".
+# on_close(trace, reason) is called once either happened, with reason None
+# after finish().
+class Trace:
+    def __init__(self, metrics, prefix, on_close=None):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.on_close = on_close
+        self.started = metrics.now()
+        self.last = self.started
+        self.stages = set()
+        self.closed = False
+        self.total_ms = None  # set by finish()
+
+    def mark(self, stage):
+        if self.closed or stage in self.stages:
+            return
+        now = self.metrics.now()
+        self.stages.add(stage)
+        self.metrics.record(f"{self.prefix}.{stage}", now - self.last)
+        self.last = now
+
+    def finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.total_ms = self.metrics.now() - self.started
+        self.metrics.record(f"{self.prefix}.total", self.total_ms)
+        if self.on_close is not None:
+            self.on_close(self, None)
+
+    def cancel(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        self.metrics.count(f"{self.prefix}.{reason}")
+        if self.on_close is not None:
+            self.on_close(self, reason)
@@ -0,0 +1,83 @@
+# Persistent registry of the brain models this app has seen
+#
+# Every board found by a scan is recorded with its name, last RSSI and when
+# it was last seen; the one the app last connected to is reconnected
+# directly by address on the next launch, without scanning. The registry is
+# a small JSON file in the app's data directory; with no path it only lives
+# in memory, for headless runs.
+
+import json
+import os
+import time
+
+REGISTRY_VERSION = 1
+
+
+class DeviceRegistry:
+    def __init__(self, path):
+        self.path = path
+        self.devices = {}  # address -> {"name", "rssi", "last_seen", "last_connected"}
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Device registry unreadable, starting empty: {e}")
+            return
+        if data.get("version") != REGISTRY_VERSION:
+            print(f"Ignoring device registry version {data.get('version')}")
+            return
+        self.devices = {address.upper(): entry for address, entry in data.get("devices", {}).items()}
+
+    # Written to a temporary file first, so a crash never leaves half a registry
+    def save(self):
+        if self.path is None:
+            return
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump({"version": REGISTRY_VERSION, "devices": self.devices}, f, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f"Could not save device registry: {e}")
+
+    # Records a scan result. Returns the device's entry.
+    def seen(self, address, name=None, rssi=None):
+        entry = self.devices.setdefault(address.upper(), {
+            "name": None, "rssi": None, "last_seen": 0, "last_connected": 0,
+        })
+        if name:
+            entry["name"] = name
+        if rssi is not None:
+            entry["rssi"] = rssi
+        entry["last_seen"] = time.time()
+        return entry
+
+    def connected(self, address):
+        self.seen(address)["last_connected"] = time.time()
+        self.save()
+
+    def forget(self, address):
+        if self.devices.pop(address.upper(), None) is not None:
+            self.save()
+
+    # Address of the board to reconnect to without scanning: the one
+    # connected most recently, or None if the app never connected
+    def preferred(self):
+        known = self.known()
+        return known[0] if known else None
+
+    # Every board the app has connected to, most recent first
+    def known(self):
+        connected = sorted((entry["last_connected"], address) for address, entry in self.devices.items()
+                           if entry.get("last_connected"))
+        return [address for _, address in reversed(connected)]
+
+    def get(self, address):
+        return self.devices.get(address.upper())
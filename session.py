@@ -0,0 +1,85 @@
+# Recorded command sessions
+#
+# A session is a JSON-lines file with one montage command per line, in the
+# order BoardPool.send() was called:
+#
+#   {"t": 12.504, "command": "bipolar", "color": "red"}
+#   {"t": 14.020, "layers": [["bipolar", "red"], ["hatband", "blue"]], "overlap": "white"}
+#
+# `t` is seconds since the first command; a color is a palette name or an
+# [r, g, b] list. Layers (BoardPool.send_layers()) are listed lowest
+# priority first, and `overlap` may be null. The app records one per launch when RECORD_SESSIONS is set
+# in main.py, and benchmarks/soak.py --replay plays them back against the
+# loopback transport.
+
+import json
+
+
+class SessionRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.started = None
+        self.count = 0
+        self.failed = False  # the file could not be opened; nothing is recorded
+
+    # Appends one command; every line is flushed, so a crash keeps the
+    # session up to the last command
+    def record(self, time, command, color):
+        if self.failed:
+            return
+        if self.file is None:
+            try:
+                self.file = open(self.path, "a")
+            except OSError as e:
+                print(f"Could not record session: {e}")
+                self.failed = True
+                return
+        if self.started is None:
+            self.started = time
+        entry = {"t": round(time - self.started, 4)}
+        if isinstance(command, list):
+            entry["layers"] = [[name, _json_color(layer_color)] for name, layer_color in command]
+            entry["overlap"] = _json_color(color)
+        else:
+            entry["command"] = command
+            entry["color"] = _json_color(color)
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _json_color(color):
+    return list(color) if isinstance(color, tuple) else color
+
+
+def _color(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+# Reads a session as a list of (t, command, color), oldest first. For
+# layers, `command` is a list of (command, color) and `color` the overlap
+# color, as BoardPool.send_layers() takes them.
+def load_session(path):
+    commands = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                if "layers" in entry:
+                    commands.append((float(entry["t"]),
+                                     [(name, _color(color)) for name, color in entry["layers"]],
+                                     _color(entry.get("overlap"))))
+                else:
+                    commands.append((float(entry["t"]), entry["command"], _color(entry.get("color", "blue"))))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path}:{number}: not a session line: {e}")
+    commands.sort(key=lambda entry: entry[0])
+    return commands
@@ -0,0 +1,9 @@
+# Host-side simulator for the ESP32 firmware in MicroPythonScripts/
+#
+# Supplies stand-ins for bluetooth, neopixel and machine so BLEPeripheral runs
+# unmodified under CPython, records every strip write, and lets scripts inject
+# BLE writes and button presses.
+
+from simulator.board import SimulatedBoard, StripWrite
+
+__all__ = ["SimulatedBoard", "StripWrite"]
@@ -0,0 +1,217 @@
+# Runs MicroPythonScripts/ESP32_Script.py unmodified under CPython
+#
+#   board = SimulatedBoard()
+#   board.connect()
+#   board.write(b"cz_ref blue")
+#   board.lit_pixels(0)        # pixels lit on strip 0 (GPIO21)
+#   board.writes[-1]           # StripWrite(time_us, strip, pin, pixels)
+#   board.advance(500)         # run timers (animations) for 500 ms of board time
+#
+# Every NeoPixel.write() is recorded with a timestamp from the board clock
+# and a copy of the strip buffer.
+
+import importlib.util
+import os
+import sys
+from collections import namedtuple
+
+from simulator import mocks
+
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "MicroPythonScripts")
+FIRMWARE_SCRIPT = os.path.join(FIRMWARE_DIR, "ESP32_Script.py")
+
+# BLE IRQ event codes used by the firmware
+IRQ_CENTRAL_CONNECT = 1
+IRQ_CENTRAL_DISCONNECT = 2
+IRQ_GATTS_WRITE = 3
+IRQ_MTU_EXCHANGED = 21
+
+BUTTON_PIN = 27
+RELAY_PIN = 12
+
+StripWrite = namedtuple("StripWrite", ("time_us", "strip", "pin", "pixels"))
+
+
+class SimulatedBoard:
+    def __init__(self, script=FIRMWARE_SCRIPT, time_source=None):
+        self.clock = mocks.SimClock(time_source)
+        self.scheduler = mocks.Scheduler(self.clock)
+        self.pins = {}
+        self.strips = []
+        self.timers = []
+        self.rmt_channels = {}
+        self.heap_size = 110000  # roughly what a non-SPIRAM ESP32 build leaves free
+        self.heap_free = 80000
+        self.writes = []
+        self.ble = None
+        self.conn_handle = 0
+        self.firmware = self._load(script)
+        self.peripheral = self.firmware.ble_peripheral
+
+    # Imports the script with this board's mock modules in sys.modules. The
+    # firmware's own helper modules (fwlog, ...) are imported fresh for every
+    # board and removed again afterwards, so boards never share their state.
+    def _load(self, script):
+        firmware_dir = os.path.dirname(os.path.abspath(script))
+        local_modules = [name[:-3] for name in os.listdir(firmware_dir) if name.endswith(".py")]
+        replaced = {
+            "bluetooth": mocks.make_bluetooth_module(self),
+            "machine": mocks.make_machine_module(self),
+            "neopixel": mocks.make_neopixel_module(self),
+            "esp32": mocks.make_esp32_module(self),
+            "gc": mocks.make_gc_module(self),
+            "micropython": mocks.make_micropython_module(),
+            "uasyncio": mocks.make_asyncio_module(self),
+            "time": mocks.make_time_module(self.clock),
+        }
+        saved = {name: sys.modules.get(name) for name in list(replaced) + local_modules}
+        for name in local_modules:
+            sys.modules.pop(name, None)
+        sys.modules.update(replaced)
+        sys.path.insert(0, firmware_dir)
+        try:
+            spec = importlib.util.spec_from_file_location("ESP32_Script", script)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(firmware_dir)
+            for name, previous in saved.items():
+                if previous is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = previous
+        return module
+
+    # Called by the NeoPixel mock
+    def register_strip(self, strip):
+        self.strips.append(strip)
+        return len(self.strips) - 1
+
+    def record_write(self, strip):
+        pin = getattr(strip.pin, "id", strip.pin)
+        self.writes.append(StripWrite(int(self.clock.seconds() * 1000000), strip.index, pin,
+                                      bytes(strip.buf)))
+
+    # Called by the RMT mock with the bytes decoded from a pulse train
+    def record_pixels(self, pin, pixels):
+        for strip in self.strips:
+            if strip.pin is pin:
+                self.writes.append(StripWrite(int(self.clock.seconds() * 1000000), strip.index,
+                                              getattr(pin, "id", pin), pixels))
+                return
+        raise ValueError("No strip on pin %r" % (pin,))
+
+    # BLE events, delivered the way the radio stack would call the IRQ handler
+
+    def connect(self, mtu=None):
+        self.conn_handle += 1
+        self.ble.handler(IRQ_CENTRAL_CONNECT, (self.conn_handle, 0, bytes(6)))
+        if mtu is not None:
+            self.ble.handler(IRQ_MTU_EXCHANGED, (self.conn_handle, mtu))
+        self.run_tasks()
+
+    def disconnect(self):
+        self.ble.handler(IRQ_CENTRAL_DISCONNECT, (self.conn_handle, 0, bytes(6)))
+        self.run_tasks()
+
+    # Writes a value to a characteristic (the command characteristic by
+    # default) and lets the firmware handle it. With run=False the write is
+    # only queued, as when several writes arrive back to back; run_tasks()
+    # then handles them.
+    def write(self, payload, handle=None, run=True):
+        if handle is None:
+            handle = self.peripheral.char_handle
+        self.ble.values[handle] = bytes(payload)
+        self.ble.handler(IRQ_GATTS_WRITE, (self.conn_handle, handle))
+        if run:
+            self.run_tasks()
+
+    # Button IRQs
+
+    def press_button(self):
+        self._set_button(1)
+
+    def release_button(self):
+        self._set_button(0)
+
+    def _set_button(self, value):
+        pin = self.pins[BUTTON_PIN]
+        pin.value(value)
+        if pin.handler is not None:
+            pin.handler(pin)
+        self.run_tasks()
+
+    def relay_on(self):
+        return self.pins[RELAY_PIN].value() == 1
+
+    # Lets the firmware's asyncio tasks run until they all wait again
+    def run_tasks(self):
+        self.scheduler.run_until(self.clock.seconds())
+
+    # Moves the board clock forward by `ms`, firing the timer callbacks and
+    # waking the sleeping tasks that fall due along the way, in order
+    def advance(self, ms):
+        end = self.clock.seconds() + ms / 1000
+        while True:
+            due = [t.due for t in self.timers if t.due is not None and t.due <= end]
+            task_due = self.scheduler.next_due()
+            if task_due is not None and task_due <= end:
+                due.append(task_due)
+            if not due:
+                break
+            now = min(due)
+            if now > self.clock.seconds():
+                self.clock.sleep(now - self.clock.seconds())
+            for timer in self.timers:
+                timer.fire(now)
+            self.scheduler.run_until(now)
+        if end > self.clock.seconds():
+            self.clock.sleep(end - self.clock.seconds())
+        self.run_tasks()
+
+    # Notifications sent on a characteristic (the telemetry one by default),
+    # as (time in seconds, value)
+    def notifications(self, handle=None):
+        if handle is None:
+            handle = self.peripheral.telemetry_handle
+        return [(t, value) for t, h, value in self.ble.notifications if h == handle]
+
+    # Like notifications(), but forgets the ones returned, so a long run
+    # does not keep every report
+    def take_notifications(self, handle=None):
+        taken = self.notifications(handle)
+        if handle is None:
+            handle = self.peripheral.telemetry_handle
+        self.ble.notifications = [n for n in self.ble.notifications if n[1] != handle]
+        return taken
+
+    # Recorded output
+
+    def clear_writes(self):
+        self.writes = []
+
+    def writes_since(self, time_us):
+        return [w for w in self.writes if w.time_us >= time_us]
+
+    # Last bytes written to a strip, or None if it was never written
+    def shown(self, strip):
+        for w in reversed(self.writes):
+            if w.strip == strip:
+                return w.pixels
+        return None
+
+    # Indexes of the pixels that are not black on the last write of a strip
+    def lit_pixels(self, strip):
+        pixels = self.shown(strip)
+        if pixels is None:
+            return []
+        bpp = self.strips[strip].bpp
+        return [i // bpp for i in range(0, len(pixels), bpp) if any(pixels[i:i + bpp])]
+
+    # (r, g, b) of one pixel as last written
+    def pixel(self, strip, index):
+        pixels = self.shown(strip)
+        offset = index * self.strips[strip].bpp
+        g, r, b = pixels[offset:offset + 3]
+        return (r, g, b)
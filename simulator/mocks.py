@@ -0,0 +1,517 @@
+# Stand-ins for the MicroPython modules ESP32_Script.py imports
+#
+# Every SimulatedBoard builds its own set of these modules, so several boards
+# can run side by side in one process without sharing radio or pin state.
+
+import time as _host_time
+import types
+
+
+# Monotonic clock for one board. sleep() does not block: it moves the clock
+# forward, so a time.sleep(2) in an IRQ handler costs nothing on the host
+# while timestamps still show the two seconds. It follows the host clock, or
+# `source` (a function returning seconds) to share another clock.
+class SimClock:
+    def __init__(self, source=None):
+        self.source = source or _host_time.perf_counter
+        self.start = self.source()  # source time at board time 0
+        self.skipped = 0.0
+
+    def seconds(self):
+        return self.source() - self.start + self.skipped
+
+    def sleep(self, seconds):
+        self.skipped += seconds
+
+
+def make_time_module(clock):
+    mod = types.ModuleType("time")
+    mod.time = lambda: int(_host_time.time())
+    mod.ticks_ms = lambda: int(clock.seconds() * 1000)
+    mod.ticks_us = lambda: int(clock.seconds() * 1000000)
+    mod.ticks_cpu = mod.ticks_us
+    mod.ticks_diff = lambda a, b: a - b
+    mod.ticks_add = lambda a, b: a + b
+    mod.sleep = clock.sleep
+    mod.sleep_ms = lambda ms: clock.sleep(ms / 1000)
+    mod.sleep_us = lambda us: clock.sleep(us / 1000000)
+    mod.localtime = _host_time.localtime
+    return mod
+
+
+def make_micropython_module():
+    mod = types.ModuleType("micropython")
+    mod.const = lambda value: value
+    mod.schedule = lambda func, arg: func(arg)
+    mod.alloc_emergency_exception_buf = lambda size: None
+    mod.opt_level = lambda level=None: 0
+    # Code emitters are plain Python on the host
+    mod.native = lambda func: func
+    mod.viper = lambda func: func
+    return mod
+
+
+# MicroPython's gc adds heap figures; the simulated heap is whatever the
+# board says it is (SimulatedBoard.heap_free)
+def make_gc_module(board):
+    mod = types.ModuleType("gc")
+    mod.collect = lambda: None
+    mod.enable = lambda: None
+    mod.disable = lambda: None
+    mod.isenabled = lambda: True
+    mod.mem_free = lambda: board.heap_free
+    mod.mem_alloc = lambda: board.heap_size - board.heap_free
+    mod.threshold = lambda amount=None: -1
+    return mod
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, board, id, mode=-1, pull=-1, value=None):
+        self.board = board
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = value or 0
+        self.handler = None
+        self.trigger = 0
+        board.pins[id] = self
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING):
+        self.handler = handler
+        self.trigger = trigger
+
+
+# Hardware timer driven by the board clock: nothing fires until the board is
+# advanced, see SimulatedBoard.advance()
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, board, id=-1, **settings):
+        self.board = board
+        self.id = id
+        self.mode = self.PERIODIC
+        self.period = 0
+        self.callback = None
+        self.due = None  # board clock seconds of the next callback, None when stopped
+        board.timers.append(self)
+        if settings:
+            self.init(**settings)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1):
+        if freq > 0:
+            period = 1000 / freq
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+        self.due = self.board.clock.seconds() + period / 1000
+
+    def deinit(self):
+        self.due = None
+
+    # Runs the callback if it is due at `now`; returns True if it ran
+    def fire(self, now):
+        if self.due is None or self.due > now:
+            return False
+        if self.mode == self.PERIODIC:
+            self.due += self.period / 1000
+        else:
+            self.due = None
+        if self.callback is not None:
+            self.callback(self)
+        return True
+
+
+def make_machine_module(board):
+    mod = types.ModuleType("machine")
+
+    class BoardPin(Pin):
+        def __init__(self, id, mode=-1, pull=-1, value=None):
+            Pin.__init__(self, board, id, mode, pull, value)
+
+    for name in ("IN", "OUT", "OPEN_DRAIN", "PULL_UP", "PULL_DOWN", "IRQ_RISING", "IRQ_FALLING"):
+        setattr(BoardPin, name, getattr(Pin, name))
+    mod.Pin = BoardPin
+
+    class BoardTimer(Timer):
+        def __init__(self, id=-1, **settings):
+            Timer.__init__(self, board, id, **settings)
+
+    BoardTimer.ONE_SHOT = Timer.ONE_SHOT
+    BoardTimer.PERIODIC = Timer.PERIODIC
+    mod.Timer = BoardTimer
+    mod.freq = lambda hz=None: 240000000
+    mod.reset = lambda: None
+    return mod
+
+
+# uasyncio on the board clock. Tasks only run when the board runs them, after
+# every injected IRQ and while the board is advanced, so a simulation is
+# deterministic: SimulatedBoard.write() returns once the firmware has gone
+# idle again.
+class CancelledError(BaseException):
+    pass
+
+
+class _Sleep:
+    def __init__(self, due):
+        self.due = due
+
+    def __await__(self):
+        yield self
+
+
+class ThreadSafeFlag:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.state = False
+        self.waiter = None
+
+    def set(self):
+        self.state = True
+        if self.waiter is not None:
+            self.scheduler.ready.append(self.waiter)
+            self.waiter = None
+
+    def clear(self):
+        self.state = False
+
+    def wait(self):
+        return _FlagWait(self)
+
+
+class _FlagWait:
+    def __init__(self, flag):
+        self.flag = flag
+
+    def __await__(self):
+        while not self.flag.state:
+            yield self.flag
+        self.flag.state = False
+
+
+class Task:
+    def __init__(self, scheduler, coro):
+        self.scheduler = scheduler
+        self.coro = coro
+        self.done = False
+        self.cancelled = False
+
+    def cancel(self):
+        if self.done or self.cancelled:
+            return False
+        self.cancelled = True
+        self.scheduler.unpark(self)
+        self.scheduler.ready.append(self)
+        return True
+
+
+class Scheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.ready = []
+        self.sleeping = []  # (due, task)
+        self.flags = []
+
+    def create_task(self, coro):
+        task = Task(self, coro)
+        self.ready.append(task)
+        return task
+
+    def unpark(self, task):
+        self.sleeping = [(due, t) for due, t in self.sleeping if t is not task]
+        if task in self.ready:
+            self.ready.remove(task)
+        for flag in self.flags:
+            if flag.waiter is task:
+                flag.waiter = None
+
+    # Board clock time of the next sleeping task, or None
+    def next_due(self):
+        return min(due for due, task in self.sleeping) if self.sleeping else None
+
+    # Runs tasks until every one of them waits on a flag or sleeps past `now`
+    def run_until(self, now):
+        while True:
+            due = sorted((d, i) for i, (d, t) in enumerate(self.sleeping) if d <= now)
+            for d, i in due:
+                self.ready.append(self.sleeping[i][1])
+            if due:
+                woken = set(i for d, i in due)
+                self.sleeping = [entry for i, entry in enumerate(self.sleeping) if i not in woken]
+            if not self.ready:
+                return
+            task = self.ready.pop(0)
+            self._step(task)
+
+    def _step(self, task):
+        try:
+            if task.cancelled:
+                task.cancelled = False
+                awaited = task.coro.throw(CancelledError())
+            else:
+                awaited = task.coro.send(None)
+        except (StopIteration, CancelledError):
+            task.done = True
+            return
+        if isinstance(awaited, _Sleep):
+            self.sleeping.append((awaited.due, task))
+        elif isinstance(awaited, ThreadSafeFlag):
+            awaited.waiter = task
+        else:
+            self.ready.append(task)
+
+
+def make_asyncio_module(board):
+    scheduler = board.scheduler
+    clock = board.clock
+    mod = types.ModuleType("uasyncio")
+    mod.CancelledError = CancelledError
+    mod.create_task = scheduler.create_task
+
+    def make_flag():
+        flag = ThreadSafeFlag(scheduler)
+        scheduler.flags.append(flag)
+        return flag
+
+    mod.ThreadSafeFlag = make_flag
+    mod.sleep = lambda seconds: _Sleep(clock.seconds() + seconds)
+    mod.sleep_ms = lambda ms: _Sleep(clock.seconds() + ms / 1000)
+
+    # Starts the main task and returns once it waits, instead of blocking
+    def run(coro):
+        task = scheduler.create_task(coro)
+        scheduler.run_until(clock.seconds())
+        return task
+
+    mod.run = run
+    return mod
+
+
+WS2812_BIT_SECONDS = 1.25e-6  # 800 kHz
+WS2812_RESET_SECONDS = 50e-6
+
+
+# Same byte layout as the real driver: GRB order, bpp bytes per pixel in buf
+class NeoPixel:
+    ORDER = (1, 0, 2, 3)
+
+    def __init__(self, board, pin, n, bpp=3, timing=1):
+        self.board = board
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.timing = timing
+        self.buf = bytearray(n * bpp)
+        self.index = board.register_strip(self)
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, v):
+        offset = i * self.bpp
+        for j in range(self.bpp):
+            self.buf[offset + self.ORDER[j]] = v[j]
+
+    def __getitem__(self, i):
+        offset = i * self.bpp
+        return tuple(self.buf[offset + self.ORDER[j]] for j in range(self.bpp))
+
+    def fill(self, v):
+        for i in range(self.n):
+            self[i] = v
+
+    # Blocks for the transfer, like the real driver
+    def write(self):
+        self.board.record_write(self)
+        self.board.clock.sleep(self.n * self.bpp * 8 * WS2812_BIT_SECONDS + WS2812_RESET_SECONDS)
+
+
+def make_neopixel_module(board):
+    mod = types.ModuleType("neopixel")
+
+    class BoardNeoPixel(NeoPixel):
+        def __init__(self, pin, n, bpp=3, timing=1):
+            NeoPixel.__init__(self, board, pin, n, bpp, timing)
+
+    mod.NeoPixel = BoardNeoPixel
+    return mod
+
+
+# esp32.RMT in transmit mode. write_pulses() decodes the WS2812 pulse train
+# back into bytes and records it as a write of the strip on that pin; the
+# transfer then runs on the board clock until wait_done() or the next
+# write_pulses() waits for it.
+class RMT:
+    APB_HZ = 80000000
+
+    def __init__(self, board, channel, pin=None, clock_div=8, idle_level=False, tx_carrier=None):
+        if channel in board.rmt_channels:
+            raise ValueError("RMT channel %d already in use" % channel)
+        self.board = board
+        self.channel = channel
+        self.pin = pin
+        self.clock_div = clock_div
+        self.idle_level = idle_level
+        self.busy_until = 0.0
+        board.rmt_channels[channel] = self
+
+    def deinit(self):
+        if self.board.rmt_channels.get(self.channel) is self:
+            del self.board.rmt_channels[self.channel]
+
+    def wait_done(self, timeout=0):
+        clock = self.board.clock
+        remaining = self.busy_until - clock.seconds()
+        if remaining > 0 and timeout:
+            clock.sleep(remaining if timeout < 0 else min(remaining, timeout / 1000))
+        return self.busy_until <= clock.seconds()
+
+    def write_pulses(self, duration, data=True):
+        self.wait_done(timeout=-1)
+        if not data or len(duration) % 16:
+            raise ValueError("not a WS2812 pulse train")
+        tick_ns = 1000000000 * self.clock_div // self.APB_HZ
+        highs = bytes(duration[0::2])  # high pulses are a few ticks long
+        # WS2812 datasheet windows: a 0 is 0.25-0.55 us high, a 1 0.65-0.95 us,
+        # and the low part of a bit at least 0.3 us
+        bits = bytearray(256)
+        for high in set(highs):
+            if 250 <= high * tick_ns <= 550:
+                bits[high] = ord("0")
+            elif 650 <= high * tick_ns <= 950:
+                bits[high] = ord("1")
+            else:
+                raise ValueError("%d ns high pulse is neither a 0 nor a 1" % (high * tick_ns))
+        if min(duration[1::2]) * tick_ns < 300:
+            raise ValueError("low pulse shorter than 300 ns")
+        value = int(highs.translate(bits), 2)
+        self.board.record_pixels(self.pin, value.to_bytes(len(duration) // 16, "big"))
+        self.busy_until = self.board.clock.seconds() + sum(duration) * tick_ns / 1e9
+
+
+def make_esp32_module(board):
+    mod = types.ModuleType("esp32")
+
+    class BoardRMT(RMT):
+        def __init__(self, channel, **settings):
+            RMT.__init__(self, board, channel, **settings)
+
+    mod.RMT = BoardRMT
+    return mod
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, int):
+            self.value = value.to_bytes(2, "little")
+        else:
+            # Stored little endian, like MicroPython's bluetooth.UUID
+            self.value = bytes(reversed(bytes.fromhex(value.replace("-", ""))))
+
+    def __bytes__(self):
+        return self.value
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return "UUID(%s)" % bytes(reversed(self.value)).hex()
+
+
+# Peripheral side of bluetooth.BLE. Attribute values live in a dict keyed by
+# handle; the board fires IRQs through the handler the firmware registered.
+class BLE:
+    FIRST_HANDLE = 16
+
+    def __init__(self, board):
+        self.board = board
+        self.is_active = False
+        self.settings = {"mtu": 23}
+        self.handler = None
+        self.values = {}
+        self.buffer_sizes = {}
+        self.services = []
+        self.advertising = None
+        self.notifications = []
+        board.ble = self
+
+    def active(self, state=None):
+        if state is not None:
+            self.is_active = bool(state)
+        return self.is_active
+
+    def config(self, *names, **settings):
+        if names:
+            return self.settings[names[0]]
+        self.settings.update(settings)
+
+    def irq(self, handler):
+        self.handler = handler
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        self.advertising = None if interval_us is None else (interval_us, adv_data, resp_data)
+
+    def gatts_register_services(self, services):
+        handles = []
+        next_handle = self.FIRST_HANDLE
+        for uuid, characteristics in services:
+            value_handles = []
+            for characteristic in characteristics:
+                value_handles.append(next_handle)
+                self.values[next_handle] = b""
+                next_handle += 3  # value, declaration and a possible CCCD
+            handles.append(tuple(value_handles))
+        self.services = services
+        return tuple(handles)
+
+    def gatts_read(self, handle):
+        return self.values[handle]
+
+    def gatts_write(self, handle, data, send_update=False):
+        self.values[handle] = bytes(data)
+
+    def gatts_notify(self, conn_handle, handle, data=None):
+        if data is not None:
+            self.values[handle] = bytes(data)
+        self.notifications.append((self.board.clock.seconds(), handle, self.values[handle]))
+
+    def gatts_set_buffer(self, handle, size, append=False):
+        self.buffer_sizes[handle] = size
+
+
+def make_bluetooth_module(board):
+    mod = types.ModuleType("bluetooth")
+    mod.BLE = lambda: BLE(board)
+    mod.UUID = UUID
+    mod.FLAG_READ = 0x0002
+    mod.FLAG_WRITE_NO_RESPONSE = 0x0004
+    mod.FLAG_WRITE = 0x0008
+    mod.FLAG_NOTIFY = 0x0010
+    mod.FLAG_INDICATE = 0x0020
+    return mod
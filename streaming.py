@@ -0,0 +1,158 @@
+# Raw frame streaming from the app to the brain model
+#
+# A frame is one bytes-like object per strip in NeoPixel buffer order (GRB,
+# three bytes per pixel). Each frame is delta-encoded against the last frame
+# that was sent and run-length compressed, then split into chunks that fit
+# the negotiated MTU. The decoder is MicroPythonScripts/framestream.py; the
+# byte layout is described there and must stay in sync with this file.
+
+import time
+
+PROTOCOL_HEADER = 0xB1
+OP_FRAME_CHUNK = 0x10
+CHUNK_HEADER_LEN = 5
+ATT_HEADER_LEN = 3
+MAX_CHUNK_DATA = 239  # firmware attribute buffer (244) minus the chunk header
+MAX_CHUNKS = 255
+
+FLAG_KEYFRAME = 0x01
+
+OP_SKIP = 0x00
+OP_RUN = 0x40
+OP_LITERAL = 0x80
+OP_END = 0xFF
+MAX_OP_PIXELS = 64
+
+
+# Appends the ops that turn `old` into `new` for one strip. Returns False if
+# the strip did not change, in which case nothing is appended.
+def encode_strip(index, new, old, out):
+    n = len(new) // 3
+    start = len(out)
+    out.append(index)
+    changed = False
+    i = 0
+    while i < n:
+        # Unchanged pixels are skipped
+        j = i
+        while j < n and new[j * 3:j * 3 + 3] == old[j * 3:j * 3 + 3]:
+            j += 1
+        if j == n:
+            break  # trailing unchanged pixels need no ops
+        while j - i > 0:
+            count = min(j - i, MAX_OP_PIXELS)
+            out.append(OP_SKIP | (count - 1))
+            i += count
+
+        changed = True
+        pixel = new[i * 3:i * 3 + 3]
+        k = i + 1
+        while k < n and k - i < MAX_OP_PIXELS and new[k * 3:k * 3 + 3] == pixel:
+            k += 1
+        if k - i >= 2:
+            out.append(OP_RUN | (k - i - 1))
+            out += pixel
+            i = k
+            continue
+
+        # Literal pixels until a run or an unchanged pixel begins
+        k = i + 1
+        while (k < n and k - i < MAX_OP_PIXELS
+               and new[k * 3:k * 3 + 3] != old[k * 3:k * 3 + 3]
+               and not (k + 1 < n and new[k * 3:k * 3 + 3] == new[k * 3 + 3:k * 3 + 6])):
+            k += 1
+        out.append(OP_LITERAL | (k - i - 1))
+        out += new[i * 3:k * 3]
+        i = k
+
+    if not changed:
+        del out[start:]
+        return False
+    out.append(OP_END)
+    return True
+
+
+# Builds the payload for `frame`, as a delta against `previous` (None for a keyframe)
+def encode_frame(frame, previous, base_frame_id):
+    out = bytearray()
+    if previous is None:
+        out.append(FLAG_KEYFRAME)
+        out.append(0)
+        previous = [bytes(len(strip)) for strip in frame]
+    else:
+        out.append(0)
+        out.append(base_frame_id)
+    for index, (new, old) in enumerate(zip(frame, previous)):
+        encode_strip(index, bytes(new), bytes(old), out)
+    return bytes(out)
+
+
+# Splits a payload into chunk writes of at most `mtu - 3` bytes
+def chunk_payload(payload, frame_id, mtu):
+    size = min(mtu - ATT_HEADER_LEN - CHUNK_HEADER_LEN, MAX_CHUNK_DATA)
+    count = max(1, -(-len(payload) // size))
+    if count > MAX_CHUNKS:
+        raise ValueError(f"Frame payload of {len(payload)} bytes needs more than {MAX_CHUNKS} chunks")
+    return [bytes((PROTOCOL_HEADER, OP_FRAME_CHUNK, frame_id, i, count)) + payload[i * size:(i + 1) * size]
+            for i in range(count)]
+
+
+# Sends frames through a GattWriteQueue. A frame is skipped while chunks of
+# the previous one are still waiting behind the write in flight, so a slow
+# link lowers the frame rate instead of building a backlog; the next frame is
+# then encoded against the last one that actually went out. Once the queue
+# gave up on a write, the board may be missing a frame, so the next one is a
+# keyframe.
+class FrameStreamer:
+    def __init__(self, write_queue, mtu=23, keyframe_interval=30):
+        self.write_queue = write_queue
+        self.mtu = mtu
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.frame_id = 0
+        self.since_keyframe = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.started = None
+        self.failed_seen = write_queue.failed
+
+    def send_frame(self, frame, keyframe=False):
+        if self.write_queue.waiting_count():
+            self.frames_skipped += 1
+            return False
+
+        if self.write_queue.failed != self.failed_seen:
+            self.failed_seen = self.write_queue.failed
+            keyframe = True
+        if keyframe or self.previous is None or self.since_keyframe >= self.keyframe_interval:
+            payload = encode_frame(frame, None, 0)
+            self.since_keyframe = 0
+        else:
+            payload = encode_frame(frame, self.previous, self.frame_id)
+            self.since_keyframe += 1
+
+        self.frame_id = (self.frame_id + 1) & 0xFF
+        chunks = chunk_payload(payload, self.frame_id, self.mtu)
+        for chunk in chunks:
+            self.write_queue.submit(chunk, f"frame {self.frame_id}", coalesce=False)
+
+        self.previous = [bytes(strip) for strip in frame]
+        if self.started is None:
+            self.started = time.monotonic()
+        self.frames_sent += 1
+        self.bytes_sent += sum(len(chunk) for chunk in chunks)
+        return True
+
+    # Next frame is sent as a keyframe, e.g. after the link was re-established
+    def reset(self):
+        self.previous = None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        return {
+            "frames": self.frames_sent,
+            "skipped": self.frames_skipped,
+            "fps": self.frames_sent / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_frame": self.bytes_sent / self.frames_sent if self.frames_sent else 0.0,
+        }
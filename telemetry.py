@@ -0,0 +1,47 @@
+# Decodes the firmware's telemetry characteristic
+#
+# The brain model notifies a 32-byte report after every command and every few
+# seconds while connected. The layout is described in
+# MicroPythonScripts/ESP32_Script.py (TELEMETRY_FORMAT) and must stay in sync
+# with this file.
+
+import struct
+from collections import namedtuple
+
+TELEMETRY_UUID = "9b7a6e36-cb8d-473b-9346-15507d362aa3"
+CCCD_UUID = "00002902-0000-1000-8000-00805f9b34fb"  # Client Characteristic Configuration
+
+TELEMETRY_VERSION = 1
+TELEMETRY_FRAME = struct.Struct("<BBHIIIIHHHHI")
+
+Telemetry = namedtuple("Telemetry", (
+    "opcode",          # last command's opcode, 0 for a text command
+    "seq",             # its sequence number, or the stream frame id
+    "decode_us",
+    "render_us",
+    "write_us",
+    "mem_free",        # gc.mem_free() on the board
+    "dropped",         # events lost to a full queue on the board
+    "coalesced",       # events replaced by a newer one before they ran
+    "stale",           # commands ignored as older than one already shown
+    "stream_dropped",  # stream frames that never made it onto the strips
+    "uptime_ms",
+))
+
+
+# Returns a Telemetry for a notified or read value, or None if it is not a
+# report this app understands
+def decode_telemetry(value):
+    value = bytes(value)
+    if len(value) < TELEMETRY_FRAME.size or value[0] != TELEMETRY_VERSION:
+        return None
+    return Telemetry(*TELEMETRY_FRAME.unpack_from(value)[1:])
+
+
+# One line for the status bar and the log
+def format_telemetry(t):
+    total_ms = (t.decode_us + t.render_us + t.write_us) / 1000
+    return (f"cmd {t.seq}: {total_ms:.1f} ms (decode {t.decode_us} us, render {t.render_us} us, "
+            f"write {t.write_us} us) | heap {t.mem_free // 1024} KB | "
+            f"dropped {t.dropped}, coalesced {t.coalesced}, stale {t.stale} | "
+            f"up {t.uptime_ms // 1000} s")
@@ -0,0 +1,212 @@
+# Firmware paths run in the simulator: the button, the IRQ event queue, the
+# frame cache, layered montages, telemetry, command sequence numbers and the
+# strip output choice
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from commands import EFFECT_PULSE, OP_SET_MONTAGE, encode_animation, encode_command, encode_layers
+from simulator import SimulatedBoard
+from telemetry import TELEMETRY_FRAME, decode_telemetry
+
+
+def drain(queue):
+    events = []
+    while True:
+        kind, item = queue.get()
+        if item is None:
+            return events
+        events.append((kind, item))
+
+
+def test_button_release_stops_the_animation():
+    board = SimulatedBoard()
+    board.connect()
+    board.write(encode_animation(EFFECT_PULSE, 1, (0, 0, 255), 1000, seq=1))
+    board.advance(200)
+    assert board.lit_pixels(0)
+
+    board.press_button()
+    board.release_button()
+    assert not any(board.lit_pixels(strip) for strip in range(4))
+
+    board.clear_writes()
+    board.advance(500)
+    assert board.writes == []
+    assert board.peripheral.animator.running_effect() == 0
+
+
+def test_full_queue_keeps_the_button_level():
+    eventqueue = SimulatedBoard().firmware.eventqueue
+    queue = eventqueue.EventQueue(4)
+    for n in range(3):
+        queue.put(eventqueue.EVENT_CHUNK, b"chunk %d" % n)
+    queue.put(eventqueue.EVENT_BUTTON, 0)
+
+    queue.put(eventqueue.EVENT_COMMAND, b"command")
+
+    assert drain(queue) == [(eventqueue.EVENT_BUTTON, 0), (eventqueue.EVENT_COMMAND, b"command")]
+
+
+def test_button_level_gets_into_a_queue_full_of_chunks():
+    eventqueue = SimulatedBoard().firmware.eventqueue
+    queue = eventqueue.EventQueue(4)
+    for n in range(4):
+        queue.put(eventqueue.EVENT_CHUNK, b"chunk %d" % n)
+
+    queue.put(eventqueue.EVENT_BUTTON, 1)
+    queue.put(eventqueue.EVENT_CHUNK, b"chunk 4")
+
+    assert queue.dropped == 2
+    assert drain(queue) == [(eventqueue.EVENT_CHUNK, b"chunk 0"), (eventqueue.EVENT_CHUNK, b"chunk 2"),
+                            (eventqueue.EVENT_CHUNK, b"chunk 3"), (eventqueue.EVENT_BUTTON, 1)]
+
+
+def test_frame_cache_evicts_the_least_recently_used_frame():
+    frame_cache = SimulatedBoard().firmware.FrameCache(30)
+    for key in (1, 2, 3):
+        frame_cache.put(key, (bytes(6), bytes(4)))
+    assert frame_cache.get(1) is not None  # 1 is now the most recently used
+
+    frame_cache.put(4, (bytes(10),))
+
+    assert frame_cache.order == [3, 1, 4]
+    assert frame_cache.get(2) is None
+    assert frame_cache.used_bytes == 30
+    assert (frame_cache.hits, frame_cache.misses) == (1, 1)
+
+
+def test_frame_cache_skips_a_frame_larger_than_the_cache():
+    frame_cache = SimulatedBoard().firmware.FrameCache(30)
+    frame_cache.put(1, (bytes(10),))
+    frame_cache.put(2, (bytes(31),))
+    assert frame_cache.order == [1]
+
+
+def leds(mask, strip):
+    bits = mask[strip]
+    return {led for led in range(len(bits) * 8) if bits[led >> 3] & (1 << (led & 7))}
+
+
+def test_layers_show_shared_leds_in_the_overlap_color():
+    board = SimulatedBoard()
+    board.connect()
+    peripheral = board.peripheral
+    first = peripheral.montage_ids["bipolar"]
+    second = peripheral.montage_ids["temporal"]
+    red, blue, green = (75, 0, 0), (0, 0, 75), (0, 75, 0)
+    board.write(encode_layers([(first, red, 0), (second, blue, 1)], overlap_rgb=green, seq=1))
+
+    for strip in range(4):
+        a = leds(peripheral.montage_masks[first], strip)
+        b = leds(peripheral.montage_masks[second], strip)
+        for led in a | b:
+            expected = green if led in a and led in b else red if led in a else blue
+            assert board.pixel(strip, led) == expected
+        assert len(board.lit_pixels(strip)) == len(a | b)
+
+
+def test_layers_without_an_overlap_color_let_the_top_layer_win():
+    board = SimulatedBoard()
+    board.connect()
+    peripheral = board.peripheral
+    first = peripheral.montage_ids["bipolar"]
+    second = peripheral.montage_ids["temporal"]
+    board.write(encode_layers([(first, (75, 0, 0), 1), (second, (0, 0, 75), 0)], seq=1))
+
+    shared = leds(peripheral.montage_masks[first], 3) & leds(peripheral.montage_masks[second], 3)
+    assert shared
+    for led in shared:
+        assert board.pixel(3, led) == (75, 0, 0)  # higher priority, drawn last
+
+
+def test_telemetry_report_decodes_in_the_app():
+    board = SimulatedBoard()
+    board.connect(mtu=247)
+    board.write(encode_command(OP_SET_MONTAGE, 1, (0, 0, 75), seq=0x1234))
+
+    (_, value), = board.take_notifications()
+    assert len(value) == 32
+    assert board.firmware.TELEMETRY_FORMAT == TELEMETRY_FRAME.format
+    report = decode_telemetry(value)
+    assert report.opcode == OP_SET_MONTAGE
+    assert report.seq == 0x1234
+    assert report.mem_free == board.heap_free
+    assert report.stale == 0
+    assert report.render_us >= 0 and report.write_us >= 0
+
+
+def test_stale_and_duplicate_commands_are_ignored_across_the_wrap():
+    board = SimulatedBoard()
+    board.connect()
+    peripheral = board.peripheral
+
+    def send(montage, seq):
+        board.write(encode_command(OP_SET_MONTAGE, peripheral.montage_ids[montage], (0, 0, 75), seq=seq))
+
+    send("bipolar", 0xFFFE)
+    send("transverse", 0xFFFF)
+    send("hatband", 0)  # wraps: newer than 0xFFFF
+    assert peripheral.stale_commands == 0
+    shown = [board.shown(strip) for strip in range(4)]
+
+    send("temporal", 0xFFFF)  # older than 0
+    send("cz_ref", 0)         # duplicate
+    send("large", 0x8000)     # half the sequence space ahead counts as older
+    assert peripheral.stale_commands == 3
+    assert [board.shown(strip) for strip in range(4)] == shown
+
+    send("small", 1)
+    assert peripheral.stale_commands == 3
+    assert peripheral.last_seq == 1
+
+
+class SlowOutput:
+    def __init__(self, board, output):
+        self.board = board
+        self.output = output
+
+    def write(self, mask):
+        self.output.write(mask)
+        self.board.clock.sleep(0.01)
+
+    def wait(self):
+        self.output.wait()
+
+
+def test_animation_frames_do_not_change_the_command_write_time():
+    board = SimulatedBoard()
+    board.connect(mtu=247)
+    peripheral = board.peripheral
+    peripheral.output = SlowOutput(board, peripheral.output)
+
+    board.write(encode_command(OP_SET_MONTAGE, 1, (0, 0, 75), seq=1))
+    report = decode_telemetry(board.take_notifications()[-1][1])
+    assert report.write_us >= 10000
+
+    # Starting an animation writes nothing; its frames do
+    board.write(encode_animation(EFFECT_PULSE, 2, (0, 0, 75), 1000, seq=2))
+    board.advance(board.firmware.TELEMETRY_INTERVAL_MS)
+    assert peripheral.animator.frames > 10
+    reports = [decode_telemetry(value) for _, value in board.take_notifications()]
+    assert [report.seq for report in reports] == [2, 2]
+    assert all(report.write_us < 10000 for report in reports)
+    assert all(report.render_us < 10000 for report in reports)
+
+
+def test_auto_output_takes_rmt_only_when_the_heap_has_room():
+    board = SimulatedBoard()
+    stripout = board.firmware.stripout
+    strips = board.peripheral.strips
+    assert isinstance(board.peripheral.output, stripout.BitbangOutput)  # 80 KB free
+
+    board.heap_free = stripout.RmtOutput.heap_bytes(strips) + stripout.RMT_HEAP_RESERVE
+    output = stripout.make_output(stripout.OUTPUT_AUTO, strips)
+    assert isinstance(output, stripout.RmtOutput)
+    output.deinit()
+
+    board.heap_free -= 1
+    assert isinstance(stripout.make_output(stripout.OUTPUT_AUTO, strips), stripout.BitbangOutput)
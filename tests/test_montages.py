@@ -0,0 +1,72 @@
+# montages.json: compiling span tables and masks, and rejecting bad files
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from simulator import SimulatedBoard
+from simulator.board import FIRMWARE_DIR
+
+STRIP_LENGTHS = (192, 69, 79, 159)
+
+
+@pytest.fixture(scope="module")
+def montages():
+    return SimulatedBoard().firmware.montages
+
+
+def montage_file(*montages, strips=("np0", "np1")):
+    return {"format": 1, "strips": list(strips),
+            "montages": [{"name": name, "spans": spans} for name, spans in montages]}
+
+
+def test_spans_compile_to_merged_byte_ranges_and_masks(montages):
+    data = montage_file(("a", [["np0", 2], ["np0", 3, 4, "continues the first"], ["np1", 0, 2], ["np0", 9]]))
+    names, tables, masks = montages.compile_montages(data, (16, 4))
+
+    assert names == ["a"]
+    assert list(tables[0]) == [0, 6, 21, 1, 0, 6, 0, 27, 30]
+    assert bytes(masks[0][0]) == bytes((0b01111100, 0b00000010))
+    assert bytes(masks[0][1]) == bytes((0b00000011,))
+    assert montages.mask_count(masks[0]) == 8
+
+
+@pytest.mark.parametrize("data, message", [
+    ({"format": 2, "strips": [], "montages": []}, "format"),
+    (montage_file(("a", [["np0", 1]]), strips=("np0",)), "the board has 2"),
+    (montage_file(("a", [["np0", 1]]), ("a", [["np1", 1]])), "Duplicate"),
+    (montage_file(("off", [["np0", 1]])), "Duplicate"),
+    (montage_file(("a", [["np9", 1]])), "unknown strip"),
+    (montage_file(("a", [["np0"]])), "malformed"),
+    (montage_file(("a", [["np0", 1, 2, 3]])), "malformed"),
+    (montage_file(("a", [["np0", -1]])), "bad LED range"),
+    (montage_file(("a", [["np0", 3, 0]])), "bad LED range"),
+    (montage_file(("a", [["np0", 14, 3]])), "runs past the end of np0"),
+    (montage_file(("a", [["np1", 4]])), "runs past the end of np1"),
+])
+def test_bad_files_are_rejected(montages, data, message):
+    with pytest.raises(ValueError, match=message):
+        montages.compile_montages(data, (16, 4))
+
+
+def test_shipped_file_fits_the_strips(montages):
+    names, tables, masks = montages.load(STRIP_LENGTHS, os.path.join(FIRMWARE_DIR, "montages.json"))
+    assert names[:3] == ["bipolar", "transverse", "hatband"]
+    for table in tables:
+        for k in range(0, len(table), 3):
+            assert table[k + 1] < table[k + 2] <= STRIP_LENGTHS[table[k]] * montages.BYTES_PER_PIXEL
+
+
+def test_shipped_file_does_not_fit_shorter_strips(montages):
+    with open(os.path.join(FIRMWARE_DIR, "montages.json")) as f:
+        data = json.load(f)
+    longest = max(span[1] + (span[2] if len(span) > 2 else 1)
+                  for montage in data["montages"] for span in montage["spans"] if span[0] == "np0")
+    assert longest <= STRIP_LENGTHS[0]
+    with pytest.raises(ValueError, match="runs past the end of np0"):
+        montages.compile_montages(data, (longest - 1,) + STRIP_LENGTHS[1:])
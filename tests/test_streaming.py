@@ -0,0 +1,132 @@
+# Frame streaming: the app's encoder against the firmware's assembler and
+# decoder, and streams through BoardPool and the loopback transport
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from boards import BoardPool
+from metrics import Metrics
+from registry import DeviceRegistry
+from simulator import SimulatedBoard
+from streaming import (FLAG_KEYFRAME, OP_LITERAL, OP_RUN, OP_SKIP, PROTOCOL_HEADER, chunk_payload,
+                       encode_frame)
+from transport_loopback import ManualClock, LoopbackTransport
+
+STRIP_LENGTHS = (192, 69, 79, 159)
+
+
+def connected_pool():
+    clock = ManualClock()
+    transport = LoopbackTransport(clock)
+    pool = BoardPool(transport, DeviceRegistry(None), Metrics(now=clock.now_ms))
+    pool.connect()
+    clock.advance(2)
+    (address, board), = pool.boards.items()
+    assert board.ready
+    return clock, pool, transport.board(address)
+
+
+def solid_frame(grb):
+    return [bytes(grb) * n for n in STRIP_LENGTHS]
+
+
+def pattern_frame(seed):
+    frame = []
+    for strip, n in enumerate(STRIP_LENGTHS):
+        pixels = bytearray()
+        for i in range(n):
+            if i < 100:
+                pixels += bytes((seed, strip, 7))  # a run longer than one op holds
+            elif i % 5 == 0:
+                pixels += bytes((i & 0xFF, seed, strip))  # literals between runs
+            else:
+                pixels += bytes((0, 0, seed))
+        frame.append(bytes(pixels))
+    return frame
+
+
+def ops(payload):
+    kinds = set()
+    pos = 2
+    while pos < len(payload):
+        pos += 1  # strip index
+        while payload[pos] != 0xFF:
+            op = payload[pos]
+            kinds.add(op & 0xC0)
+            pos += 1
+            if op & 0xC0 == OP_RUN:
+                pos += 3
+            elif op & 0xC0 == OP_LITERAL:
+                pos += ((op & 0x3F) + 1) * 3
+        pos += 1
+    return kinds
+
+
+# Sends one payload through the firmware's assembler and decoder
+def apply(framestream, assembler, bufs, payload, frame_id, mtu):
+    chunks = chunk_payload(payload, frame_id, mtu)
+    assert all(chunk[0] == PROTOCOL_HEADER and len(chunk) <= mtu - 3 for chunk in chunks)
+    complete = [assembler.add_chunk(chunk) for chunk in chunks]
+    assert complete == [False] * (len(chunks) - 1) + [True]
+    assert assembler.frame_id == frame_id
+    return framestream.decode(assembler.buf, assembler.length, bufs)
+
+
+def test_encoded_frames_round_trip_through_the_firmware_decoder():
+    framestream = SimulatedBoard().firmware.framestream
+    assembler = framestream.FrameAssembler(framestream.max_payload_len(STRIP_LENGTHS))
+    bufs = [bytearray(n * 3) for n in STRIP_LENGTHS]
+
+    first = pattern_frame(10)
+    keyframe = encode_frame(first, None, 0)
+    assert keyframe[0] == FLAG_KEYFRAME
+    assert {OP_RUN, OP_LITERAL} <= ops(keyframe)
+    assert apply(framestream, assembler, bufs, keyframe, 1, 23)
+    assert [bytes(buf) for buf in bufs] == first
+
+    second = [bytearray(strip) for strip in first]
+    second[0][150:153] = b"\x01\x02\x03"  # one pixel on strip 0, the rest unchanged
+    second[3] = bytearray(pattern_frame(20)[3])
+    second = [bytes(strip) for strip in second]
+    delta = encode_frame(second, first, 1)
+    assert delta[:2] == bytes((0, 1))
+    assert OP_SKIP in ops(delta)
+    assert len(delta) < len(keyframe)
+    assert apply(framestream, assembler, bufs, delta, 2, 247)
+    assert [bytes(buf) for buf in bufs] == second
+
+
+def test_unchanged_frame_encodes_no_strips():
+    frame = pattern_frame(3)
+    assert encode_frame(frame, frame, 5) == bytes((0, 5))
+
+
+def test_malformed_payload_is_rejected():
+    framestream = SimulatedBoard().firmware.framestream
+    bufs = [bytearray(n * 3) for n in STRIP_LENGTHS]
+    past_the_end = bytes((FLAG_KEYFRAME, 0, 1, OP_RUN | 63, 1, 2, 3, OP_RUN | 10, 1, 2, 3, 0xFF))
+    assert not framestream.decode(past_the_end, len(past_the_end), bufs)
+    unknown_strip = bytes((FLAG_KEYFRAME, 0, 4, 0xFF))
+    assert not framestream.decode(unknown_strip, len(unknown_strip), bufs)
+
+
+def test_frame_after_a_montage_command_is_applied():
+    clock, pool, board = connected_pool()
+    assert pool.stream_frame(solid_frame((0, 0, 40)))
+    clock.advance(0.5)
+    assert pool.stream_frame(solid_frame((0, 40, 0)))
+    clock.advance(0.5)
+    assert board.pixel(0, 0) == (40, 0, 0)
+
+    pool.send("bipolar", "blue")
+    clock.advance(0.5)
+    assert len(board.lit_pixels(0)) < STRIP_LENGTHS[0]
+
+    assert pool.stream_frame(solid_frame((40, 0, 0)))
+    clock.advance(0.5)
+    for strip, n in enumerate(STRIP_LENGTHS):
+        assert len(board.lit_pixels(strip)) == n
+    assert board.pixel(0, 0) == (0, 40, 0)
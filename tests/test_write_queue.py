@@ -0,0 +1,86 @@
+# GattWriteQueue after it gives up on a write, on its own and through the
+# loopback transport
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from boards import BoardPool, GattWriteQueue
+from metrics import Metrics
+from registry import DeviceRegistry
+from streaming import FrameStreamer
+from transport import GATT_SUCCESS
+from transport_loopback import ManualClock, LoopbackTransport
+
+
+def test_next_write_starts_after_giving_up():
+    clock = ManualClock()
+    written = []
+    queue = GattWriteQueue(lambda payload: written.append(payload) or True, clock)
+    queue.submit(b"a1", "frame 1", coalesce=False)
+    queue.submit(b"a2", "frame 1", coalesce=False)
+    queue.submit(b"b1", "frame 2", coalesce=False)
+
+    # Never acked: sent once and retried twice
+    clock.advance(3 * queue.timeout)
+
+    assert queue.failed == 1
+    assert written == [b"a1", b"a1", b"a1", b"b1"]  # the rest of frame 1 is dropped
+    assert queue.in_flight[0] == b"b1"
+    assert queue.waiting_count() == 0
+
+    queue.on_write_complete(GATT_SUCCESS)
+    assert queue.in_flight is None
+
+
+def test_streamer_sends_a_keyframe_after_a_failed_frame():
+    clock = ManualClock()
+    queue = GattWriteQueue(lambda payload: True, clock)
+    streamer = FrameStreamer(queue, mtu=23)
+    frame = [bytes([16]) * 60 for _ in range(4)]
+
+    def acked():
+        while queue.in_flight is not None:
+            queue.on_write_complete(GATT_SUCCESS)
+
+    assert streamer.send_frame(frame)
+    acked()
+    assert streamer.send_frame(frame)
+    acked()
+    assert streamer.since_keyframe == 1  # a delta against the first frame
+
+    assert streamer.send_frame(frame)
+    clock.advance(3 * queue.timeout)
+    assert queue.in_flight is None and queue.waiting_count() == 0
+
+    assert streamer.send_frame(frame)
+    assert streamer.since_keyframe == 0
+
+
+def test_stream_resumes_over_loopback_after_lost_writes():
+    clock = ManualClock()
+    transport = LoopbackTransport(clock)
+    pool = BoardPool(transport, DeviceRegistry(None), Metrics(now=clock.now_ms))
+    pool.connect()
+    clock.advance(2)
+    (address, board), = pool.boards.items()
+    assert board.ready
+
+    # The link accepts writes but they never arrive, so none is acked
+    deliver = board.link.write
+    board.link.write = lambda payload: True
+    lit = [bytes([0, 0, 40]) * n for n in (192, 69, 79, 159)]
+    assert pool.stream_frame(lit)
+    clock.advance(3 * board.write_queue.timeout + 0.1)
+    assert board.write_queue.failed == 1
+    assert board.write_queue.waiting_count() == 0
+
+    board.link.write = deliver
+    assert pool.stream_frame(lit)
+    clock.advance(0.5)
+    assert board.write_queue.in_flight is None
+    simulated = transport.board(address)
+    assert len(simulated.lit_pixels(0)) == 192
+    assert len(simulated.lit_pixels(3)) == 159
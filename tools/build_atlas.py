@@ -0,0 +1,76 @@
+# Packs the montage card images into a Kivy atlas
+#
+#   python tools/build_atlas.py               # writes images/cards.atlas + images/cards-0.png
+#   python tools/build_atlas.py --size 256    # card size in pixels (default 300)
+#
+# Every PNG in images/ and Images/ becomes a region named after its file
+# ("bipolar", "bipolar_dark", ...), so ui.kv can use atlas://images/cards/<name>.
+# The cards are drawn at 97dp, which is 291 px on an xxhdpi screen; the
+# default size keeps them sharp there without shipping the 400 px originals.
+# Run this whenever a card image changes and commit the output.
+#
+# The packing is kivy.atlas.Atlas.create, the same as `python -m kivy.atlas`;
+# this only scales the cards to --size first and sizes the page to fit them.
+# Both need Pillow.
+
+import math
+import os
+import sys
+import tempfile
+
+from PIL import Image
+from kivy.atlas import Atlas
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIRS = ("images", "Images")
+ATLAS_BASE = os.path.join(ROOT_DIR, "images", "cards")
+DEFAULT_SIZE = 300
+PADDING = 2  # transparent pixels around each region, so filtering does not bleed
+
+
+def find_images():
+    images = {}
+    for directory in SOURCE_DIRS:
+        path = os.path.join(ROOT_DIR, directory)
+        if not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(".png") and not name.startswith("cards-"):
+                region = name[:-4]
+                if region in images:
+                    raise ValueError(f"{name} exists in more than one image directory")
+                images[region] = os.path.join(path, name)
+    return images
+
+
+def build(size):
+    images = find_images()
+    cell = size + PADDING
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+
+    with tempfile.TemporaryDirectory() as scaled_dir:
+        filenames = []
+        for region, path in sorted(images.items()):
+            scaled = os.path.join(scaled_dir, region + ".png")
+            with Image.open(path) as image:
+                image.convert("RGBA").resize((size, size), Image.LANCZOS).save(scaled)
+            filenames.append(scaled)
+            print(f"{region}: {os.path.relpath(path, ROOT_DIR)}")
+        result = Atlas.create(ATLAS_BASE, filenames, (columns * cell, rows * cell), padding=PADDING)
+
+    if not result:
+        sys.exit("Atlas.create failed")
+    atlas_file, meta = result
+    print(f"{len(filenames)} regions on {len(meta)} page(s) -> {atlas_file}")
+
+
+def main(argv):
+    size = DEFAULT_SIZE
+    if "--size" in argv:
+        size = int(argv[argv.index("--size") + 1])
+    build(size)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
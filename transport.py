@@ -0,0 +1,128 @@
+# Transports: how the app reaches the brain models
+#
+# The app never talks to a Bluetooth stack directly. A Transport scans for
+# boards and makes one Link per board; BoardConnection (boards.py) drives
+# the link and receives its events. Three backends implement it:
+#
+#   android   Android's BluetoothGatt through pyjnius (transport_android.py)
+#   desktop   BlueZ, CoreBluetooth or WinRT through bleak (transport_desktop.py)
+#   loopback  in-process simulated boards running the firmware (transport_loopback.py)
+#
+# Every event is delivered on the thread that runs `clock`, the Kivy Clock
+# in the app. Link events go to the link's handler:
+#
+#   on_link(connected, status)   the link came up or went down
+#   on_mtu(mtu, status)          the MTU negotiated after the link came up
+#   on_services(status)          the command characteristic was found, or not
+#   on_subscribed(status)        telemetry notifications were enabled
+#   on_write(status)             a write finished: ack for GattWriteQueue
+#   on_notify(uuid, value)       a notification arrived
+#
+# and scan events to the handler passed to start_scan():
+#
+#   on_scan_result(address, name, rssi)
+#   on_scan_failed(error_code)
+#
+# Statuses use Android's numbering: GATT_SUCCESS, anything else is a failure.
+
+# BLE Constants
+CHAR_UUID = "9b7a6e35-cb8d-473b-9346-15507d362aa3"
+SERVICE_UUID = "3322271E-756A-443D-8A9D-2F90C7A73BF5"
+
+GATT_SUCCESS = 0
+GATT_FAILURE = 0x101  # android.bluetooth.BluetoothGatt.GATT_FAILURE
+DEFAULT_MTU = 23  # ATT default until a larger one is negotiated
+
+TRANSPORT_ANDROID = "android"
+TRANSPORT_DESKTOP = "desktop"
+TRANSPORT_LOOPBACK = "loopback"
+
+
+# One connection to one board. connect() starts it; the link reports the
+# MTU and then looks up the services by itself once it is up.
+class Link:
+    def __init__(self, transport, address, handler):
+        self.transport = transport
+        self.address = address
+        self.label = address[-5:].replace(":", "")  # short name for logs, metrics and the UI
+        self.handler = handler
+
+    # Starts a new connection, dropping any previous one
+    def connect(self):
+        raise NotImplementedError
+
+    # Brings a dropped link back up. The services found before are reused
+    # where the backend can, so on_services follows without a discovery
+    # round trip. Returns False if the reconnect could not be started.
+    def reconnect(self):
+        raise NotImplementedError
+
+    # Drops the link or cancels a pending connect; a reconnect can follow
+    def disconnect(self):
+        pass
+
+    # Drops the link for good and forgets the services
+    def close(self):
+        pass
+
+    # Enables telemetry notifications. Returns False if there is nothing to
+    # wait for; otherwise on_subscribed follows.
+    def subscribe(self):
+        return False
+
+    # Starts one write to the command characteristic. Returns False if it
+    # was refused; otherwise on_write follows.
+    def write(self, payload):
+        raise NotImplementedError
+
+
+class Transport:
+    def __init__(self, clock):
+        self.clock = clock
+
+    # Startup work that can run on a worker thread while the UI is built.
+    # `address` is the board the app will most likely connect to.
+    def prepare(self, address=None):
+        pass
+
+    # Asks for what the transport needs from the user and calls
+    # callback(granted) on the main thread
+    def request_permissions(self, callback):
+        self.clock.schedule_once(lambda dt: callback(True))
+
+    # None if a connection can be attempted, otherwise the status to show
+    def check(self):
+        return None
+
+    # Milliseconds since the process started, or None if unknown
+    def process_age_ms(self):
+        return None
+
+    def link(self, address, handler):
+        raise NotImplementedError
+
+    # Scans for boards advertising SERVICE_UUID until stop_scan(). Returns
+    # False if the scan could not be started.
+    def start_scan(self, handler):
+        raise NotImplementedError
+
+    def stop_scan(self):
+        pass
+
+
+# Builds the transport `kind`. A backend whose dependencies are missing falls
+# back to the loopback, so the app still starts on a bare desktop.
+def make_transport(kind, clock, **options):
+    if kind == TRANSPORT_ANDROID:
+        from transport_android import AndroidTransport
+        return AndroidTransport(clock)
+    if kind == TRANSPORT_DESKTOP:
+        try:
+            from transport_desktop import DesktopTransport
+            return DesktopTransport(clock)
+        except ImportError as e:
+            print(f"Desktop Bluetooth unavailable ({e}), using the loopback transport")
+    elif kind != TRANSPORT_LOOPBACK:
+        raise ValueError(f"Unknown transport: {kind}")
+    from transport_loopback import LoopbackTransport
+    return LoopbackTransport(clock, **options)
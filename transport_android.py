@@ -0,0 +1,419 @@
+# Android transport: BluetoothGatt through pyjnius and MyGattCallback
+#
+# MyGattCallback (JavaFiles/myGattCallback.java) turns GATT callbacks into
+# calls on a Python listener on the Binder thread; the listeners below hand
+# them to the main thread through the transport's clock.
+
+import threading
+
+from android.permissions import request_permissions, Permission, check_permission
+from jnius import autoclass, cast, detach, PythonJavaClass, java_method
+
+from metrics import now_ms
+from telemetry import TELEMETRY_UUID, CCCD_UUID
+from transport import CHAR_UUID, SERVICE_UUID, GATT_SUCCESS, GATT_FAILURE, Link, Transport
+
+
+# Stands in for a Java class and runs autoclass on first use. Every
+# autoclass call reflects over the whole class through JNI, so resolving them
+# all at import time held up the first frame.
+class LazyJavaClass:
+    lock = threading.Lock()  # classes are resolved on the main and the Bluetooth thread
+
+    def __init__(self, name):
+        self.name = name
+        self.cls = None
+
+    def resolve(self):
+        if self.cls is None:
+            with LazyJavaClass.lock:
+                if self.cls is None:
+                    started = now_ms()
+                    self.cls = autoclass(self.name)
+                    print(f"Resolved {self.name} in {now_ms() - started:.1f} ms")
+        return self.cls
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+    def __call__(self, *args):
+        return self.resolve()(*args)
+
+# Java Classes
+BluetoothAdapter = LazyJavaClass('android.bluetooth.BluetoothAdapter')
+BluetoothDevice = LazyJavaClass('android.bluetooth.BluetoothDevice')
+BluetoothGatt = LazyJavaClass('android.bluetooth.BluetoothGatt')
+BluetoothGattCharacteristic = LazyJavaClass('android.bluetooth.BluetoothGattCharacteristic')
+BluetoothGattDescriptor = LazyJavaClass('android.bluetooth.BluetoothGattDescriptor')
+Context = LazyJavaClass('android.content.Context')
+UUID = LazyJavaClass('java.util.UUID')
+LocationManager = LazyJavaClass('android.location.LocationManager')
+PythonActivity = LazyJavaClass('org.kivy.android.PythonActivity')
+MyGattCallback = LazyJavaClass('org.montage.ble.MyGattCallback')
+BluetoothManager = LazyJavaClass('android.bluetooth.BluetoothManager')
+BluetoothProfile = LazyJavaClass('android.bluetooth.BluetoothProfile')
+SystemClock = LazyJavaClass('android.os.SystemClock')
+ScanFilterBuilder = LazyJavaClass('android.bluetooth.le.ScanFilter$Builder')
+ScanSettings = LazyJavaClass('android.bluetooth.le.ScanSettings')
+ScanSettingsBuilder = LazyJavaClass('android.bluetooth.le.ScanSettings$Builder')
+ParcelUuid = LazyJavaClass('android.os.ParcelUuid')
+ArrayList = LazyJavaClass('java.util.ArrayList')
+Scanner = LazyJavaClass('org.montage.ble.MyGattCallback$Scanner')
+AndroidProcess = LazyJavaClass('android.os.Process')
+
+# Classes the connection needs, resolved off the main thread during startup
+BLUETOOTH_CLASSES = (BluetoothGatt, BluetoothProfile, BluetoothGattCharacteristic,
+                     BluetoothGattDescriptor, UUID, MyGattCallback)
+
+REQUIRED_PERMISSIONS = [
+    Permission.ACCESS_FINE_LOCATION,
+    Permission.BLUETOOTH,
+    Permission.BLUETOOTH_ADMIN,
+    Permission.ACCESS_BACKGROUND_LOCATION
+]
+
+
+# Receives MyGattCallback events on the Binder thread and hands them to its
+# AndroidLink on the Kivy main thread
+class GattEventListener(PythonJavaClass):
+    __javainterfaces__ = ['org/montage/ble/MyGattCallback$Listener']
+    __javacontext__ = 'app'
+
+    def __init__(self, link):
+        super().__init__()
+        self.link = link
+        self.clock = link.transport.clock
+
+    @java_method('(II)V')
+    def onConnectionStateChange(self, status, new_state):
+        self.clock.schedule_once(lambda dt: self.link.on_connection_state_change(self, status, new_state))
+
+    @java_method('(I)V')
+    def onServicesDiscovered(self, status):
+        self.clock.schedule_once(lambda dt: self.link.on_services_discovered(self, status))
+
+    @java_method('(I)V')
+    def onCharacteristicWrite(self, status):
+        self.clock.schedule_once(lambda dt: self.link.on_characteristic_write(self, status))
+
+    @java_method('(II)V')
+    def onMtuChanged(self, mtu, status):
+        self.clock.schedule_once(lambda dt: self.link.on_mtu_changed(self, mtu, status))
+
+    @java_method('(I)V')
+    def onDescriptorWrite(self, status):
+        self.clock.schedule_once(lambda dt: self.link.on_descriptor_write(self, status))
+
+    @java_method('(Ljava/lang/String;[B)V')
+    def onCharacteristicChanged(self, uuid, value):
+        value = bytes(b & 0xFF for b in value)  # Java bytes are signed
+        self.clock.schedule_once(lambda dt: self.link.on_characteristic_changed(self, uuid, value))
+
+
+# Receives filtered scan results from MyGattCallback.Scanner and hands them
+# to the transport on the Kivy main thread
+class ScanEventListener(PythonJavaClass):
+    __javainterfaces__ = ['org/montage/ble/MyGattCallback$Scanner$ScanListener']
+    __javacontext__ = 'app'
+
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+
+    @java_method('(Ljava/lang/String;Ljava/lang/String;I)V')
+    def onScanResult(self, address, name, rssi):
+        self.transport.clock.schedule_once(lambda dt: self.transport.on_scan_result(self, address, name, rssi))
+
+    @java_method('(I)V')
+    def onScanFailed(self, error_code):
+        self.transport.clock.schedule_once(lambda dt: self.transport.on_scan_failed(self, error_code))
+
+
+# One BluetoothGatt client. A dropped link is reconnected with
+# BluetoothGatt.connect() on the same client, and MyGattCallback is told to
+# skip service discovery so the characteristics found before are reused.
+# Events from a client that was already replaced are ignored.
+class AndroidLink(Link):
+    def __init__(self, transport, address, handler):
+        super().__init__(transport, address, handler)
+        self.ble_client = None
+        self.gatt_callback = None
+        self.gatt_listener = None
+        self.characteristic = None
+        self.telemetry_characteristic = None
+        self.reusing = False  # this link reuses the characteristics found before
+
+    def connect(self):
+        self.close()
+        # Keep references to both so they are not garbage collected while Java holds them
+        self.gatt_listener = GattEventListener(self)
+        self.gatt_callback = MyGattCallback(self.gatt_listener)
+        self.ble_client = self.transport.remote_device(self.address).connectGatt(
+            self.transport.get_context(),
+            False,
+            self.gatt_callback
+        )
+
+    def reconnect(self):
+        if self.ble_client is None:
+            return False
+        self.reusing = self.characteristic is not None
+        self.gatt_callback.setDiscoverServices(not self.reusing)
+        try:
+            return bool(self.ble_client.connect())
+        except Exception as e:
+            print(f"{self.label}: reconnect failed: {e}")
+            return False
+
+    def disconnect(self):
+        if self.ble_client is not None:
+            try:
+                self.ble_client.disconnect()  # also cancels a pending connect
+            except Exception as e:
+                print(f"Error cancelling connect: {e}")
+
+    # Drops the connection without waiting for Android to report it
+    def close(self):
+        if self.ble_client is not None:
+            print(f"{self.label}: closing GATT connection")
+            try:
+                self.ble_client.disconnect()
+                self.ble_client.close()
+            except Exception as e:
+                print(f"Error closing GATT: {e}")
+            self.ble_client = None  # Clear the reference
+        self.characteristic = None
+        self.telemetry_characteristic = None
+        self.reusing = False
+
+    def on_connection_state_change(self, listener, status, new_state):
+        if listener is not self.gatt_listener:
+            return  # late event from a connection that was already replaced
+        if new_state == BluetoothProfile.STATE_CONNECTED:
+            # MyGattCallback requests the MTU and starts service discovery itself
+            self.handler.on_link(True, status)
+        elif new_state == BluetoothProfile.STATE_DISCONNECTED:
+            self.handler.on_link(False, status)
+
+    def on_mtu_changed(self, listener, mtu, status):
+        if listener is self.gatt_listener:
+            self.handler.on_mtu(mtu, status)
+
+    # Called once service discovery has finished, or right after the link
+    # came up when the services are being reused
+    def on_services_discovered(self, listener, status):
+        if listener is not self.gatt_listener:
+            return
+        if self.reusing:
+            print(f"{self.label}: reusing characteristics")
+            self.handler.on_services(GATT_SUCCESS)
+            return
+        if status != BluetoothGatt.GATT_SUCCESS:
+            print(f"{self.label}: service discovery failed with status {status}")
+            self.handler.on_services(status)
+            return
+        self.handler.on_services(GATT_SUCCESS if self.find_characteristics() else GATT_FAILURE)
+
+    def find_characteristics(self):
+        try:
+            service = self.ble_client.getService(UUID.fromString(SERVICE_UUID))
+            if not service:
+                print(f"{self.label}: service not found")
+                return False
+
+            print(f"{self.label}: service found!")
+            characteristic = service.getCharacteristic(UUID.fromString(CHAR_UUID))
+            if not characteristic:
+                print(f"{self.label}: characteristic not found")
+                return False
+            print(f"{self.label}: characteristic set!")
+            # Skip the ATT write response round trip when the firmware allows it;
+            # GattWriteQueue still paces writes on onCharacteristicWrite
+            properties = characteristic.getProperties()
+            if properties & BluetoothGattCharacteristic.PROPERTY_WRITE_NO_RESPONSE:
+                characteristic.setWriteType(BluetoothGattCharacteristic.WRITE_TYPE_NO_RESPONSE)
+                print(f"{self.label}: using write without response")
+            self.characteristic = characteristic
+            self.telemetry_characteristic = service.getCharacteristic(UUID.fromString(TELEMETRY_UUID))
+            return True
+        except Exception as e:
+            print(f"{self.label}: service lookup error: {e}")
+            return False
+
+    # The board forgets notifications with every link, so this runs after
+    # every connect
+    def subscribe(self):
+        characteristic = self.telemetry_characteristic
+        if not characteristic:
+            print(f"{self.label}: no telemetry characteristic")
+            return False
+        descriptor = characteristic.getDescriptor(UUID.fromString(CCCD_UUID))
+        if not descriptor or not self.ble_client.setCharacteristicNotification(characteristic, True):
+            print(f"{self.label}: telemetry notifications not available")
+            return False
+        descriptor.setValue(BluetoothGattDescriptor.ENABLE_NOTIFICATION_VALUE)
+        if not self.ble_client.writeDescriptor(descriptor):
+            print(f"{self.label}: telemetry subscription not accepted")
+            return False
+        return True
+
+    def on_descriptor_write(self, listener, status):
+        if listener is self.gatt_listener:
+            self.handler.on_subscribed(status)
+
+    def write(self, payload):
+        if self.characteristic is None:
+            return False
+        self.characteristic.setValue(payload)
+        return self.ble_client.writeCharacteristic(self.characteristic)
+
+    def on_characteristic_write(self, listener, status):
+        if listener is not self.gatt_listener:
+            return
+        # A reused characteristic can be stale, e.g. after a firmware update
+        # changed the attribute table; look the services up again. Writes are
+        # refused until on_services reports the new characteristic.
+        if status != BluetoothGatt.GATT_SUCCESS and self.reusing:
+            print(f"{self.label}: write failed on a reused characteristic, rediscovering")
+            self.reusing = False
+            self.characteristic = None
+            self.gatt_callback.setDiscoverServices(True)
+            self.ble_client.discoverServices()
+        self.handler.on_write(status)
+
+    def on_characteristic_changed(self, listener, uuid, value):
+        if listener is self.gatt_listener:
+            self.handler.on_notify(uuid, value)
+
+
+class AndroidTransport(Transport):
+    def __init__(self, clock):
+        super().__init__(clock)
+        self.adapter = None  # looked up by prepare() during startup
+        self.device = None  # the registry's preferred board, if there is one
+        self.le_scanner = None
+        self.scan_callback = None  # MyGattCallback.Scanner, kept until the next scan
+        self.scan_listener = None
+        self.scan_handler = None
+
+    # Worker thread: resolves the connection's Java classes and looks up the
+    # adapter and device while the main thread builds the UI
+    def prepare(self, address=None):
+        started = now_ms()
+        try:
+            for cls in BLUETOOTH_CLASSES:
+                cls.resolve()
+            adapter = BluetoothAdapter.getDefaultAdapter()
+            if adapter is not None and address is not None:
+                self.device = adapter.getRemoteDevice(address)
+            self.adapter = adapter
+            print(f"Bluetooth prepared in {now_ms() - started:.1f} ms")
+        except Exception as e:
+            print(f"Bluetooth preparation failed: {e}")
+        finally:
+            detach()
+
+    # Usually already looked up by prepare()
+    def get_adapter(self):
+        return self.adapter or BluetoothAdapter.getDefaultAdapter()
+
+    def remote_device(self, address):
+        device = self.device
+        if device is None or device.getAddress() != address:
+            device = self.get_adapter().getRemoteDevice(address)
+        return device
+
+    def get_context(self):
+        return PythonActivity.mActivity.getApplicationContext()
+
+    def process_age_ms(self):
+        try:
+            return SystemClock.elapsedRealtime() - AndroidProcess.getStartElapsedRealtime()
+        except Exception:
+            return None
+
+    # Requests permissions and checks their status
+    def request_permissions(self, callback):
+        def on_permissions_callback(permissions, grants):
+
+            print("Permissions callback executed")
+            for i, grant in enumerate(grants):
+                if not grant:
+                    print(f"Permission denied: {permissions[i]}")
+
+            if all(grants):
+                print("All permissions granted")
+            else:
+                print("Some permissions were denied")
+            self.clock.schedule_once(lambda dt: callback(all(grants)))
+
+        if self.check_permissions():
+            self.clock.schedule_once(lambda dt: callback(True))
+        else:
+            request_permissions([
+                Permission.ACCESS_BACKGROUND_LOCATION,
+                Permission.ACCESS_FINE_LOCATION,
+                Permission.BLUETOOTH,
+                Permission.BLUETOOTH_ADMIN,
+            ], on_permissions_callback)
+
+    # Checks that all required permissions were granted
+    def check_permissions(self):
+        return all(check_permission(p) for p in REQUIRED_PERMISSIONS)
+
+    # Ensures location is enabled
+    def is_location_enabled(self):
+        try:
+            context = self.get_context()
+            location_manager = cast('android.location.LocationManager',
+                                    context.getSystemService(Context.LOCATION_SERVICE))
+            return (location_manager.isProviderEnabled(LocationManager.GPS_PROVIDER) or
+                    location_manager.isProviderEnabled(LocationManager.NETWORK_PROVIDER))
+        except Exception as e:
+            print(f"Location check failed: {e}")
+            return False
+
+    def check(self):
+        if not self.check_permissions():
+            return "Missing Permissions"
+        if not self.is_location_enabled():
+            print("Please enable location services manually.")
+            return "Location Off"
+        adapter = self.get_adapter()
+        if adapter is None or not adapter.isEnabled():
+            return "Bluetooth Off"
+        return None
+
+    def link(self, address, handler):
+        return AndroidLink(self, address, handler)
+
+    def start_scan(self, handler):
+        scanner = self.get_adapter().getBluetoothLeScanner()
+        if scanner is None:
+            return False
+
+        filters = ArrayList()
+        filters.add(ScanFilterBuilder().setServiceUuid(ParcelUuid.fromString(SERVICE_UUID)).build())
+        settings = ScanSettingsBuilder().setScanMode(ScanSettings.SCAN_MODE_LOW_LATENCY).build()
+        self.scan_listener = ScanEventListener(self)
+        self.scan_callback = Scanner(self.scan_listener)
+        self.scan_handler = handler
+        scanner.startScan(filters, settings, self.scan_callback)
+        self.le_scanner = scanner
+        return True
+
+    def on_scan_result(self, listener, address, name, rssi):
+        if listener is self.scan_listener and self.le_scanner is not None:
+            self.scan_handler.on_scan_result(address, name, rssi)
+
+    def on_scan_failed(self, listener, error_code):
+        if listener is self.scan_listener:
+            self.scan_handler.on_scan_failed(error_code)
+
+    def stop_scan(self):
+        if self.le_scanner is not None:
+            try:
+                self.le_scanner.stopScan(self.scan_callback)
+            except Exception as e:
+                print(f"Error stopping scan: {e}")
+            self.le_scanner = None
@@ -0,0 +1,185 @@
+# Desktop transport: BlueZ, CoreBluetooth or WinRT through bleak
+#
+#   pip install bleak
+#
+# bleak is asyncio based, so its calls run on an event loop in a worker
+# thread and every result is handed back to the main thread through the
+# transport's clock. On macOS boards are identified by a per-host UUID
+# instead of their address.
+
+import asyncio
+import threading
+
+from bleak import BleakClient, BleakScanner
+
+from telemetry import TELEMETRY_UUID
+from transport import CHAR_UUID, SERVICE_UUID, GATT_SUCCESS, GATT_FAILURE, Link, Transport
+
+
+# One BleakClient at a time. bleak clients are not reused after a drop, so
+# reconnect() opens a new one; BlueZ and CoreBluetooth keep the services
+# cached per device, which keeps the second discovery cheap.
+class DesktopLink(Link):
+    def __init__(self, transport, address, handler):
+        super().__init__(transport, address, handler)
+        self.client = None
+        self.generation = 0  # bumped whenever the client changes; older events are dropped
+        self.response = False  # the characteristic needs write with response
+        self.has_telemetry = False
+
+    # Hands `callback(*args)` to the main thread, unless the client was
+    # replaced or closed in the meantime
+    def post(self, generation, callback, *args):
+        def deliver(dt):
+            if generation == self.generation:
+                callback(*args)
+        self.transport.clock.schedule_once(deliver)
+
+    def connect(self):
+        self.close()
+        self.open()
+
+    def reconnect(self):
+        self.open()
+        return True
+
+    def open(self):
+        self.generation += 1
+        generation = self.generation
+        self.client = BleakClient(
+            self.address,
+            disconnected_callback=lambda client: self.post(generation, self.handler.on_link, False, GATT_FAILURE))
+        self.transport.run(self.start(self.client, generation))
+
+    async def start(self, client, generation):
+        try:
+            await client.connect()
+        except Exception as e:
+            print(f"{self.label}: connect failed: {e}")
+            return  # BoardConnection's connect timeout takes it from here
+        self.post(generation, self.handler.on_link, True, GATT_SUCCESS)
+        self.post(generation, self.handler.on_mtu, client.mtu_size, GATT_SUCCESS)
+
+        characteristic = client.services.get_characteristic(CHAR_UUID)
+        if characteristic is None:
+            print(f"{self.label}: characteristic not found")
+            self.post(generation, self.handler.on_services, GATT_FAILURE)
+            return
+        self.response = "write-without-response" not in characteristic.properties
+        self.has_telemetry = client.services.get_characteristic(TELEMETRY_UUID) is not None
+        self.post(generation, self.handler.on_services, GATT_SUCCESS)
+
+    def disconnect(self):
+        client = self.client
+        self.generation += 1
+        if client is not None:
+            self.transport.run(self.stop(client))
+
+    def close(self):
+        self.disconnect()
+        self.client = None
+
+    async def stop(self, client):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            print(f"Error closing connection: {e}")
+
+    def subscribe(self):
+        if self.client is None or not self.has_telemetry:
+            print(f"{self.label}: no telemetry characteristic")
+            return False
+        generation = self.generation
+
+        def on_notification(sender, data):
+            self.post(generation, self.handler.on_notify, TELEMETRY_UUID, bytes(data))
+
+        async def start(client):
+            try:
+                await client.start_notify(TELEMETRY_UUID, on_notification)
+                status = GATT_SUCCESS
+            except Exception as e:
+                print(f"{self.label}: telemetry subscription failed: {e}")
+                status = GATT_FAILURE
+            self.post(generation, self.handler.on_subscribed, status)
+
+        self.transport.run(start(self.client))
+        return True
+
+    def write(self, payload):
+        if self.client is None:
+            return False
+        generation = self.generation
+
+        async def send(client, payload):
+            try:
+                await client.write_gatt_char(CHAR_UUID, payload, response=self.response)
+                status = GATT_SUCCESS
+            except Exception as e:
+                print(f"{self.label}: write failed: {e}")
+                status = GATT_FAILURE
+            self.post(generation, self.handler.on_write, status)
+
+        self.transport.run(send(self.client, bytes(payload)))
+        return True
+
+
+class DesktopTransport(Transport):
+    def __init__(self, clock):
+        super().__init__(clock)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.scanner = None
+        self.scan_generation = 0  # bumped by every start and stop; older results are dropped
+
+    # Runs a coroutine on the Bluetooth thread
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def link(self, address, handler):
+        return DesktopLink(self, address, handler)
+
+    # Hands a scan event to the main thread, unless that scan was stopped
+    def post_scan(self, generation, callback, *args):
+        def deliver(dt):
+            if generation == self.scan_generation:
+                callback(*args)
+        self.clock.schedule_once(deliver)
+
+    def start_scan(self, handler):
+        self.stop_scan()
+        self.scan_generation += 1
+        generation = self.scan_generation
+
+        def on_detected(device, advertisement):
+            name = device.name or advertisement.local_name
+            self.post_scan(generation, handler.on_scan_result, device.address, name, advertisement.rssi)
+
+        async def start():
+            scanner = BleakScanner(on_detected, service_uuids=[SERVICE_UUID.lower()])
+            try:
+                await scanner.start()
+            except Exception as e:
+                print(f"Scan failed: {e}")
+                self.post_scan(generation, handler.on_scan_failed, GATT_FAILURE)
+                return
+            if generation == self.scan_generation:
+                self.scanner = scanner
+            else:
+                await scanner.stop()  # stopped while it was starting
+
+        self.run(start())
+        return True
+
+    def stop_scan(self):
+        self.scan_generation += 1
+
+        async def stop():
+            scanner, self.scanner = self.scanner, None
+            if scanner is not None:
+                try:
+                    await scanner.stop()
+                except Exception as e:
+                    print(f"Error stopping scan: {e}")
+
+        self.run(stop())
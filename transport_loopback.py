@@ -0,0 +1,274 @@
+# Loopback transport: simulated boards in the same process
+#
+# Every board is a simulator.SimulatedBoard running the real firmware, so
+# commands go through the firmware's decoder and renderer and show up as
+# strip writes. The boards share the app's clock: with the Kivy Clock the app
+# runs on a desktop against simulated boards, and with ManualClock the whole
+# command pipeline runs headless in virtual time, as fast as the host allows:
+#
+#   clock = ManualClock()
+#   transport = LoopbackTransport(clock, boards=2)
+#   pool = BoardPool(transport, DeviceRegistry(None), Metrics(now=clock.now_ms))
+#   pool.connect()
+#   clock.advance(2)                        # scan, connect, subscribe
+#   pool.send("bipolar", "blue")
+#   clock.advance(0.1)
+#   transport.board(address).writes         # what reached the LEDs
+#
+# Each GATT operation completes LATENCY_S after it was issued, about one
+# connection interval, and the board handles a write when it arrives.
+# drop() and set_in_range() stand in for a board that walks away.
+#
+# Board time follows the app clock. With count_host_time, the host time the
+# firmware spends handling each event is added on top, so its own timings
+# and the time from a write to the board's report include what the firmware
+# costs to run. A `monitor` sees every write as it reaches a board and every
+# report the board sends, in app clock time:
+#
+#   monitor.delivered(address, time, payload)
+#   monitor.reported(address, time, value)
+
+import heapq
+import time
+
+from simulator import SimulatedBoard
+from simulator.board import FIRMWARE_SCRIPT
+from telemetry import TELEMETRY_UUID
+from transport import GATT_SUCCESS, Link, Transport
+
+LATENCY_S = 0.0075  # 7.5 ms, the firmware's shortest preferred connection interval
+MTU = 247  # what the firmware asks for
+TICK_S = 0.02  # board timers (animations, telemetry) run at least this often
+BOARD_NAME = "ESP32_BLE"
+BOARD_RSSI = -60
+STATUS_LINK_LOSS = 8  # Android's GATT_CONN_TIMEOUT, reported by drop()
+
+
+# Drop-in for the Kivy Clock that only moves when told to. Callbacks run in
+# time order, and in scheduling order when they fall due together.
+class ManualClock:
+    def __init__(self):
+        self.time = 0.0
+        self.queue = []  # (due, order, ClockEvent)
+        self.order = 0
+
+    def get_time(self):
+        return self.time
+
+    # For metrics.Metrics, so traces measure virtual time
+    def now_ms(self):
+        return self.time * 1000
+
+    def schedule_once(self, callback, timeout=0):
+        event = ClockEvent(callback)
+        self.order += 1
+        heapq.heappush(self.queue, (self.time + max(timeout, 0), self.order, event))
+        return event
+
+    # Runs every callback that falls due in the next `seconds`
+    def advance(self, seconds):
+        end = self.time + seconds
+        while self.queue and self.queue[0][0] <= end:
+            due, _, event = heapq.heappop(self.queue)
+            self.time = max(self.time, due)
+            if not event.cancelled:
+                event.callback(0)
+        self.time = end
+
+
+class ClockEvent:
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class LoopbackLink(Link):
+    def __init__(self, transport, address, handler):
+        super().__init__(transport, address, handler)
+        self.board = transport.boards[address]
+        self.connected = False
+        self.subscribed = False
+        self.services = False  # found on an earlier link, reused by reconnect()
+        self.generation = 0  # bumped whenever the link goes down; older events are dropped
+
+    # Runs `callback(*args)` after the link latency, unless the link went
+    # down in the meantime
+    def later(self, callback, *args):
+        generation = self.generation
+
+        def deliver(dt):
+            if generation == self.generation:
+                callback(*args)
+        self.transport.clock.schedule_once(deliver, self.transport.latency_s)
+
+    def connect(self):
+        self.close()
+        self.open(reuse=False)
+
+    def reconnect(self):
+        self.open(reuse=self.services)
+        return True
+
+    # A board out of range never answers; the connect timeout notices
+    def open(self, reuse):
+        if not self.transport.in_range.get(self.address, True):
+            return
+        self.later(self.on_open, reuse)
+
+    def on_open(self, reuse):
+        self.connected = True
+        self.subscribed = False
+        self.transport.sync(self.board)
+        self.board.take_notifications()  # sent while nobody was connected
+        self.transport.run_board(self.board.connect, self.transport.mtu)
+        self.handler.on_link(True, GATT_SUCCESS)
+        self.handler.on_mtu(self.transport.mtu, GATT_SUCCESS)
+        if reuse:
+            self.handler.on_services(GATT_SUCCESS)
+        else:
+            self.later(self.on_discovered)
+
+    def on_discovered(self):
+        self.services = True
+        self.handler.on_services(GATT_SUCCESS)
+
+    def disconnect(self):
+        self.generation += 1
+        if self.connected:
+            self.connected = False
+            self.transport.run_board(self.board.disconnect)
+
+    def close(self):
+        self.disconnect()
+        self.services = False
+
+    # The link dropped without the app asking, as when a board is switched
+    # off or walks out of range
+    def lose(self, status=STATUS_LINK_LOSS):
+        if self.connected:
+            self.disconnect()
+            self.handler.on_link(False, status)
+
+    def subscribe(self):
+        self.later(self.on_subscribe)
+        return True
+
+    def on_subscribe(self):
+        self.subscribed = True
+        self.handler.on_subscribed(GATT_SUCCESS)
+
+    def write(self, payload):
+        if not self.connected:
+            return False
+        self.later(self.on_write, bytes(payload))
+        return True
+
+    def on_write(self, payload):
+        arrived = self.transport.clock.get_time()
+        self.transport.sync(self.board)
+        started = self.board.clock.seconds()
+        self.transport.run_board(self.board.write, payload)
+        monitor = self.transport.monitor
+        if monitor is not None:
+            monitor.delivered(self.address, arrived, payload)
+        self.handler.on_write(GATT_SUCCESS)
+        self.deliver_notifications(arrived - started)
+
+    # Hands the board's new reports to the app. `offset` turns board time
+    # into app clock time.
+    def deliver_notifications(self, offset):
+        monitor = self.transport.monitor
+        for t, value in self.board.take_notifications():
+            if monitor is not None:
+                monitor.reported(self.address, t + offset, value)
+            if self.subscribed:
+                self.handler.on_notify(TELEMETRY_UUID, value)
+
+
+class LoopbackTransport(Transport):
+    def __init__(self, clock, boards=1, latency_s=LATENCY_S, mtu=MTU, script=FIRMWARE_SCRIPT,
+                 count_host_time=False, monitor=None):
+        super().__init__(clock)
+        self.latency_s = latency_s
+        self.mtu = mtu
+        self.count_host_time = count_host_time
+        self.monitor = monitor
+        self.busy = 0.0  # host seconds the firmware has run for, with count_host_time
+        self.entered = None  # host time the current firmware call started
+        self.boards = {}  # address -> SimulatedBoard
+        self.in_range = {}  # address -> False for boards that do not answer
+        self.links = {}  # address -> LoopbackLink
+        self.scan_events = []
+        self.tick_event = None
+        for n in range(boards):
+            address = f"10:00:00:00:00:{n + 1:02X}"
+            self.boards[address] = SimulatedBoard(script, time_source=self.board_time)
+
+    def board(self, address):
+        return self.boards[address]
+
+    def link(self, address, handler):
+        link = self.links[address] = LoopbackLink(self, address, handler)
+        if self.tick_event is None:
+            self.tick_event = self.clock.schedule_once(self.tick, TICK_S)
+        return link
+
+    def board_time(self):
+        busy = self.busy
+        if self.entered is not None:
+            busy += time.perf_counter() - self.entered
+        return self.clock.get_time() + busy
+
+    # Calls into the firmware, counting the host time it takes if asked to
+    def run_board(self, function, *args):
+        if not self.count_host_time or self.entered is not None:
+            return function(*args)
+        self.entered = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.busy += time.perf_counter() - self.entered
+            self.entered = None
+
+    # Brings a board's clock up to the app clock, running the timers and
+    # tasks that fell due
+    def sync(self, board):
+        self.run_board(board.advance, 0)
+
+    # Runs the boards' timers and forwards their periodic telemetry
+    def tick(self, dt):
+        for link in self.links.values():
+            if link.connected:
+                self.sync(link.board)
+                link.deliver_notifications(self.clock.get_time() - link.board.clock.seconds())
+        self.tick_event = self.clock.schedule_once(self.tick, TICK_S)
+
+    # Test hooks: a board that drops its link, and one that stops answering
+    def drop(self, address, status=STATUS_LINK_LOSS):
+        link = self.links.get(address)
+        if link is not None:
+            link.lose(status)
+
+    def set_in_range(self, address, in_range):
+        self.in_range[address] = in_range
+        if not in_range:
+            self.drop(address)
+
+    # Boards advertise while they are in range and not connected
+    def start_scan(self, handler):
+        self.stop_scan()
+        for address in self.boards:
+            link = self.links.get(address)
+            if self.in_range.get(address, True) and (link is None or not link.connected):
+                self.scan_events.append(self.clock.schedule_once(
+                    lambda dt, address=address: handler.on_scan_result(address, BOARD_NAME, BOARD_RSSI),
+                    self.latency_s))
+        return True
+
+    def stop_scan(self):
+        for event in self.scan_events:
+            event.cancel()
+        self.scan_events = []